@@ -1,67 +1,50 @@
 from models.data_types import *
-from models.shared_memory import create_shared_state
+from models.shared_memory import create_shared_state, create_state_history
 from models.tasks import Task
+from models.events import NotifyingQueue, forward_queue
+from models.timers import TimerService
+from models.clock import Clock, VirtualClock
+from models.outbound import OutboundQueue
+from models.recorder import FlightRecorder
+from models.config import load_config
 
-from core.main import handle_log, motor_test, log, manage_tasks
+from core.main import handle_log, motor_test, log, manage_tasks, report_task_stats
 from core.websocket_handler import WebsocketHandler
 from core.control import Control
 from core.localization import Localization
 from core.navigation import Navigation
 
-from api.gps import GPS
 from api.abstract import AbstractController
 
 import multiprocessing
 from multiprocessing.shared_memory import SharedMemory
 import threading
 from queue import Queue, Empty
-from typing import List, Literal
-from time import time
-from pathlib import Path
-
-from pydantic import BaseModel
-from pydantic_yaml import parse_yaml_file_as
-from ruamel.yaml import YAML
-yaml = YAML(typ='safe')
-
-class ConfigSchema(BaseModel):
-    simulation: bool 
-    socket_ip: str
-    socket_port: int
-    perception: bool
-    video_ip: str
-    video_port: int
-    camera_path: str
-    ping_interval: int
-    gps_path: str
-
-def load_config() -> ConfigSchema:
-    default_config = parse_yaml_file_as(ConfigSchema, 'data/config.yaml').model_dump()
-    local_path = Path('data/local/config.yaml')
-    if local_path.exists():
-        local_file = open(local_path, 'r')
-        local_config = yaml.load(local_file)
-        local_file.close()
-        local_filtered = {k:v for (k,v) in local_config.items() if v}
-        default_config.update(local_filtered)
-    return ConfigSchema(**default_config)
+from typing import List, Literal, Optional
+from time import time, monotonic
 
 if __name__ == "__main__":
     config = load_config()
     log("STARTUP WITH CONFIGURATION:\n" + config.model_dump_json(indent=2))
 
+    # Set whenever something is put into a queue the main loop reads from
+    main_wakeup = threading.Event()
+
     # Anything put into this queue will be printed
     # to stdout & forwarded to frontend
-    logging_queue = Queue()
+    logging_queue = NotifyingQueue(main_wakeup)
     logging_pqueue = multiprocessing.Queue()
+    # Process tasks can't wake the main loop directly, so forward their logs
+    forward_queue(logging_pqueue, logging_queue, name="ProcessLogForwarder")
 
     # For tracking and cleanup
     tasks: List[Task] = []
     shared_memories: List[SharedMemory] = []
 
     # Websocket Initialization
-    queue_to_base = Queue(maxsize=10) # When there's no connection, messages pile up
-    queue_from_base= Queue()
+    # Decides what reaches base and when, so telemetry can't crowd out acks
+    queue_to_base = OutboundQueue(rates=config.telemetry_rates)
+    queue_from_base = NotifyingQueue(main_wakeup)
     ws_shutdown_q = Queue() # This just takes the single shutdown method for the websocket server
     ws_task = WebsocketHandler(
         websocket_interface=config.socket_ip,
@@ -72,6 +55,9 @@ if __name__ == "__main__":
         verbose=True,
         shutdown_q=ws_shutdown_q,
         logging_q=logging_queue,
+        batch_window=config.batch_window,
+        batch_bytes=config.batch_bytes,
+        batch_compression=config.batch_compression,
     )
     tasks.append(ws_task)
     ws_task.start()
@@ -82,12 +68,40 @@ if __name__ == "__main__":
         from api.motor_controller import MotorController
     else:
         from api.mock_controller import MockController as MotorController
-    motor_controller: AbstractController = MotorController(log)
+    # Lockstep simulated time shared by the simulator, control, and mock
+    # localization, so simulations run as fast as the CPU allows
+    sim_clock: Union[Clock, None] = None
+    sensor_emulation = config.simulation and config.sensor_emulation
+    if sensor_emulation and config.virtual_time:
+        # Localization is then a process, which can't join the virtual clock
+        log("Sensor emulation runs in real time, ignoring virtual_time")
+    elif config.simulation and config.virtual_time:
+        sim_clock = VirtualClock()
+        motor_controller: AbstractController = MotorController(log, clock=sim_clock)
+    else:
+        motor_controller = MotorController(log)
 
     # Control System Initialization
     shared_state_name = "shared_state"
     measured_state = create_shared_state(name=shared_state_name)
     shared_memories.append(measured_state)
+    shared_history_name = "shared_state_history"
+    state_history = create_state_history(name=shared_history_name)
+    shared_memories.append(state_history)
+
+    # Flight data recorder, set up before the tasks so it sees them start
+    recorder: Optional[FlightRecorder] = None
+    if config.recorder_path:
+        recorder = FlightRecorder(
+            config.recorder_path,
+            history=shared_history_name,
+            chunk_records=config.recorder_chunk_records,
+            clock=sim_clock.now if sim_clock else monotonic,
+        )
+        Task.recorder = recorder
+        motor_controller.recorder = recorder
+        recorder.start()
+        log("Recording to " + config.recorder_path + "/" + recorder.prefix + "_*.fdr")
 
     control_desired_q = Queue() # Setpoint input to nav
     navigation_task: Task = Navigation(
@@ -100,23 +114,55 @@ if __name__ == "__main__":
         shared_state_name=shared_state_name,
         logging_q=logging_queue,
         controller=motor_controller,
+        shared_history_name=shared_history_name,
+        clock=sim_clock,
     )
     tasks.append(control_task)
     
     # Initialize the real or fake localization task
-    if not config.simulation:
+    simulator_task: Optional[Task] = None
+    if sensor_emulation:
+        # Control stays on the simulated state, since the filters' estimate
+        # isn't good enough to steer by yet. The real localization runs on
+        # sensors emulated from it, as a soak and profiling load, and writes
+        # its estimate to its own shared memory
+        from core.localization import Mock_Localization
+        from api.localization import localize, localize_setup
+        from api.sensor_emulator import SensorEmulator, SharedTruth, localize_spec
+        shared_estimate_name = "shared_estimate"
+        shared_memories.append(create_shared_state(name=shared_estimate_name))
+        simulator_task = Mock_Localization(
+            output=shared_state_name,
+            logging_q=logging_queue,
+            localize_func=motor_controller.get_state,
+            output_history=shared_history_name,
+            name="Simulation",
+        )
+        tasks.append(simulator_task)
+        emulator = SensorEmulator(SharedTruth(shared_state_name), localize_spec())
+        localization_task: Task = Localization(
+            logging_q=logging_pqueue,
+            output_shared_memory=shared_estimate_name,
+            setup_args=localize_setup(emulator),
+            kalman_filter=localize,
+            depth_func=emulator.depth,
+            sensor_recording=config.recorder_path,
+        )
+    elif not config.simulation:
         from api.localization import localize, localize_setup
         def depth_func() -> float:
             return 0.
         # TODO: Convert this to task factory
         localization_input_q = multiprocessing.Queue()
         localization_stop = multiprocessing.Event()
-        localization_task: Task = Localization(
+        localization_task = Localization(
             logging_q=logging_pqueue,
             output_shared_memory=shared_state_name,
             setup_args=localize_setup(),
             kalman_filter=localize,
             depth_func=depth_func,
+            output_history=shared_history_name,
+            sensor_recording=config.recorder_path,
         )
     else:
         from core.localization import Mock_Localization
@@ -124,6 +170,8 @@ if __name__ == "__main__":
             output=shared_state_name,
             logging_q=logging_queue,
             localize_func=motor_controller.get_state,
+            output_history=shared_history_name,
+            clock=sim_clock,
         )
     tasks.append(localization_task)
 
@@ -138,9 +186,16 @@ if __name__ == "__main__":
         )
         tasks.append(perception_task)
 
-    promises: List[Promise] = []
+    timers = TimerService()
+    if config.stats_interval > 0:
+        timers.schedule(
+            name="taskStats",
+            delay=config.stats_interval,
+            callback=lambda: report_task_stats(tasks, logging_queue),
+            interval=config.stats_interval,
+        )
     dispatch: dict[
-        Literal["pid", "motor", "control", "mission", "tasks", "promise"],
+        Literal["pid", "motor", "control", "mission", "tasks"],
         Dispatch,
     ] = {
         "pid": Dispatch(
@@ -152,7 +207,7 @@ if __name__ == "__main__":
             func=lambda msg: motor_test(
                 msg["content"],
                 motor_controller=motor_controller,
-                promises=promises,
+                timers=timers,
                 disable_controller=control_task.deactivate,
             ),
         ),
@@ -168,14 +223,12 @@ if __name__ == "__main__":
             log="Managing tasks",
             func=lambda msg: manage_tasks(msg, tasks=tasks, logging_q=logging_queue),
         ),
-        "promise": Dispatch(
-            log="Registering promise",
-            func=lambda msg: promises.append(msg),
-        ),
     }
 
     try:
         control_task.startup()
+        if simulator_task:
+            simulator_task.startup()
         localization_task.startup()
         initial_task_log: str = "Tasks: "
         for task in tasks:
@@ -184,6 +237,10 @@ if __name__ == "__main__":
         del initial_task_log
         log("Beginning main loop")
         while True:
+            # Sleep until a log or command arrives or the next timer is due
+            main_wakeup.wait(timeout=timers.timeout())
+            main_wakeup.clear()
+
             # Parse logs
             while True:
                 try:
@@ -193,25 +250,29 @@ if __name__ == "__main__":
                 except Empty:
                     break
 
-            # Check promises
-            for promise in promises:
-                if time() - promise.init > promise.duration:
-                    promises.remove(promise)
-                    promise.callback()
+            # Run any timers that are due
+            timers.run_due()
 
             # Based on commands, dispatch functions and/or subroutines
-            try:
-                message = queue_from_base.get_nowait()
-                if message:
-                    log("Evaluating dispatch: " + str(message))
-                    if dispatch[message["command"]]:
-                        log("DISPATCH: " + dispatch[message["command"]].log)
-                        dispatch[message["command"]].func(message)
-                    else:
-                        log("Dispatch function not found for: " \
-                            + str(message["command"]))
-            except Empty:
-                pass
+            while True:
+                try:
+                    message = queue_from_base.get_nowait()
+                    if message:
+                        log("Evaluating dispatch: " + str(message))
+                        if recorder:
+                            recorder.command(message)
+                        handler = dispatch.get(message.get("command"))
+                        if handler:
+                            log("DISPATCH: " + handler.log)
+                            handler.func(message)
+                        else:
+                            log("Dispatch function not found for: " \
+                                + str(message.get("command")))
+                except Empty:
+                    break
+                except Exception as e:
+                    # A bad command from base must not take down the main loop
+                    log("Dispatch failed: " + repr(e))
 
     except KeyboardInterrupt:
         log("Joining threads")
@@ -220,6 +281,10 @@ if __name__ == "__main__":
             if task.meta.started:
                 task.shutdown()
                 task.join()
+        logging_pqueue.put(None) # Stops the log forwarder
+        if recorder:
+            log("Closing flight recording")
+            recorder.stop() # Before the shared memory it reads goes away
         log("Closing shared memory")
         for shm in shared_memories:
             shm.close()
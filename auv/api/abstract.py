@@ -1,12 +1,20 @@
-from typing import Union
+from typing import Tuple, Union
 import sys
 sys.path.append("../..")
 from models.data_types import State, MotorSpeeds
 
 class AbstractController():
+    # Set to a models.recorder.FlightRecorder to record every set_speeds()
+    recorder = None
+
     def set_speeds(self, input:MotorSpeeds, verbose=True):
         raise NotImplementedError
 
+    def record_speeds(self, input:MotorSpeeds):
+        """ Call at the start of set_speeds() """
+        if self.recorder:
+            self.recorder.motors(input)
+
     def set_zeros(self):
         raise NotImplementedError
 
@@ -18,3 +26,45 @@ class AbstractController():
     
     def set_last_time(self):
         raise NotImplementedError
+
+# The sensors localization reads, duck typed after the Adafruit drivers and
+# pyserial so the real objects fit without subclassing. See
+# api/sensor_emulator.py for emulated ones.
+
+class AbstractAccelGyro():
+    @property
+    def acceleration(self) -> Tuple[float, float, float]:
+        """ Specific force in m/s^2, body frame """
+        raise NotImplementedError
+
+    @property
+    def gyro(self) -> Tuple[float, float, float]:
+        """ Angular velocity in rad/s, body frame """
+        raise NotImplementedError
+
+class AbstractMagnetometer():
+    @property
+    def magnetic(self) -> Tuple[float, float, float]:
+        """ Magnetic field in microtesla, body frame """
+        raise NotImplementedError
+
+class AbstractSerial():
+    def readline(self) -> bytes:
+        raise NotImplementedError
+
+class AbstractPressureSensor():
+    """ Like MS5837: read() takes a sample, the rest return the last one """
+    def read(self) -> bool:
+        raise NotImplementedError
+
+    def pressure(self, conversion: float = 1.0) -> float:
+        """ In mbar times `conversion` """
+        raise NotImplementedError
+
+    def temperature(self) -> float:
+        """ In degrees C """
+        raise NotImplementedError
+
+    def depth(self) -> float:
+        """ In meters """
+        raise NotImplementedError
@@ -1 +1 @@
-from .main import localize, localize_setup, I2C, LSM6DS, LIS3MDL, serial, EKF, MUKF
+from .main import localize, localize_setup, EKF, MUKF
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.linalg import get_lapack_funcs
 
 # Tried adding individual class
 class GpsCoordinate:
@@ -36,8 +37,19 @@ EARTH_RADIUS = 6378137.0
 
 
 class EKF:
-    def __init__(self):
+    """ Loosely coupled INS/GPS error state EKF. The error state is
+        [position NED, velocity NED, accelerometer bias], 9 elements.
+
+        `dtype` is used for the covariance, the Jacobians, and every other
+        filter matrix. Latitude/longitude/altitude and velocity are always kept
+        in float64, since float32 can't resolve meters at the Earth's radius.
+        All matrices are allocated once here and updated in place. predict()
+        allocates nothing, and correct() only allocates the few 3-vectors of
+        the GPS position error (it runs at the GPS rate, not every step).
+    """
+    def __init__(self, dtype=np.float64):
         self.initialized_ = False
+        self.dtype = dtype
 
         # Initial States
         self.vn_ins = 0.0
@@ -49,25 +61,44 @@ class EKF:
         self.lon_ins = 0.0
         self.alt_ins= 0.0
         self.lla_ins: np.ndarray = np.zeros(3, dtype=np.float64)
+        self.lla_origin: np.ndarray = np.zeros(3, dtype=np.float64) # First fix
 
         self.abx = 0.0
         self.aby = 0.0
         self.abz = 0.0
-        self.accel_bias = np.zeros(3, dtype=np.float32)
-
-        self.P = np.zeros((9, 9), dtype=np.float32)
-        self.R = np.zeros((6, 6), dtype=np.float32)
-        self.H = np.zeros((6, 9), dtype=np.float32)
-        self.Rw = np.zeros((6, 6), dtype=np.float32)
-
-        self.f_b = np.zeros(3, dtype=np.float32)
-        self.grav = np.array([0.0, 0.0, G], dtype=np.float32)
+        self.accel_bias = np.zeros(3, dtype=dtype)
+
+        self.P = np.zeros((9, 9), dtype=dtype)
+        self.R = np.zeros((6, 6), dtype=dtype)
+        self.H = np.zeros((6, 9), dtype=dtype)
+        self.Rw = np.zeros((6, 6), dtype=dtype)
+
+        self.f_b = np.zeros(3, dtype=dtype)
+        self.grav = np.array([0.0, 0.0, G], dtype=dtype)
+
+        # Workspace for predict() and correct()
+        self._C_N2B = np.zeros((3, 3), dtype=dtype)
+        self._acc = np.zeros(3, dtype=dtype)
+        self._accel_nav = np.zeros(3, dtype=dtype)
+        self._PHI = np.identity(9, dtype=dtype)
+        self._Q = np.zeros((9, 9), dtype=dtype)
+        self._CCt = np.zeros((3, 3), dtype=dtype)
+        self._tmp = np.zeros((9, 9), dtype=dtype)
+        self._S = np.zeros((6, 6), dtype=dtype)
+        # K is found transposed, in Fortran order so LAPACK solves in place
+        self._Kt = np.zeros((6, 9), dtype=dtype, order="F")
+        self._posv = get_lapack_funcs("posv", (self._Kt,))
+        self._KR = np.zeros((9, 6), dtype=dtype)
+        self._KRKt = np.zeros((9, 9), dtype=dtype)
+        self._I_KH = np.identity(9, dtype=dtype)
+        self._y = np.zeros(6, dtype=dtype)
+        self._x_err = np.zeros(9, dtype=dtype)
 
         self._initialize_matrices()
 
     def _initialize_matrices(self):
-        self.H[0:3, 0:3] = np.identity(3, dtype=np.float32)
-        self.H[3:6, 3:6] = np.identity(3, dtype=np.float32)
+        self.H[0:3, 0:3] = np.identity(3)
+        self.H[3:6, 3:6] = np.identity(3)
 
         self.Rw[0:3, 0:3] = (SIG_W_A**2.0) * np.identity(3)
         self.Rw[3:6, 3:6] = (2.0 * SIG_A_D*SIG_A_D / TAU_A) * np.identity(3)
@@ -89,6 +120,18 @@ class EKF:
     # Velocity down is also 0 here since we used Course Made Good for direction...
     def get_vel_down_ms(self): return self.vd_ins
 
+    def get_position_ned_m(self):
+        """ North, east, and down in meters from the first fix, on a flat
+            earth tangent there
+        """
+        lat0, lon0, alt0 = self.lla_origin
+        Rew, Rns = self._earth_radius(lat0)
+        return (
+            (self.lat_ins - lat0) * (Rns + alt0),
+            (self.lon_ins - lon0) * (Rew + alt0) * np.cos(lat0),
+            alt0 - self.alt_ins,
+        )
+
     # Helper Functions
     def _earth_radius(self, lat):
         sin_lat_sq = np.sin(lat)**2.0
@@ -155,19 +198,19 @@ class EKF:
         ned = R_ecef2ned @ ecef_vec
         return ned
     
-    def _quat2dcm(self, q):
-        """Converts quaternion (w, x, y, z) to a DCM"""
+    def _quat2dcm(self, q, dcm=None):
+        """Converts quaternion (w, x, y, z) to a DCM, written into `dcm` if
+        given"""
         q0, q1, q2, q3 = q
         q0_2 = q0**2; q1_2 = q1**2; q2_2 = q2**2; q3_2 = q3**2
         q1q2 = q1*q2; q0q3 = q0*q3
         q1q3 = q1*q3; q0q2 = q0*q2
         q2q3 = q2*q3; q0q1 = q0*q1
 
-        dcm = np.zeros((3, 3), dtype=np.float32)
+        if dcm is None:
+            dcm = np.zeros((3, 3), dtype=self.dtype)
         
         # Check with textbook if this Quaternion -> DCM is correct 
-        dcm[0,0] = q0_2 + q1_2 - q2_2 - q3_2
-    
         dcm[0,0] = 2.0 * q0_2 - 1.0 + 2.0 * q1_2
         dcm[1,1] = 2.0 * q0_2 - 1.0 + 2.0 * q2_2
         dcm[2,2] = 2.0 * q0_2 - 1.0 + 2.0 * q3_2
@@ -188,58 +231,84 @@ class EKF:
         self.lat_ins, self.lon_ins, self.alt_ins = init_gps_coor.lat, init_gps_coor.lon, init_gps_coor.alt
         self.vn_ins, self.ve_ins, self.vd_ins = init_gps_vel.vN, init_gps_vel.vE, init_gps_vel.vD
         self.lla_ins[:] = [self.lat_ins, self.lon_ins, self.alt_ins]
+        self.lla_origin[:] = self.lla_ins
         self.V_ins[:] = [self.vn_ins, self.ve_ins, self.vd_ins]
 
         self.abx, self.aby, self.abz = 0.0, 0.0, 0.0
         self.accel_bias[:] = [self.abx, self.aby, self.abz]
 
-        self.P = np.zeros((9, 9), dtype=np.float32)
+        self.P[:] = 0.0
         self.P[0:3, 0:3] = (P_P_INIT**2.0) * np.identity(3)
         self.P[3:6, 3:6] = (P_V_INIT**2.0) * np.identity(3)
         self.P[6:9, 6:9] = (P_AB_INIT**2.0) * np.identity(3)
 
         self.initialized_ = True
-        print("Position/Velocity Initialized")
 
 
     def predict(self, dt, imu_data, q):
-        C_N2B = self._quat2dcm(q)
+        C_N2B = self._quat2dcm(q, self._C_N2B)
         C_B2N = C_N2B.T
 
-        acc_raw = np.array([imu_data.accX, imu_data.accY, imu_data.accZ], dtype=np.float32)
-        self.f_b = acc_raw - self.accel_bias
-
-        print(C_B2N @ self.f_b)
-        accel_nav = C_B2N @ self.f_b + self.grav
-
-        self.vn_ins += accel_nav[0] * dt
-        self.ve_ins += accel_nav[1] * dt
-        self.vd_ins += accel_nav[2] * dt
-        self.V_ins[:] = [self.vn_ins, self.ve_ins, self.vd_ins]
-
-        lla_dot = self._llarate(self.V_ins, self.lat_ins, self.alt_ins)
+        acc_raw = self._acc
+        acc_raw[0] = imu_data.accX
+        acc_raw[1] = imu_data.accY
+        acc_raw[2] = imu_data.accZ
+        np.subtract(acc_raw, self.accel_bias, out=self.f_b)
+
+        accel_nav = self._accel_nav
+        np.matmul(C_B2N, self.f_b, out=accel_nav)
+        accel_nav += self.grav
+
+        self.vn_ins += float(accel_nav[0]) * dt
+        self.ve_ins += float(accel_nav[1]) * dt
+        self.vd_ins += float(accel_nav[2]) * dt
+        V_ins = self.V_ins
+        V_ins[0] = self.vn_ins
+        V_ins[1] = self.ve_ins
+        V_ins[2] = self.vd_ins
+
+        lla_dot = self._llarate(V_ins, self.lat_ins, self.alt_ins)
         self.lat_ins += lla_dot[0] * dt
         self.lon_ins += lla_dot[1] * dt
         self.alt_ins += lla_dot[2] * dt
-        self.lla_ins[:] = [self.lat_ins, self.lon_ins, self.alt_ins]
-
-        # Calculate Jacobian Fs (9x9) - relates error state derivative to error state
-        Fs = np.zeros((9, 9), dtype=np.float32)
-        Fs[0:3, 3:6] = np.identity(3)
-        Fs[5, 2] = 2.0 * G / EARTH_RADIUS
-        Fs[3:6, 6:9] = -C_B2N
-        Fs[6:9, 6:9] = (-1.0 / TAU_A) * np.identity(3)
-        PHI = np.identity(9, dtype=np.float32) + Fs * dt
-
-        Gs = np.zeros((9, 6), dtype=np.float32)
-        Gs[3:6, 0:3] = -C_B2N
-        Gs[6:9, 3:6] = np.identity(3)
-        Q = PHI @ Gs @ self.Rw @ Gs.T * dt
-        Q = 0.5 * (Q + Q.T)
-        
-        self.P = PHI @ self.P @ PHI.T + Q
-        self.P = 0.5 * (self.P + self.P.T)
-        self.P += np.identity(9) * 1e-12
+        lla_ins = self.lla_ins
+        lla_ins[0] = self.lat_ins
+        lla_ins[1] = self.lon_ins
+        lla_ins[2] = self.alt_ins
+
+        # PHI = I + Fs * dt, where the Jacobian Fs (relating the error state
+        # derivative to the error state) only has these nonzero blocks:
+        #   Fs[0:3, 3:6] = I, Fs[5, 2] = 2G/R, Fs[3:6, 6:9] = -C_B2N,
+        #   Fs[6:9, 6:9] = -I/TAU_A
+        # so only those entries of the preallocated PHI are updated
+        PHI = self._PHI
+        PHI[0, 3] = PHI[1, 4] = PHI[2, 5] = dt
+        PHI[5, 2] = 2.0 * G / EARTH_RADIUS * dt
+        np.multiply(C_B2N, -dt, out=PHI[3:6, 6:9])
+        PHI[6, 6] = PHI[7, 7] = PHI[8, 8] = 1.0 - dt / TAU_A
+
+        # Q = sym(PHI @ Gs @ Rw @ Gs.T * dt), with Gs[3:6, 0:3] = -C_B2N and
+        # Gs[6:9, 3:6] = I the only nonzero blocks of Gs and Rw diagonal per
+        # block, so Gs @ Rw @ Gs.T = blockdiag(0, ra * C C^T, rb * I)
+        ra = self.Rw[0, 0]
+        rb = self.Rw[3, 3]
+        CCt = np.matmul(C_B2N, C_N2B, out=self._CCt)
+        Q = self._Q
+        np.multiply(CCt, 0.5 * ra * dt * dt, out=Q[0:3, 3:6])
+        np.multiply(CCt, 0.5 * ra * dt * dt, out=Q[3:6, 0:3])
+        np.multiply(CCt, ra * dt, out=Q[3:6, 3:6])
+        np.multiply(C_B2N, -0.5 * rb * dt * dt, out=Q[3:6, 6:9])
+        np.multiply(C_N2B, -0.5 * rb * dt * dt, out=Q[6:9, 3:6])
+        Q[6, 6] = Q[7, 7] = Q[8, 8] = (1.0 - dt / TAU_A) * rb * dt
+
+        P = self.P
+        tmp = self._tmp
+        np.matmul(PHI, P, out=tmp)
+        np.matmul(tmp, PHI.T, out=P)
+        P += Q
+        np.add(P, P.T, out=tmp)
+        np.multiply(tmp, 0.5, out=P)
+        P.flat[::10] += 1e-12
 
 
     def correct(self, gps_vel, gps_coord):
@@ -253,23 +322,30 @@ class EKF:
         pos_err_ned = self._ecef2ned(pos_ecef_gps - pos_ecef_ins, self.lla_ins)
 
         # Measurement innovation vector y (6x1)
-        y = np.zeros(6, dtype=np.float32)
-        y[0:3] = pos_err_ned.astype(np.float32)
+        y = self._y
+        y[0:3] = pos_err_ned
         y[3] = gps_vel.vN - self.vn_ins
         y[4] = gps_vel.vE - self.ve_ins
         y[5] = gps_vel.vD - self.vd_ins
 
         P = self.P 
-        H = self.H
         R = self.R
 
-        PHt = P @ H.T
-        S = H @ PHt + R
-
-        # Could use solve_kalman_gain() helper from unscented but this seems to work
-        S_inv = np.linalg.inv(S)
-        K = PHt @ S_inv
-        x_err = K @ y
+        # H just selects the position and velocity, so P @ H.T is the first 6
+        # columns of P and H @ P @ H.T is its top left 6x6 block
+        PHt = P[:, 0:6]
+        S = np.add(P[0:6, 0:6], R, out=self._S)
+
+        # K = PHt @ inv(S), found by solving S @ K.T = PHt.T with a Cholesky
+        # factorization (S is symmetric positive definite). S is symmetric,
+        # so it is its own Fortran order copy, and both are overwritten.
+        Kt = self._Kt
+        np.copyto(Kt, PHt.T)
+        _c, _x, info = self._posv(S.T, Kt, lower=True, overwrite_a=True, overwrite_b=True)
+        if info != 0:
+            raise np.linalg.LinAlgError("Innovation covariance is not positive definite")
+        K = Kt.T
+        x_err = np.matmul(K, y, out=self._x_err)
 
         dpn, dpe, dpd = x_err[0], x_err[1], x_err[2]
         dvn, dve, dvd = x_err[3], x_err[4], x_err[5]
@@ -303,10 +379,16 @@ class EKF:
         self.accel_bias[:] = [self.abx, self.aby, self.abz]
 
 
-        I_KH = np.identity(9, dtype=np.float32) - K @ H
+        # I - K @ H is the identity minus K in its first 6 columns
+        I_KH = self._I_KH
+        np.negative(K, out=I_KH[:, 0:6])
+        I_KH[0:6, 0:6].flat[::7] += 1.0
         # Used Joseph form for better numerical stability
-        P_corrected = I_KH @ P @ I_KH.T + K @ R @ K.T
-
-        self.P = P_corrected
-        self.P = 0.5 * (self.P + self.P.T)
-        self.P += np.identity(9) * 1e-12
+        tmp = self._tmp
+        np.matmul(I_KH, P, out=tmp)
+        np.matmul(tmp, I_KH.T, out=P)
+        KR = np.matmul(K, R, out=self._KR)
+        P += np.matmul(KR, Kt, out=self._KRKt)
+        np.add(P, P.T, out=tmp)
+        np.multiply(tmp, 0.5, out=P)
+        P.flat[::10] += 1e-12
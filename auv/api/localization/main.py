@@ -1,19 +1,28 @@
-import serial
+from __future__ import annotations
 import pynmea2
-import board
-from busio import I2C
 import time
 import math
 import numpy as np
-from typing import Callable
+from typing import Callable, Optional, TYPE_CHECKING
 
-from adafruit_lis3mdl import LIS3MDL
-from adafruit_lsm6ds.lsm6dsox import LSM6DSOX as LSM6DS
 from scipy.spatial.transform import Rotation
 
-from extended_filter import EKF, ImuData, GpsCoordinate, GpsVelocity
-from models.data_types import KinematicState
-from unscented_quat import MUKF
+try:
+    from .extended_filter import EKF, ImuData, GpsCoordinate, GpsVelocity
+    from .unscented_quat import MUKF
+except ImportError:
+    from extended_filter import EKF, ImuData, GpsCoordinate, GpsVelocity
+    from unscented_quat import MUKF
+from models.data_types import State as KinematicState
+
+# The hardware libraries are only imported by localize_setup(), so that
+# localize() can run off the vehicle (e.g. in api/replay.py)
+if TYPE_CHECKING:
+    import serial
+    from busio import I2C
+    from adafruit_lis3mdl import LIS3MDL
+    from adafruit_lsm6ds.lsm6dsox import LSM6DSOX as LSM6DS
+    from api.sensor_emulator import SensorEmulator
 
 # --- magnetometer calibration constants ---
 B = np.array([  -10.37,   67.69,   72.69])
@@ -35,7 +44,18 @@ def heading_to_ned(speed_kt, course_deg):
     v_e = speed_ms * math.sin(rad)
     return v_n, v_e
 
-def localize_setup(): # Temporary for instatiation
+def localize_setup(emulator: Optional[SensorEmulator] = None): # Temporary for instatiation
+    """ The sensors and filters for localize(), or with `emulator` its
+        emulated sensors in place of the hardware
+    """
+    if emulator:
+        return None, emulator.imu, emulator.magnetometer, emulator.gps_serial, EKF(), MUKF()
+
+    import serial
+    import board
+    from adafruit_lis3mdl import LIS3MDL
+    from adafruit_lsm6ds.lsm6dsox import LSM6DSOX as LSM6DS
+
     # I²C sensors
     i2c       = board.I2C()
     ag_sensor = LSM6DS(i2c)
@@ -57,8 +77,13 @@ def localize(
     ser: serial.Serial,
     ekf: EKF,
     mukf: MUKF,
+    cur_time: Optional[float] = None,
 ) -> KinematicState:
-    cur_time = time.time()
+    """ One filter step with the sensors read now. `cur_time` is the time of
+        this step (defaults to time.time()), on the same clock as `prev_time`.
+    """
+    if cur_time is None:
+        cur_time = time.time()
     dt = cur_time - prev_time
          
     # --- read IMU & mag ---
@@ -66,7 +91,7 @@ def localize(
     wm = np.array(ag_sensor.gyro)
     mm = np.array(Ainv @ (np.array(m_sensor.magnetic) - B))
     
-    mukf.update_imu(dt, am, wm, mm)
+    mukf.update_imu(am, wm, mm, dt)
     q = mukf.get_current_orientation()
 
     imu = ImuData(accX=am[0], accY=am[1], accZ=am[2])
@@ -76,7 +101,6 @@ def localize(
     if line.startswith(b'$GPRMC'):
         s = line.decode('utf-8').strip()
         parsed = parse_gprmc(s)
-        print(parsed)
         if parsed:
             lat_deg, lon_deg, spd_kt, crs_deg = parsed
             lat_rad = math.radians(lat_deg)
@@ -89,13 +113,30 @@ def localize(
                 ekf.correct(gps_vel, gps_coor)
             else:
                 ekf.initialize(gps_vel, gps_coor)
-        
-    return KinematicState(
-        position = np.zeros(3, dtype=float),
-        velocity = np.zeros(3, dtype=float),
-        attitude = np.zeros(3, dtype=float),
-        angular_velocity = np.zeros(3, dtype=float),
-    )
+
+    return estimate(ekf, mukf)
+
+def estimate(ekf: EKF, mukf: MUKF) -> KinematicState:
+    """ The filters' estimate in the frame the rest of the AUV uses (that of
+        MockController): x north, y west, z up, from the first GPS fix, with
+        the attitude as intrinsic XYZ Euler angles in degrees and the
+        angular velocity in rad/s. The position and velocity stay zero until
+        the first fix, and z is left to the depth sensor.
+    """
+    state = KinematicState()
+    if ekf.initialized():
+        north, east, _down = ekf.get_position_ned_m()
+        state.position[0] = north
+        state.position[1] = -east
+        state.velocity[0] = ekf.get_vel_north_ms()
+        state.velocity[1] = -ekf.get_vel_east_ms()
+        state.velocity[2] = -ekf.get_vel_down_ms()
+    w, x, y, z = mukf.get_current_orientation()
+    rotation = Rotation.from_quat([x, y, z, w])
+    state.attitude[:] = rotation.as_euler("XYZ", degrees=True)
+    # The filter's angular velocity is in the body frame, the state's isn't
+    state.angular_velocity[:] = rotation.apply(mukf.w)
+    return state
 
 if __name__ == "__main__":
     i2c, ag_sensor, m_sensor, ser, ekf, mukf = localize_setup()
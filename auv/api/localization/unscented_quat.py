@@ -13,10 +13,9 @@ Qa - acceleration process noise
 Rw - angular velocity measurement noise
 Ra - acceleration measurement noise
 W0 - weight for the mean sigma values
-State Vector = [e, w, Qw, Qa]
+State Vector = [e, w, Qw, Qa, Qm]
 ________________________________________________________________________________
 TODO
--Optimize (Use numpy whenever possible, modify objects in-place (use x[:]=))
 -Add position tracking with GPS and motor input signal (Bu term in literature)
 """
 
@@ -25,6 +24,10 @@ from math import sqrt, sin, cos
 import numpy as np
 from scipy.linalg import cholesky, solve_triangular
 
+# Augmented state is [e, w, Qw, Qa, Qm], giving 2 * N_AUG + 1 sigma points
+N_AUG = 15
+N_SIGMA = 2 * N_AUG + 1
+
 
 class MUKF:
     def __init__(self):
@@ -43,6 +46,14 @@ class MUKF:
         self.W0 = 1.0/25.0
         self.chartUpdate = True
 
+        # Workspace reused by every update_imu()
+        self._Pe = np.zeros((N_AUG, N_AUG))
+        self._offsets = np.zeros((N_SIGMA, N_AUG))
+        self._X = np.zeros((N_SIGMA, 7))
+        self._Y = np.zeros((N_SIGMA, 9))
+        self._dX = np.zeros((N_SIGMA, 6))
+        self._weights = np.zeros(N_SIGMA)
+
     def set_q(self, qIn):
         """ Manually set the current quaternion orientation """
         self.q = qIn
@@ -63,88 +74,58 @@ class MUKF:
         """
         Takes in acceleration (m/s), angular velocity (rad/s), magnetic field 
         strength (T), and delta time to repeatedly update the estimated state
+
+        All 2 * N_AUG + 1 sigma points are propagated together as rows of
+        (31, n) arrays rather than one at a time.
         """
-        Pe = np.zeros((15, 15))
+        Pe = self._Pe
         Pe[0:6, 0:6] = self.P
         Pe[6:9, 6:9] = self.Qw
         Pe[9:12, 9:12] = self.Qa
         Pe[12:15, 12:15] = self.Qm
 
-        L_pe_upper = cholesky(Pe)
-        Pe_L = L_pe_upper.T
-        Pe[:] = Pe_L
-        Wi = (1.0 - self.W0) / (2.0 * 12)
+        Wi = (1.0 - self.W0) / (2.0 * N_AUG)
         alpha = 1.0 / sqrt(2.0 * Wi)
-        Pe *= alpha        
-        
-        X = np.zeros((31, 16))
-        Y = np.zeros((31, 9))
+        # The columns of the lower Cholesky factor are the rows of the upper
+        offsets = self._offsets
+        np.multiply(cholesky(Pe, check_finite=False), alpha, out=offsets[1:N_AUG+1])
+        np.negative(offsets[1:N_AUG+1], out=offsets[N_AUG+1:])
 
+        # Sigma points: quaternion [0:4], angular velocity [4:7]
+        X = self._X
         X[0, :4] = self.q
-        X[0, 4:7] = self.w
-        X[0, 7:16] = 0.0
-
-        # if not self.chartUpdate:
-        #     self.q0[:] = self.q
-        #     self.e[:] = 0.0
-
-        for j in range(15):
-            eP_plus = self.e + Pe[:, j][0:3]
-            X[j+1, :4] = MUKF.chart_to_manifold(self.q0, eP_plus)
-            X[j+1, 4:7] = self.w + Pe[:, j][3:6]
-            X[j+1, 7:16] = Pe[:, j][6:15]
-
-        for j in range(15):
-            eP_minus = self.e - Pe[:, j][0:3]
-            X[j+13, :4] = MUKF.chart_to_manifold(self.q0, eP_minus)
-            X[j+13, 4:7] = self.w - Pe[:, j][3:6]
-            X[j+13, 7:16] = -Pe[:, j][6:15]
-
-        for j in range(31):
-            MUKF.state_transition(X[j], dt)
-            prod = X[0, :4] @ X[j, :4]
-            if prod < 0.0:
-                X[j, :4] *= -1.0
-            MUKF.state_to_measurement(Y[j], X[j])
-
-        xmean = np.zeros(7)
-        ymean = np.zeros(9)
-        xmean[:7] = self.W0*X[0, :7]
-        ymean[:9] = self.W0*Y[0, :9]
-        for j in range(1, 31):
-            xmean[:7] += Wi*X[j, :7]
-            ymean[:9] += Wi*Y[j, :9]
-
-        qmeanNorm = np.linalg.norm(xmean[:4])
-        xmean[:4] /= qmeanNorm
-        
-        Pxx = np.zeros((6, 6))
-        Pxy = np.zeros((6, 9))
-        Pyy = np.zeros((9, 9))
-        dX = np.zeros(6)
-        dY = np.zeros(9)
-
-        dX[:3] = MUKF.manifold_to_chart(xmean[:4], X[0, :4])
-        dX[3:6] = X[0, 4:7] - xmean[4:7]
-        dY[:] = Y[0, :9] - ymean[:9]
-
-        Pxx += self.W0 * np.outer(dX, dX)
-        Pxy += self.W0 * np.outer(dX, dY)
-        Pyy += self.W0 * np.outer(dY, dY)
-
-        for k in range(1, 25):
-            dX[:3] = MUKF.manifold_to_chart(xmean[:4], X[k, :4])
-            dX[3:6] = X[k, 4:7] - xmean[4:7]
-            dY[:] = Y[k, :9] - ymean[:9]
-            Pxx += Wi * np.outer(dX, dX)
-            Pxy += Wi * np.outer(dX, dY)
-            Pyy += Wi * np.outer(dY, dY)
+        X[1:, :4] = MUKF.chart_to_manifold(self.q0, self.e + offsets[1:, 0:3])
+        np.add(self.w, offsets[:, 3:6], out=X[:, 4:7])
+
+        # The angular velocity noise enters through the process model
+        MUKF.state_transition(X, offsets[:, 6:9], dt)
+        flip = X[:, :4] @ X[0, :4] < 0.0
+        X[flip, :4] *= -1.0
+        Y = self._Y
+        MUKF.state_to_measurement(Y, X)
+
+        weights = self._weights
+        weights[0] = self.W0
+        weights[1:] = Wi
+        xmean = weights @ X
+        ymean = weights @ Y
+        xmean[:4] /= np.linalg.norm(xmean[:4])
+
+        dX = self._dX
+        dX[:, :3] = MUKF.manifold_to_chart(xmean[:4], X[:, :4])
+        np.subtract(X[:, 4:7], xmean[4:7], out=dX[:, 3:6])
+        dY = Y - ymean
+
+        wdX = dX * weights[:, None]
+        Pxx = wdX.T @ dX
+        Pxy = wdX.T @ dY
+        Pyy = (dY * weights[:, None]).T @ dY
 
         Pyy[0:3, 0:3] += self.Ra
         Pyy[3:6, 3:6] += self.Rw
         Pyy[6:9, 6:9] += self.Rm
 
-        K = MUKF.solve_kalman_gain(np.copy(Pyy), Pxy)
+        K = MUKF.solve_kalman_gain(Pyy, Pxy)
         anorm = np.linalg.norm(am)
         mnorm = np.linalg.norm(mm)
         y = np.concatenate(((am) / anorm - ymean[:3],
@@ -154,97 +135,88 @@ class MUKF:
 
         self.q0 = xmean[:4]
         self.e = dx[:3]
-        self.q = MUKF.chart_to_manifold(np.copy(self.q0), np.copy(self.e))
+        self.q = MUKF.chart_to_manifold(self.q0, np.copy(self.e))
         self.q /= np.linalg.norm(self.q)
         self.w = xmean[4:7] + dx[3:6]
         self.P = Pxx - K @ Pyy @ K.T 
         self.P = 0.5 * (self.P + self.P.T)
     
     def manifold_to_chart(qm, q):
-        """ Maps the quaternion q to the qm-centered orthographic chart """
-        delta = np.zeros(4)
-        delta[0] = qm[0]*q[0] + qm[1]*q[1] + qm[2]*q[2] + qm[3]*q[3]
-        delta[1] = qm[0]*q[1] - q[0]*qm[1] - qm[2]*q[3] + qm[3]*q[2]
-        delta[2] = qm[0]*q[2] - q[0]*qm[2] - qm[3]*q[1] + qm[1]*q[3]
-        delta[3] = qm[0]*q[3] - q[0]*qm[3] - qm[1]*q[2] + qm[2]*q[1]
-
-        if delta[0] < 0.0:
-            delta *= -1.0
-
-        e = np.zeros(3)
-        e[0] = 2.0 * delta[1]
-        e[1] = 2.0 * delta[2]
-        e[2] = 2.0 * delta[3]
+        """ Maps the quaternion q to the qm-centered orthographic chart.
+            q may also be an (N, 4) array, giving an (N, 3) array of points.
+        """
+        q0, q1, q2, q3 = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+        d0 = qm[0]*q0 + qm[1]*q1 + qm[2]*q2 + qm[3]*q3
+        sign = np.where(d0 < 0.0, -2.0, 2.0)
+
+        e = np.empty(q.shape[:-1] + (3,))
+        e[..., 0] = sign * (qm[0]*q1 - q0*qm[1] - qm[2]*q3 + qm[3]*q2)
+        e[..., 1] = sign * (qm[0]*q2 - q0*qm[2] - qm[3]*q1 + qm[1]*q3)
+        e[..., 2] = sign * (qm[0]*q3 - q0*qm[3] - qm[1]*q2 + qm[2]*q1)
         return e
 
     def chart_to_manifold(qm, e):
-        """ Maps the point e in the qm-centered chart to the manifold """
-        enorm = np.linalg.norm(e)
-        if enorm > 2.0:
-            aux = 2.0 / enorm
-            e *= aux
-            enorm = 2.0
-
-        delta = np.zeros(4)
-        delta[0] = sqrt(1.0 - 0.25 * enorm * enorm)
-        delta[1:4] = 0.5 * e
-
-        q = np.zeros(4)
-        q[0] = qm[0]*delta[0] - qm[1]*delta[1] - qm[2]*delta[2] - qm[3]*delta[3]
-        q[1] = qm[0]*delta[1] + delta[0]*qm[1] + qm[2]*delta[3] - qm[3]*delta[2]
-        q[2] = qm[0]*delta[2] + delta[0]*qm[2] + qm[3]*delta[1] - qm[1]*delta[3]
-        q[3] = qm[0]*delta[3] + delta[0]*qm[3] + qm[1]*delta[2] - qm[2]*delta[1]
+        """ Maps the point e in the qm-centered chart to the manifold.
+            e may also be an (N, 3) array, giving an (N, 4) array of
+            quaternions. Points outside the chart are scaled onto its edge.
+        """
+        enorm = np.linalg.norm(e, axis=-1, keepdims=True)
+        outside = enorm > 2.0
+        if np.any(outside):
+            e = np.where(outside, e * (2.0 / np.where(outside, enorm, 1.0)), e)
+            enorm = np.minimum(enorm, 2.0)
+
+        d0 = np.sqrt(1.0 - 0.25 * enorm[..., 0] * enorm[..., 0])
+        d1, d2, d3 = 0.5 * e[..., 0], 0.5 * e[..., 1], 0.5 * e[..., 2]
+
+        q = np.empty(e.shape[:-1] + (4,))
+        q[..., 0] = qm[0]*d0 - qm[1]*d1 - qm[2]*d2 - qm[3]*d3
+        q[..., 1] = qm[0]*d1 + d0*qm[1] + qm[2]*d3 - qm[3]*d2
+        q[..., 2] = qm[0]*d2 + d0*qm[2] + qm[3]*d1 - qm[1]*d3
+        q[..., 3] = qm[0]*d3 + d0*qm[3] + qm[1]*d2 - qm[2]*d1
         return q
 
-    def state_transition(x, dt):
-        """ Predicts next state from angular velocity and previous state """
-        wp = x[4:7] + x[7:10] * dt
-        wnorm = np.linalg.norm(wp)
-
-        qw = np.zeros(4)
-        if wnorm != 0.0:
-            wdt05 = 0.5 * wnorm * dt
-            qw[0] = cos(wdt05)
-            qw[1:4] = wp * (sin(wdt05) / wnorm )
-        else:
-            qw[0] = 1.0
-            qw[1:4] = 0.0
-
-        qp = np.zeros(4)
-        qp = np.zeros(4)
-        qp[0] = x[0]*qw[0] - x[1]*qw[1] - x[2]*qw[2] - x[3]*qw[3]
-        qp[1] = x[0]*qw[1] + qw[0]*x[1] + x[2]*qw[3] - x[3]*qw[2]
-        qp[2] = x[0]*qw[2] + qw[0]*x[2] + x[3]*qw[1] - x[1]*qw[3]
-        qp[3] = x[0]*qw[3] + qw[0]*x[3] + x[1]*qw[2] - x[2]*qw[1]
-
-        x[:4] = qp
-        x[4:7] = wp
-
-    def state_to_measurement(y, x):
-        """ Predicts IMU measurements given the state """
-        RT = np.zeros((3, 3))
-        RT[0, 0] = 1.0 - 2.0*(x[2]*x[2] + x[3]*x[3])
-        RT[0, 1] = 2.0*(x[1]*x[2] - x[3]*x[0])
-        RT[0, 2] = 2.0*(x[1]*x[3] + x[2]*x[0])
-
-        RT[1, 0] = 2.0*(x[1]*x[2] + x[3]*x[0])
-        RT[1, 1] = 1.0 - 2.0*(x[1]*x[1] + x[3]*x[3])
-        RT[1, 2] = 2.0*(x[2]*x[3] - x[1]*x[0])
-
-        RT[2, 0] = 2.0*(x[1]*x[3] - x[2]*x[0])
-        RT[2, 1] = 2.0*(x[2]*x[3] + x[1]*x[0])
-        RT[2, 2] = 1.0 - 2.0*(x[1]*x[1] + x[2]*x[2])
-
-        ap = np.array([0, 0, 1])
-        y[:3] = RT @ ap
-        y[3:6] = x[4:7]
-        mp = np.array([1, 0, 0])
-        y[6:] = RT @ mp
+    def state_transition(X, noise_w, dt):
+        """ Predicts next state of every sigma point (rows of X) in place from
+            its angular velocity, perturbed by the angular velocity noise
+        """
+        wp = X[:, 4:7] + noise_w * dt
+        wnorm = np.linalg.norm(wp, axis=1)
+        moving = wnorm != 0.0
+        wdt05 = 0.5 * wnorm * dt
+
+        qw0 = np.cos(wdt05)
+        # Identity rotation wherever the angular velocity is exactly zero
+        scale = np.divide(np.sin(wdt05), wnorm, out=np.zeros_like(wnorm), where=moving)
+        qw1, qw2, qw3 = wp[:, 0] * scale, wp[:, 1] * scale, wp[:, 2] * scale
+
+        x0, x1, x2, x3 = X[:, 0].copy(), X[:, 1].copy(), X[:, 2].copy(), X[:, 3].copy()
+        X[:, 0] = x0*qw0 - x1*qw1 - x2*qw2 - x3*qw3
+        X[:, 1] = x0*qw1 + qw0*x1 + x2*qw3 - x3*qw2
+        X[:, 2] = x0*qw2 + qw0*x2 + x3*qw1 - x1*qw3
+        X[:, 3] = x0*qw3 + qw0*x3 + x1*qw2 - x2*qw1
+        X[:, 4:7] = wp
+
+    def state_to_measurement(Y, X):
+        """ Predicts IMU measurements of every sigma point (rows of X) into Y:
+            gravity [0:3] and north [6:9] rotated into the body frame, and the
+            angular velocity [3:6]
+        """
+        x0, x1, x2, x3 = X[:, 0], X[:, 1], X[:, 2], X[:, 3]
+        # Third column of the rotation matrix, i.e. RT @ [0, 0, 1]
+        Y[:, 0] = 2.0*(x1*x3 + x2*x0)
+        Y[:, 1] = 2.0*(x2*x3 - x1*x0)
+        Y[:, 2] = 1.0 - 2.0*(x1*x1 + x2*x2)
+        Y[:, 3:6] = X[:, 4:7]
+        # First column of the rotation matrix, i.e. RT @ [1, 0, 0]
+        Y[:, 6] = 1.0 - 2.0*(x2*x2 + x3*x3)
+        Y[:, 7] = 2.0*(x1*x2 + x3*x0)
+        Y[:, 8] = 2.0*(x1*x3 - x2*x0)
 
     def solve_kalman_gain(S, M):
         """ Solves for K using Cholesky decomposition """
-        L_upper = cholesky(S)
+        L_upper = cholesky(S, check_finite=False)
         L_lower = L_upper.T
-        Y = solve_triangular(L_lower, M.T, lower=True)
-        K = solve_triangular(L_upper, Y, lower=False)
+        Y = solve_triangular(L_lower, M.T, lower=True, check_finite=False)
+        K = solve_triangular(L_upper, Y, lower=False, check_finite=False)
         return K.T
\ No newline at end of file
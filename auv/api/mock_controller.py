@@ -5,14 +5,15 @@ except:
     sys.path.append("..")
     from abstract import AbstractController
 from models.data_types import State, InitialState, SerialState, MotorSpeeds
+from models.clock import Clock, REAL_CLOCK
 
-from time import time
 from threading import Lock
+from math import sin, cos, asin, atan2, radians, degrees, sqrt
 import numpy as np
 from numpy import ndarray as arr
 from numpy import float64 as f64
-from scipy.spatial.transform import Rotation as R
-from scipy.integrate import solve_ivp
+
+STATE_SIZE = 13 # position [:3], velocity [3:6], attitude [6:10], omega [10:13]
 
 def quaternion_multiply(q1, q2):
     """
@@ -48,6 +49,40 @@ def quaternion_derivative(q, omega):
     q_dot = 0.5 * quaternion_multiply(omega_q, q)
     return q_dot
 
+def euler_to_quaternion(euler: arr, out: arr) -> arr:
+    """ Intrinsic XYZ Euler angles in degrees to a quaternion (x, y, z, w),
+        written into `out`. Same convention as scipy's
+        Rotation.from_euler('XYZ', euler, degrees=True).
+    """
+    a, b, c = radians(euler[0]) * 0.5, radians(euler[1]) * 0.5, radians(euler[2]) * 0.5
+    sa, ca = sin(a), cos(a)
+    sb, cb = sin(b), cos(b)
+    sc, cc = sin(c), cos(c)
+    # q = qx(a) * qy(b) * qz(c)
+    x, y, z, w = sa * cb, ca * sb, sa * sb, ca * cb
+    out[0] = x * cc + y * sc
+    out[1] = y * cc - x * sc
+    out[2] = w * sc + z * cc
+    out[3] = w * cc - z * sc
+    return out
+
+def quaternion_to_euler(q: arr, out: arr) -> arr:
+    """ Quaternion (x, y, z, w), not necessarily normalized, to intrinsic XYZ
+        Euler angles in degrees, written into `out`. Inverse of
+        euler_to_quaternion().
+    """
+    x, y, z, w = q[0], q[1], q[2], q[3]
+    s = 2.0 / (x*x + y*y + z*z + w*w)
+    r00 = 1.0 - s * (y*y + z*z)
+    r01 = s * (x*y - z*w)
+    r02 = s * (x*z + y*w)
+    r12 = s * (y*z - x*w)
+    r22 = 1.0 - s * (x*x + y*y)
+    out[0] = degrees(atan2(-r12, r22))
+    out[1] = degrees(asin(max(-1.0, min(1.0, r02))))
+    out[2] = degrees(atan2(-r01, r00))
+    return out
+
 def pack(unpacked: list[arr]) -> arr:
     """ Inverse of unpack(). Takes an unpacked list of state arrays and flattens
         the state arrays into a single state array of 13 indices.
@@ -66,33 +101,69 @@ def unpack(packed: arr) -> list[arr]:
     """
     return np.split(packed, [3, 6, 10])
 
-def motion_model(_time_delta:float, y:arr, mass: float, rotational_inertia:arr, thrust_force:arr, local_torque:arr):
+def motion_model(y, a_local, alpha_local) -> tuple:
     """ Return derivative of attitude -> angular velocity
         Return derivative of angular velocity -> angular acceleration
         Return derivative of position -> velocity
         Return derivative of velocity -> acceleration
         This must be a pure function, not part of a class & no references to self.state
+
+        `y` is the 13 element state as plain floats, and `a_local` and
+        `alpha_local` the body frame linear and angular accelerations from the
+        thrusters. All of the quaternion math is written out by hand since at
+        this size calling into numpy costs more than the math itself.
     """
-    _position, velocity, theta, omega = unpack(y)
-    rotation_to_global = R.from_quat(theta)
+    _px, _py, _pz, vx, vy, vz, qx, qy, qz, qw, wx, wy, wz = y
+    ax, ay, az = a_local
 
-    alpha_local = np.linalg.solve(rotational_inertia, local_torque)
+    # Rotate the local acceleration to global by the (normalized) attitude
+    s = 2.0 / (qx*qx + qy*qy + qz*qz + qw*qw)
+    gx = (1.0 - s*(qy*qy + qz*qz)) * ax + s*(qx*qy - qz*qw) * ay + s*(qx*qz + qy*qw) * az
+    gy = s*(qx*qy + qz*qw) * ax + (1.0 - s*(qx*qx + qz*qz)) * ay + s*(qy*qz - qx*qw) * az
+    gz = s*(qx*qz - qy*qw) * ax + s*(qy*qz + qx*qw) * ay + (1.0 - s*(qx*qx + qy*qy)) * az
 
-    a_local = thrust_force / mass
-    accel = rotation_to_global.apply(a_local)
+    # 0.5 * [omega, 0] * q
+    dqx = 0.5 * ( wx*qw + wy*qz - wz*qy)
+    dqy = 0.5 * (-wx*qz + wy*qw + wz*qx)
+    dqz = 0.5 * ( wx*qy - wy*qx + wz*qw)
+    dqw = 0.5 * (-wx*qx - wy*qy - wz*qz)
 
-    d_position_dt = velocity
-    d_velocity_dt = accel - velocity
-    d_theta_dt = quaternion_derivative(theta, omega)
-    d_omega_dt = alpha_local - omega
+    return (
+        vx, vy, vz,
+        gx - vx, gy - vy, gz - vz,
+        dqx, dqy, dqz, dqw,
+        alpha_local[0] - wx, alpha_local[1] - wy, alpha_local[2] - wz,
+    )
 
-    return pack([d_position_dt, d_velocity_dt, d_theta_dt, d_omega_dt])
+def rk4_step(y, h: float, a_local, alpha_local) -> list:
+    """ One classic 4th order Runge-Kutta step of motion_model() of size `h`,
+        with the attitude quaternion renormalized afterwards.
+    """
+    k1 = motion_model(y, a_local, alpha_local)
+    half = 0.5 * h
+    k2 = motion_model([a + half * b for a, b in zip(y, k1)], a_local, alpha_local)
+    k3 = motion_model([a + half * b for a, b in zip(y, k2)], a_local, alpha_local)
+    k4 = motion_model([a + h * b for a, b in zip(y, k3)], a_local, alpha_local)
+    sixth = h / 6.0
+    y = [a + sixth * (b1 + 2.0 * (b2 + b3) + b4) for a, b1, b2, b3, b4 in zip(y, k1, k2, k3, k4)]
+    norm = 1.0 / sqrt(y[6]*y[6] + y[7]*y[7] + y[8]*y[8] + y[9]*y[9])
+    y[6] *= norm
+    y[7] *= norm
+    y[8] *= norm
+    y[9] *= norm
+    return y
 
 class MockController(AbstractController):
     """ Mock motor controller that has same input API but which
         integrates to generate fake state based on the input
+
+        The motion model is integrated with fixed RK4 steps of `step` seconds,
+        so the result only depends on the inputs and the elapsed time and not
+        on how often get_state() is called. Time left over that is shorter
+        than a step is carried over to the next call. Elapsed time is read from
+        `clock`, which can be a VirtualClock to simulate faster than real time.
     """
-    def __init__(self, log):
+    def __init__(self, log, step: float = 0.001, clock: Clock = REAL_CLOCK):
         log("Mock Controller: __init__()")
         self.getter_lock = Lock()
         self.setter_lock = Lock()
@@ -106,7 +177,17 @@ class MockController(AbstractController):
             mass = 1.0,
             inertia = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]),
         )
-        self.last_time = time()
+        # Integrated state, with the attitude as a quaternion so it never has
+        # to round trip through Euler angles between steps
+        self.step = step
+        self.y = np.zeros(STATE_SIZE, dtype=f64)
+        self.y[0:3] = self.state.position
+        self.y[3:6] = self.state.velocity
+        euler_to_quaternion(self.state.attitude, self.y[6:10])
+        self.y[10:13] = self.state.angular_velocity
+        self.pending_time = 0.0 # Elapsed time not yet integrated, < step
+        self.clock = clock
+        self.last_time = clock.now()
         self.motor_speeds = MotorSpeeds(
             forward = 0,
             turn = 0,
@@ -119,6 +200,7 @@ class MockController(AbstractController):
         """ Replicates API of real motor controller, setting motor speeds to manipulate 
             state of system. Also records initial time to integrate against
         """
+        self.record_speeds(input)
         with self.setter_lock:
             if verbose:
                 self.log("Mock Controller: set_speeds()")
@@ -132,8 +214,7 @@ class MockController(AbstractController):
             
             self.state.local_force[0] = input.forward 
             self.state.local_torque[2] = input.turn
-            self.state.local_force[2] = input.front * 0.5
-            self.state.local_force[2] = input.back * 0.5
+            self.state.local_force[2] = (input.front + input.back) * 0.5
 
             self.state.local_torque[1] = 0
             self.state.local_torque[1] += input.front * 0.5
@@ -145,6 +226,7 @@ class MockController(AbstractController):
     def set_zeros(self):
         """ Sets all fake motor values to zero.
         """
+        self.record_speeds(MotorSpeeds(forward=0, turn=0, front=0, back=0))
         with self.setter_lock:
             self.log("Mock Controller: set_zeros()")
             self.get_state()
@@ -164,7 +246,7 @@ class MockController(AbstractController):
         """ Call this when the state is changed by an input (changing a motor
             speed) to create a new initial time to integrate against.
         """
-        self.last_time = time()
+        self.last_time = self.clock.now()
 
     def get_state(self) -> State:
         """ Returns the simulated state using the last known position, velocity,
@@ -172,37 +254,33 @@ class MockController(AbstractController):
         """
         with self.getter_lock:
             #log("Motor Controller: get_state()")
-            time_delta = time() - self.last_time
-            self.last_time = time()
-
-            packed = pack([
-                self.state.position,
-                self.state.velocity,
-                R.from_euler('XYZ', self.state.attitude, True).as_quat(True),
-                self.state.angular_velocity
-            ]);
-
-            solution = solve_ivp(
-                fun=motion_model,
-                t_span=(0,time_delta),
-                y0=packed,
-                args=(
-                    self.state.mass,
-                    self.state.inertia,
-                    self.state.local_force,
-                    self.state.local_torque
-                )
-            );
-
-            self.state.position, \
-            self.state.velocity, \
-            quat_attitude, \
-            self.state.angular_velocity = unpack(solution.y[:,-1]);
-            
-            self.state.attitude = R.from_quat(quat_attitude).as_euler('XYZ', True)
-
+            now = self.clock.now()
+            self.pending_time += now - self.last_time
+            self.last_time = now
+            steps = int(self.pending_time // self.step)
+            if steps > 0:
+                self.pending_time -= steps * self.step
+                self.integrate(steps)
             return self.state
 
+    def integrate(self, steps: int):
+        """ Advances the simulation by `steps` fixed steps under the current
+            motor inputs and updates self.state.
+        """
+        state = self.state
+        a_local = (state.local_force / state.mass).tolist()
+        alpha_local = np.linalg.solve(state.inertia, state.local_torque).tolist()
+        h = self.step
+        y = self.y.tolist()
+        for _ in range(steps):
+            y = rk4_step(y, h, a_local, alpha_local)
+        packed = self.y
+        packed[:] = y
+        state.position[:] = packed[0:3]
+        state.velocity[:] = packed[3:6]
+        quaternion_to_euler(packed[6:10], state.attitude)
+        state.angular_velocity[:] = packed[10:13]
+
 if __name__ == "__main__":
     mock = MockController(print)
     try:
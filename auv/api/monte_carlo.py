@@ -0,0 +1,317 @@
+""" Batched Monte-Carlo version of the mock motion model, for tuning Control.
+
+    BatchSimulator steps N perturbed vehicles at once as an (N, 13) state
+    array, with the same motion model as MockController and the same PID law
+    and thruster allocation as Control applied to all of them in batch.
+    run_monte_carlo() shards rollouts across a process pool and aggregates
+    settling time, overshoot, and energy over all of them.
+"""
+
+try:
+    from .mock_controller import STATE_SIZE
+except:
+    from mock_controller import STATE_SIZE
+
+from typing import List, Optional, Dict, Any
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+from msgspec import Struct, field
+import numpy as np
+from numpy import ndarray as arr
+from numpy import float64 as f64
+
+from models.pid import VectorPID
+
+AXES = ["surge", "sway", "heave", "roll", "pitch", "yaw"]
+
+class RolloutSpec(Struct):
+    """ Everything that defines a batch of rollouts. The defaults match the
+        setpoint, gains, and rates that Control and MockController use.
+    """
+    duration: float = 30.0
+    step: float = 0.001 # Integration step, as in MockController
+    control_rate: float = 200.0 # Control.rate_hz
+    setpoint: List[float] = field(default_factory=lambda: [10.0, 0.0, 10.0, 0.0, 0.0, 50.0])
+    Kp: List[float] = field(default_factory=lambda: [0.5, 0.5, 0.5, 0., 0., 0.5])
+    Ki: List[float] = field(default_factory=lambda: [0.05, 0.05, 0.05, 0., 0., 0.0])
+    Kd: List[float] = field(default_factory=lambda: [0., 0., 0., 0., 0., 0.1])
+    # Thruster allocation, rows are AXES and columns are the motors (forward,
+    # turn, front, back). Control uses its pseudo-inverse
+    allocation: List[List[float]] = field(default_factory=lambda: [
+        [ 1, 0, 0, 0],
+        [ 0, 0, 0, 0],
+        [ 0, 0, 0.5, 0.5],
+        [ 0, 0, 0, 0],
+        [ 0, 0, -1, 1],
+        [ 0, 1, 0, 0],
+    ])
+    mass: float = 1.0
+    inertia: List[float] = field(default_factory=lambda: [1.0, 1.0, 1.0]) # Diagonal
+    # Perturbations, all drawn once per rollout
+    mass_sigma: float = 0.1 # Relative
+    inertia_sigma: float = 0.1 # Relative, per axis
+    disturbance_sigma: float = 0.02 # Constant global acceleration (current), m/s^2
+    position_noise: float = 0.05 # Measurement noise, m
+    attitude_noise: float = 0.5 # Measurement noise, degrees
+    # An axis has settled once its error stays within these
+    position_tolerance: float = 0.25
+    attitude_tolerance: float = 2.0
+
+def quaternion_to_euler_batch(q: arr, out: arr) -> arr:
+    """ (N, 4) quaternions (x, y, z, w) to (N, 3) intrinsic XYZ Euler angles in
+        degrees. Batched quaternion_to_euler() from mock_controller.
+    """
+    x, y, z, w = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    s = 2.0 / (x*x + y*y + z*z + w*w)
+    np.degrees(np.arctan2(-s * (y*z - x*w), 1.0 - s * (x*x + y*y)), out=out[:, 0])
+    np.degrees(np.arcsin(np.clip(s * (x*z + y*w), -1.0, 1.0)), out=out[:, 1])
+    np.degrees(np.arctan2(-s * (x*y - z*w), 1.0 - s * (y*y + z*z)), out=out[:, 2])
+    return out
+
+def motion_model_batch(Y: arr, a_local: arr, alpha_local: arr, a_global: arr, out: arr) -> arr:
+    """ motion_model() from mock_controller for (N, 13) states at once, with a
+        global frame acceleration `a_global` (disturbance) added. Writes the
+        derivative into `out`.
+    """
+    qx, qy, qz, qw = Y[:, 6], Y[:, 7], Y[:, 8], Y[:, 9]
+    wx, wy, wz = Y[:, 10], Y[:, 11], Y[:, 12]
+    ax, ay, az = a_local[:, 0], a_local[:, 1], a_local[:, 2]
+    s = 2.0 / (qx*qx + qy*qy + qz*qz + qw*qw)
+
+    out[:, 0:3] = Y[:, 3:6]
+    out[:, 3] = (1.0 - s*(qy*qy + qz*qz)) * ax + s*(qx*qy - qz*qw) * ay + s*(qx*qz + qy*qw) * az
+    out[:, 4] = s*(qx*qy + qz*qw) * ax + (1.0 - s*(qx*qx + qz*qz)) * ay + s*(qy*qz - qx*qw) * az
+    out[:, 5] = s*(qx*qz - qy*qw) * ax + s*(qy*qz + qx*qw) * ay + (1.0 - s*(qx*qx + qy*qy)) * az
+    out[:, 3:6] += a_global
+    out[:, 3:6] -= Y[:, 3:6]
+    out[:, 6] = 0.5 * ( wx*qw + wy*qz - wz*qy)
+    out[:, 7] = 0.5 * (-wx*qz + wy*qw + wz*qx)
+    out[:, 8] = 0.5 * ( wx*qy - wy*qx + wz*qw)
+    out[:, 9] = 0.5 * (-wx*qx - wy*qy - wz*qz)
+    np.subtract(alpha_local, Y[:, 10:13], out=out[:, 10:13])
+    return out
+
+class BatchSimulator:
+    """ N independent vehicles, each with its own mass, inertia, and constant
+        disturbance drawn from `spec`, driven by Control's PID law in batch.
+
+        The controller runs at `spec.control_rate` on noisy measurements of
+        position and Euler attitude and holds its motor speeds for the
+        integration steps in between, like Control writing to MockController.
+        The derivative term is on the measurement, as Control does with the
+        state history.
+    """
+    def __init__(self, spec: RolloutSpec, n: int, rng: Optional[np.random.Generator] = None):
+        self.spec = spec
+        self.n = n
+        self.rng = rng if rng is not None else np.random.default_rng()
+        rng = self.rng
+
+        self.Y = np.zeros((n, STATE_SIZE), dtype=f64)
+        self.Y[:, 9] = 1.0 # Identity attitude
+        self.mass = spec.mass * (1.0 + spec.mass_sigma * rng.standard_normal(n))
+        self.inertia = np.asarray(spec.inertia, dtype=f64) \
+            * (1.0 + spec.inertia_sigma * rng.standard_normal((n, 3)))
+        self.disturbance = spec.disturbance_sigma * rng.standard_normal((n, 3))
+
+        self.setpoint = np.asarray(spec.setpoint, dtype=f64)
+        self.pid = VectorPID(
+            Kp=spec.Kp,
+            Ki=spec.Ki,
+            Kd=spec.Kd,
+            wrap=[False, False, False, True, True, True],
+            windup=1.,
+            batch=(n,),
+        )
+        self.thrust_allocation = np.linalg.pinv(np.asarray(spec.allocation, dtype=f64))
+
+        # Controller state
+        self.measured = np.zeros((n, 6), dtype=f64)
+        self.speeds = np.zeros((n, 4), dtype=f64)
+        self.a_local = np.zeros((n, 3), dtype=f64)
+        self.alpha_local = np.zeros((n, 3), dtype=f64)
+
+        # RK4 workspace
+        self._k = np.zeros((4, n, STATE_SIZE), dtype=f64)
+        self._tmp = np.zeros((n, STATE_SIZE), dtype=f64)
+
+    def measure(self) -> arr:
+        """ Noisy position and Euler attitude (degrees) of every vehicle """
+        spec = self.spec
+        measured = self.measured
+        measured[:, 0:3] = self.Y[:, 0:3]
+        quaternion_to_euler_batch(self.Y[:, 6:10], measured[:, 3:6])
+        if spec.position_noise:
+            measured[:, 0:3] += spec.position_noise * self.rng.standard_normal((self.n, 3))
+        if spec.attitude_noise:
+            measured[:, 3:6] += spec.attitude_noise * self.rng.standard_normal((self.n, 3))
+        return measured
+
+    def error(self, measured: arr) -> arr:
+        """ Setpoint minus measurement, with angles wrapped to [-180, 180) """
+        err = self.setpoint - measured
+        err[:, 3:6] = (err[:, 3:6] + 540) % 360 - 180
+        return err
+
+    def control(self, dt: float) -> arr:
+        """ One tick of Control's PID law for all vehicles. Sets and returns
+            the (N, 4) motor speeds.
+        """
+        signal = self.pid.update(self.setpoint, self.measure(), dt)
+        np.clip(signal @ self.thrust_allocation.T, -1, 1, out=self.speeds)
+        self.set_speeds(self.speeds)
+        return self.speeds
+
+    def set_speeds(self, speeds: arr):
+        """ Batched MockController.set_speeds(), motor speeds to the body
+            frame accelerations
+        """
+        forward, turn, front, back = speeds[:, 0], speeds[:, 1], speeds[:, 2], speeds[:, 3]
+        self.a_local[:, 0] = forward / self.mass
+        self.a_local[:, 2] = (front + back) * 0.5 / self.mass
+        self.alpha_local[:, 1] = (front - back) * 0.5 / self.inertia[:, 1]
+        self.alpha_local[:, 2] = turn / self.inertia[:, 2]
+
+    def integrate(self, h: float):
+        """ One RK4 step of every vehicle, with renormalized quaternions """
+        Y, tmp = self.Y, self._tmp
+        k1, k2, k3, k4 = self._k
+        args = (self.a_local, self.alpha_local, self.disturbance)
+        motion_model_batch(Y, *args, out=k1)
+        np.multiply(k1, 0.5 * h, out=tmp)
+        tmp += Y
+        motion_model_batch(tmp, *args, out=k2)
+        np.multiply(k2, 0.5 * h, out=tmp)
+        tmp += Y
+        motion_model_batch(tmp, *args, out=k3)
+        np.multiply(k3, h, out=tmp)
+        tmp += Y
+        motion_model_batch(tmp, *args, out=k4)
+        k2 += k3
+        k2 *= 2.0
+        k1 += k2
+        k1 += k4
+        k1 *= h / 6.0
+        Y += k1
+        q = Y[:, 6:10]
+        q /= np.sqrt(np.einsum("ij,ij->i", q, q))[:, None]
+
+    def rollout(self) -> Dict[str, arr]:
+        """ Runs every vehicle for `spec.duration` and returns per-vehicle
+            metrics, each an (N, 6) array over AXES except energy (N,):
+            * settling_time - when the error last left the tolerance band
+              (inf if it never settled by the end)
+            * overshoot - furthest the true state went past the setpoint, as
+              a fraction of the initial error (0 for axes with no initial error)
+            * energy - integral of the sum of squared motor speeds over time
+        """
+        spec = self.spec
+        h = spec.step
+        substeps = max(int(round(1.0 / (spec.control_rate * h))), 1)
+        dt = substeps * h
+        ticks = int(round(spec.duration / dt))
+        tolerance = np.array([spec.position_tolerance] * 3 + [spec.attitude_tolerance] * 3)
+
+        truth = np.zeros((self.n, 6), dtype=f64)
+        def true_error() -> arr:
+            truth[:, 0:3] = self.Y[:, 0:3]
+            quaternion_to_euler_batch(self.Y[:, 6:10], truth[:, 3:6])
+            return self.error(truth)
+
+        initial = true_error()
+        direction = np.sign(initial)
+        scale = np.abs(initial)
+        overshoot = np.zeros((self.n, 6), dtype=f64)
+        last_outside = np.zeros((self.n, 6), dtype=f64)
+        energy = np.zeros(self.n, dtype=f64)
+        for tick in range(ticks):
+            speeds = self.control(dt)
+            energy += np.einsum("ij,ij->i", speeds, speeds) * dt
+            for _ in range(substeps):
+                self.integrate(h)
+            err = true_error()
+            # Past the setpoint means the error changed sign from the start
+            np.maximum(overshoot, -direction * err, out=overshoot)
+            outside = np.abs(err) > tolerance
+            last_outside[outside] = (tick + 1) * dt
+
+        final_outside = np.abs(true_error()) > tolerance
+        settling_time = np.where(final_outside, np.inf, last_outside)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            overshoot = np.where(scale > 0, overshoot / scale, 0.)
+        return {
+            "settling_time": settling_time,
+            "overshoot": overshoot,
+            "energy": energy,
+        }
+
+def simulate_batch(spec: RolloutSpec, n: int, seed: np.random.SeedSequence) -> Dict[str, arr]:
+    """ One shard of run_monte_carlo(), run in a worker process """
+    simulator = BatchSimulator(spec, n, np.random.default_rng(seed))
+    return simulator.rollout()
+
+def settling_percentile(settling_time: arr, p: float) -> Optional[float]:
+    """ `p`th percentile of settling times, None if it falls on rollouts that
+        never settled
+    """
+    value = float(np.percentile(settling_time, p, method="inverted_cdf"))
+    return value if np.isfinite(value) else None
+
+def summarize(metrics: Dict[str, arr]) -> Dict[str, Any]:
+    """ Aggregate statistics over all rollouts, JSON-friendly """
+    settling = metrics["settling_time"]
+    overshoot = metrics["overshoot"]
+    energy = metrics["energy"]
+    summary: Dict[str, Any] = {"runs": int(energy.shape[0])}
+    for i, axis in enumerate(AXES):
+        settled = np.isfinite(settling[:, i])
+        summary[axis] = {
+            "settled_fraction": float(settled.mean()),
+            "settling_time_p50": settling_percentile(settling[:, i], 50),
+            "settling_time_p95": settling_percentile(settling[:, i], 95),
+            "overshoot_mean": float(overshoot[:, i].mean()),
+            "overshoot_max": float(overshoot[:, i].max()),
+        }
+    summary["energy"] = {
+        "mean": float(energy.mean()),
+        "p95": float(np.percentile(energy, 95)),
+        "max": float(energy.max()),
+    }
+    return summary
+
+def run_monte_carlo(
+    spec: RolloutSpec,
+    runs: int,
+    workers: Optional[int] = None,
+    batch_size: int = 256,
+    seed: int = 0,
+) -> Dict[str, Any]:
+    """ Runs `runs` perturbed rollouts of `spec` in batches of `batch_size`
+        across `workers` processes (all cores by default) and returns the
+        summarize()d metrics. The same seed gives the same result regardless
+        of the number of workers.
+    """
+    sizes = [batch_size] * (runs // batch_size)
+    if runs % batch_size:
+        sizes.append(runs % batch_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(sizes) == 1:
+        results = [simulate_batch(spec, n, s) for n, s in zip(sizes, seeds)]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(sizes))) as pool:
+            results = list(pool.map(simulate_batch, [spec] * len(sizes), sizes, seeds))
+    metrics = {
+        key: np.concatenate([result[key] for result in results])
+        for key in results[0]
+    }
+    return summarize(metrics)
+
+if __name__ == "__main__":
+    import json
+    import time
+    start = time.perf_counter()
+    summary = run_monte_carlo(RolloutSpec(), runs=1024)
+    print(json.dumps(summary, indent=2))
+    print(f"{summary['runs']} rollouts in {time.perf_counter() - start:.1f} s")
@@ -71,6 +71,7 @@ class MotorController(AbstractController):
 
         data: String read from the serial connection containing motor speed values.
         """
+        self.record_speeds(input)
         # Parse motor speed from data object.
         self.forward_speed = input.forward * 255
         self.turn_speed = input.turn * 255
@@ -149,6 +150,7 @@ class MotorController(AbstractController):
         """
         Sets motor speeds of each individual motor to 0.
         """
+        self.record_speeds(MotorSpeeds(forward=0, turn=0, front=0, back=0))
         for motor in self.motors:
             motor.set_speed(0)
 
@@ -1,4 +1,5 @@
 from api import MotorController
+from models.pid import VectorPID
 import time
 
 PITCH_CONTROL_TOLERANCE = 4.0
@@ -6,7 +7,7 @@ PITCH_TARGET_TOLERANCE = 2.0
 
 
 class PID:
-    """PID Controller"""
+    """PID Controller for a single axis, on top of VectorPID"""
 
     def __init__(
         self,
@@ -27,41 +28,44 @@ class PID:
         self.set_point = target
         self.control_tolerance = control_tolerance
         self.target_tolerance = target_tolerance
-        self.p = p
-        self.i = i
-        self.d = d
-        self.windup = i_windup
+        self.engine = VectorPID(Kp=p, Ki=i, Kd=d, windup=i_windup)
         self.is_debug = debug
-        self.last_error = 0.0
-        self.sum_error = 0.0
         self.last_time = time.time()
         self.within_tolerance = False
 
+    @property
+    def p(self):
+        return float(self.engine.Kp[0])
+
+    @property
+    def i(self):
+        return float(self.engine.Ki[0])
+
+    @property
+    def d(self):
+        return float(self.engine.Kd[0])
+
+    @property
+    def windup(self):
+        return float(self.engine.windup[0])
+
     def pid(self, current_value, heading=False):
         """ PID Calculation """
-        # Calculate error
+        engine = self.engine
+        # Headings are wrapped so the error is always the shorter way around
+        engine.wrap[0] = heading
+        error = self.set_point - current_value
         if heading:
-            if current_value > 180: 
-                current_value = (current_value - 360)
-            
-            error = self.set_point - current_value
-            
-            # if current_value < 0 or current_value >= 360:
-            #     current_value %= 360
-            # error = self.set_point - current_value
-            # if error > 180:
-            #     error -= 360
-            # elif error < -180:
-            #     error += 360
-        else:
-            error = self.set_point - current_value
-        
+            error = (error + 540) % 360 - 180
+
         # Figure out state
         if self.within_tolerance and abs(error) > self.control_tolerance:
-            print("Not within tolerance")
+            if self.is_debug:
+                print("Not within tolerance")
             self.within_tolerance = False
         elif not self.within_tolerance and abs(error) < self.target_tolerance:
-            print("Within tolerance")
+            if self.is_debug:
+                print("Within tolerance")
             self.within_tolerance = True
 
         current_time = time.time()
@@ -79,26 +83,12 @@ class PID:
             return 0
 
         dt = current_time - self.last_time
-
-        # Calculate P term
-        p_term = self.p * error
-        # Calculate I term
-        self.sum_error += error * dt
-        i_change = (
-            self.sum_error
-            if abs(self.sum_error) < self.windup
-            else (self.windup if self.sum_error >= 0 else -self.windup)
-        )
-
-        i_term = self.i * i_change
-        # Calculate D term
-        d_term = self.d * (error - self.last_error)
-        d_term /= dt
-
-        # Update values for next iteration
         self.last_time = current_time
-        self.last_error = error
+        output = float(engine.update(self.set_point, current_value, dt)[0])
         if self.is_debug:
+            p_term = self.p * error
+            i_term = self.i * float(engine.integral[0])
+            d_term = self.d * float(engine.derivative[0])
             print(
                 "[PID %s] SetPoint %7.2f Current %7.2f Error %7.2f P %7.2f I %7.2f D %7.2f Feedback %7.2f"
                 % (
@@ -109,20 +99,20 @@ class PID:
                     p_term,
                     i_term,
                     d_term,
-                    p_term + i_term + d_term,
+                    output,
                 ),
                 end="\n",
             )
-        return p_term + i_term + d_term
+        return output
 
     def set_p(self, p):
-        self.p = p
+        self.engine.set_gains(0, p=p)
 
     def set_i(self, i):
-        self.i = i
+        self.engine.set_gains(0, i=i)
 
     def set_d(self, d):
-        self.d = d
+        self.engine.set_gains(0, d=d)
 
     def set_windup(self, windup):
         """Integral windup, also known as integrator windup or reset windup,
@@ -134,7 +124,7 @@ class PID:
         (offset by errors in the other direction).
         The specific problem is the excess overshooting.
         """
-        self.windup = windup
+        self.engine.windup[0] = windup
 
     def update_target(self, target):
         self.set_point = target
@@ -0,0 +1,358 @@
+""" Deterministic offline replay of a recorded run, for regression testing and
+    profiling localization and control changes on real data.
+
+    A real run with a recorder_path leaves two recordings (models/recorder.py):
+    "sensors", every raw sample localization read, and "flight", the states,
+    motor outputs, commands, and task events. replay() feeds the sensor
+    samples through localize() tick by tick, writes each State to shared
+    memory like Localization does, and runs the real Control on it with a
+    ReplayController in place of the motors. Everything runs on a
+    VirtualClock set to the recorded timestamps, so the result doesn't depend
+    on how fast the machine is, and the replayed states and motor outputs are
+    then compared with the recorded ones.
+"""
+
+try:
+    from .abstract import AbstractController
+except:
+    from abstract import AbstractController
+
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+from collections import Counter
+from pathlib import Path
+from time import perf_counter, sleep
+import json
+import os
+
+import numpy as np
+from numpy import float64 as f64
+
+from core.control import Control
+from models.clock import VirtualClock
+from models.data_types import State, MotorSpeeds
+from models.shared_memory import (
+    create_shared_state, create_state_history, SharedStateHandle, StateHistoryHandle,
+)
+from models.recorder import (
+    chunk_paths, load, texts,
+    KIND_STATE, KIND_MOTORS, KIND_COMMAND, KIND_TASK,
+    KIND_TICK, KIND_ACCEL, KIND_GYRO, KIND_MAG, KIND_DEPTH, KIND_NMEA,
+)
+
+STATE_FIELDS = [
+    name + "_" + axis
+    for name in ("position", "velocity", "attitude", "angular_velocity")
+    for axis in "xyz"
+]
+MOTOR_FIELDS = ["forward", "turn", "front", "back"]
+
+class SampleStream:
+    """ The recorded samples of one sensor, handed out in order, but only
+        those recorded during the current tick (see ReplaySensors.begin()).
+        A filter that reads fewer samples than were recorded skips the rest
+        (counted in `unread`), one that reads more gets the last one again
+        (counted in `extra`), so a changed filter still lines up with time.
+    """
+    def __init__(self, times: np.ndarray, values: Sequence[Any], empty: Any):
+        self.times = times
+        self.values = values
+        self.empty = empty
+        self.cursor = 0
+        self.end = 0
+        self.unread = 0
+        self.extra = 0
+
+    def begin(self, after: float, until: float):
+        start = int(np.searchsorted(self.times, after, side="right"))
+        if start > self.cursor:
+            self.unread += start - self.cursor
+        self.cursor = max(self.cursor, start)
+        self.end = int(np.searchsorted(self.times, until, side="right"))
+
+    def next(self) -> Any:
+        if self.cursor < self.end:
+            self.cursor += 1
+            return self.values[self.cursor - 1]
+        self.extra += 1
+        return self.values[self.cursor - 1] if self.cursor > 0 else self.empty
+
+class ReplaySensors:
+    """ Stands in for the accelerometer/gyroscope, magnetometer, GPS serial
+        port, and depth function that localize_setup() returns, duck typed
+        like RecordingAccelGyro and friends in models/recorder.py.
+    """
+    def __init__(self, records: np.ndarray):
+        def numeric(kind: int, width: int) -> SampleStream:
+            selected = records[records["kind"] == kind]
+            values = [tuple(row) for row in selected["data"][:, :width].tolist()]
+            return SampleStream(selected["timestamp"], values, (0.,) * width)
+        self.accel = numeric(KIND_ACCEL, 3)
+        self.gyro_stream = numeric(KIND_GYRO, 3)
+        self.mag = numeric(KIND_MAG, 3)
+        self.depth_stream = numeric(KIND_DEPTH, 1)
+        lines = list(texts(records, KIND_NMEA))
+        self.nmea = SampleStream(
+            np.array([timestamp for timestamp, _ in lines], dtype=f64),
+            [line.encode("latin-1") for _, line in lines],
+            b"",
+        )
+        self.streams = {
+            "accel": self.accel,
+            "gyro": self.gyro_stream,
+            "mag": self.mag,
+            "depth": self.depth_stream,
+            "nmea": self.nmea,
+        }
+
+    def begin(self, after: float, until: float):
+        """ Limits every sensor to the samples recorded in (after, until] """
+        for stream in self.streams.values():
+            stream.begin(after, until)
+
+    @property
+    def acceleration(self) -> Tuple[float, float, float]:
+        return self.accel.next()
+
+    @property
+    def gyro(self) -> Tuple[float, float, float]:
+        return self.gyro_stream.next()
+
+    @property
+    def magnetic(self) -> Tuple[float, float, float]:
+        return self.mag.next()
+
+    def readline(self) -> bytes:
+        return self.nmea.next()
+
+    def depth(self) -> float:
+        return self.depth_stream.next()[0]
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        return {
+            name: {"recorded": len(stream.values), "unread": stream.unread, "extra": stream.extra}
+            for name, stream in self.streams.items()
+        }
+
+class ReplayController(AbstractController):
+    """ Motor controller that only keeps what it was told, with the time """
+    def __init__(self, clock: Callable[[], float]):
+        self.clock = clock
+        self.times: List[float] = []
+        self.outputs: List[Tuple[float, float, float, float]] = []
+        self.speeds = MotorSpeeds(forward=0., turn=0., front=0., back=0.)
+
+    def set_speeds(self, input: MotorSpeeds, verbose=True):
+        self.record_speeds(input)
+        self.speeds = input
+        self.times.append(self.clock())
+        self.outputs.append((input.forward, input.turn, input.front, input.back))
+
+    def set_zeros(self):
+        self.set_speeds(MotorSpeeds(forward=0., turn=0., front=0., back=0.))
+
+    def get_speeds(self) -> MotorSpeeds:
+        return self.speeds
+
+    def set_last_time(self):
+        pass
+
+class DiscardQueue:
+    """ Logging queue for Control that drops everything """
+    def put(self, item: Any):
+        pass
+
+def load_recording(
+    directory: Union[str, Path],
+    sensors_prefix: Optional[str] = None,
+    flight_prefix: Optional[str] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """ The sensor and flight records of a run, the newest ones in `directory`
+        unless the prefixes (<name>_<start>) are given
+    """
+    sensors = load(chunk_paths(directory, sensors_prefix, name="sensors"))
+    flight = load(chunk_paths(directory, flight_prefix, name="flight"))
+    if len(sensors) == 0:
+        raise ValueError("No sensor recording in " + str(directory))
+    return sensors, flight
+
+def compare(
+    recorded_times: np.ndarray,
+    recorded: np.ndarray,
+    replayed_times: np.ndarray,
+    replayed: np.ndarray,
+    fields: List[str],
+) -> Dict[str, Any]:
+    """ RMS and max difference per field between each recorded value and the
+        replayed value in effect at its timestamp
+    """
+    comparison: Dict[str, Any] = {"recorded": len(recorded), "replayed": len(replayed)}
+    if len(recorded) == 0 or len(replayed) == 0:
+        comparison["compared"] = 0
+        return comparison
+    index = np.searchsorted(replayed_times, recorded_times, side="right") - 1
+    matched = index >= 0
+    difference = replayed[index[matched]] - recorded[matched]
+    comparison["compared"] = int(matched.sum())
+    if len(difference):
+        comparison["rms"] = dict(zip(fields, np.sqrt(np.mean(difference ** 2, axis=0)).tolist()))
+        comparison["max"] = dict(zip(fields, np.abs(difference).max(axis=0).tolist()))
+    return comparison
+
+def replay(
+    sensors: np.ndarray,
+    flight: np.ndarray,
+    speed: Optional[float] = None,
+    kalman_filter: Optional[Callable] = None,
+    setup_filters: Optional[Callable[[], Tuple[Any, Any]]] = None,
+    tick: float = 1e-6,
+) -> Dict[str, Any]:
+    """ Replays a run (see load_recording()) and returns how the replayed
+        outputs compare to the recorded ones, and how long it all took.
+
+        `speed` scales the recorded time (2 is twice as fast as the run was),
+        by default it runs as fast as possible. `kalman_filter` and
+        `setup_filters` default to localize() and fresh EKF and MUKF filters.
+    """
+    if kalman_filter is None or setup_filters is None:
+        from api.localization import localize, EKF, MUKF
+        kalman_filter = kalman_filter or localize
+        setup_filters = setup_filters or (lambda: (EKF(), MUKF()))
+    ticks = sensors[sensors["kind"] == KIND_TICK]
+    if len(ticks) == 0:
+        raise ValueError("The sensor recording has no ticks")
+    replay_sensors = ReplaySensors(sensors)
+    ekf, mukf = setup_filters()
+    setup_args = (None, replay_sensors, replay_sensors, replay_sensors, ekf, mukf)
+
+    # Timeline of ticks, and of the commands and Control events they meet
+    timeline: List[Tuple[float, int, Any]] = [
+        (float(timestamp), index, None) for index, timestamp in enumerate(ticks["timestamp"])
+    ]
+    skipped: Counter = Counter()
+    applied = 0
+    control_active = False
+    for timestamp, text in texts(flight, KIND_COMMAND):
+        message = json.loads(text)
+        if message.get("command") != "control":
+            # Nothing else reaches Control, see dispatch in __init__.py
+            skipped[message.get("command")] += 1
+        elif timestamp >= timeline[0][0]:
+            timeline.append((timestamp, -1, message))
+        else:
+            skipped["control (before first tick)"] += 1
+    for timestamp, text in texts(flight, KIND_TASK):
+        name, event = text.rsplit(" ", 1)
+        if name != "Control" or event not in ("activate", "deactivate"):
+            continue
+        if timestamp < timeline[0][0]:
+            control_active = event == "activate"
+        else:
+            timeline.append((timestamp, -1, event))
+    timeline.sort(key=lambda entry: entry[0])
+
+    suffix = str(os.getpid())
+    shared_state = create_shared_state(name="replay_state_" + suffix)
+    state_history = create_state_history(name="replay_history_" + suffix)
+    clock = VirtualClock(tick=tick, start=timeline[0][0])
+    # Joined before Control, so a tick due with Control's goes first
+    driver = clock.join("Replay")
+    controller = ReplayController(clock.now)
+    control = Control(
+        shared_state_name=shared_state.name,
+        logging_q=DiscardQueue(), # type: ignore
+        controller=controller,
+        shared_history_name=state_history.name,
+        clock=clock,
+    )
+    output = SharedStateHandle(shared_state.name)
+    history = StateHistoryHandle(state_history.name)
+    output_state = State()
+    state_times = np.zeros(len(ticks), dtype=f64)
+    states = np.zeros((len(ticks), len(STATE_FIELDS)), dtype=f64)
+    filter_time = 0.
+    after = -np.inf
+
+    wall_start = perf_counter()
+    try:
+        if control_active:
+            control.activate()
+        control.startup()
+        for timestamp, index, event in timeline:
+            driver.sleep(timestamp - driver.now())
+            if speed:
+                sleep(max(0., wall_start + (timestamp - timeline[0][0]) / speed - perf_counter()))
+            if index < 0:
+                if event == "activate":
+                    control.activate()
+                elif event == "deactivate":
+                    control.deactivate()
+                else:
+                    control.input(event)
+                    applied += 1
+                continue
+            # One tick of Localization.run() on the samples it read
+            prev_time, cur_time, written = ticks["data"][index, :3]
+            replay_sensors.begin(after, timestamp)
+            after = timestamp
+            begin = perf_counter()
+            kf_output = kalman_filter(prev_time, *setup_args, cur_time=cur_time)
+            filter_time += perf_counter() - begin
+            output_state.position[0] = kf_output.position[0]
+            output_state.position[1] = kf_output.position[1]
+            output_state.position[2] = -replay_sensors.depth()
+            output_state.velocity[:] = kf_output.velocity
+            output_state.attitude[:] = kf_output.attitude
+            output_state.angular_velocity[:] = kf_output.angular_velocity
+            output.write_from(output_state, written)
+            history.append(output_state, written)
+            state_times[index] = written
+            states[index] = np.concatenate((
+                output_state.position, output_state.velocity,
+                output_state.attitude, output_state.angular_velocity,
+            ))
+    finally:
+        started = control.shutdown()
+        driver.leave()
+        if started:
+            control.join()
+        wall_seconds = perf_counter() - wall_start
+        output.close()
+        history.close()
+        for shm in (shared_state, state_history):
+            shm.close()
+            shm.unlink()
+
+    recorded_states = flight[flight["kind"] == KIND_STATE]
+    recorded_motors = flight[flight["kind"] == KIND_MOTORS]
+    recorded_seconds = timeline[-1][0] - timeline[0][0]
+    return {
+        "ticks": len(ticks),
+        "recorded_seconds": recorded_seconds,
+        "wall_seconds": wall_seconds,
+        "speedup": recorded_seconds / wall_seconds if wall_seconds > 0 else None,
+        "filter_us": 1e6 * filter_time / len(ticks),
+        "control": control.stats.summary(),
+        "sensors": replay_sensors.counts(),
+        "commands": {"applied": applied, "skipped": dict(skipped)},
+        "state": compare(
+            recorded_states["timestamp"], recorded_states["data"][:, :len(STATE_FIELDS)],
+            state_times, states, STATE_FIELDS,
+        ),
+        "motors": compare(
+            recorded_motors["timestamp"], recorded_motors["data"][:, :len(MOTOR_FIELDS)],
+            np.array(controller.times, dtype=f64),
+            np.array(controller.outputs, dtype=f64).reshape(-1, len(MOTOR_FIELDS)),
+            MOTOR_FIELDS,
+        ),
+    }
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Replay a recorded run offline")
+    parser.add_argument("directory", nargs="?", default="data/recordings")
+    parser.add_argument("--sensors", help="sensors_<start> prefix, newest by default")
+    parser.add_argument("--flight", help="flight_<start> prefix, newest by default")
+    parser.add_argument("--speed", type=float, help="recorded time scale, as fast as possible by default")
+    args = parser.parse_args()
+    sensors, flight = load_recording(args.directory, args.sensors, args.flight)
+    print(json.dumps(replay(sensors, flight, speed=args.speed), indent=2))
@@ -0,0 +1,400 @@
+""" Emulated IMU, magnetometer, GPS, and MS5837 pressure sensor, generated
+    from the simulated motion, so the real localization path (localize() in
+    the Localization process) can run and be load tested without hardware.
+
+    Frames are the ones MockController simulates in: world x north, y west,
+    z up (so depth is -z, as Localization writes it), and body x forward,
+    y left, z up. So an IMU lying still reads +g on z, like the LSM6DS does.
+
+    Every sensor samples at its own rate. Reading it between samples returns
+    the last sample, like reading a sensor's output registers. Each sample
+    has white noise plus a bias that random walks, see NoiseSpec. With
+    `data_ready` set, reading the acceleration waits for the next IMU sample,
+    like waiting on the data ready pin, so localization runs at the IMU rate.
+
+    The motion comes from a truth source: ControllerTruth reads a
+    MockController in the same process, and SharedTruth reads the state that
+    Mock_Localization writes to shared memory, for the Localization process.
+"""
+
+try:
+    from .abstract import (
+        AbstractAccelGyro, AbstractMagnetometer, AbstractSerial, AbstractPressureSensor,
+    )
+    from .mock_controller import MockController, motion_model, euler_to_quaternion
+except:
+    from abstract import (
+        AbstractAccelGyro, AbstractMagnetometer, AbstractSerial, AbstractPressureSensor,
+    )
+    from mock_controller import MockController, motion_model, euler_to_quaternion
+
+from typing import Callable, List, Optional, Tuple
+from datetime import datetime, timezone
+from math import atan2, cos, degrees, floor, hypot, radians, sqrt
+
+from msgspec import Struct, field
+import numpy as np
+from numpy import ndarray as arr
+from numpy import float64 as f64
+
+from models.clock import Clock, REAL_CLOCK
+from models.data_types import State
+from models.shared_memory import SharedStateHandle, SnapshotTimeout
+
+G = 9.80665
+EARTH_RADIUS = 6378137.0
+SEA_LEVEL_PA = 101300.0 # What MS5837.depth() takes as the surface
+KNOTS = 1.0 / 0.514444 # Per m/s
+
+class NoiseSpec(Struct):
+    noise: float = 0.0 # Standard deviation of each sample
+    bias: List[float] = field(default_factory=lambda: [0.0, 0.0, 0.0]) # Initial
+    bias_walk: float = 0.0 # Bias random walk, per sqrt(second)
+
+class EmulatorSpec(Struct):
+    """ Rates in Hz and noise in the units of each sensor. The defaults are
+        close to the LSM6DSOX, LIS3MDL, a 10 Hz GPS, and the MS5837-30BA.
+    """
+    imu_rate: float = 1660.0
+    mag_rate: float = 155.0
+    gps_rate: float = 10.0
+    pressure_rate: float = 50.0
+    accel: NoiseSpec = field(default_factory=lambda: NoiseSpec(
+        noise=0.02, bias=[0.05, -0.03, 0.02], bias_walk=0.0005))
+    gyro: NoiseSpec = field(default_factory=lambda: NoiseSpec(
+        noise=0.002, bias=[0.001, -0.002, 0.0015], bias_walk=1e-5))
+    mag: NoiseSpec = field(default_factory=lambda: NoiseSpec(noise=0.3))
+    # Earth's field in microtesla, world frame (north, west, up), San Diego
+    magnetic_field: List[float] = field(default_factory=lambda: [22.9, -5.0, -39.8])
+    # Reading = soft_iron @ field + hard_iron, see localize_spec()
+    hard_iron: List[float] = field(default_factory=lambda: [0.0, 0.0, 0.0])
+    soft_iron: List[List[float]] = field(default_factory=lambda: np.eye(3).tolist())
+    gps_position_noise: float = 2.0 # Meters, per axis
+    gps_speed_noise: float = 0.05 # m/s
+    gps_max_depth: float = 0.5 # No fix any deeper than this
+    origin: List[float] = field(default_factory=lambda: [32.7157, -117.1611]) # Lat, lon of x = y = 0
+    pressure_noise: float = 0.2 # mbar
+    fluid_density: float = 1029.0 # kg/m^3
+    water_temperature: float = 15.0 # Degrees C
+    start_time: float = 1.7e9 # Unix time of clock time 0, for the GPS
+    data_ready: bool = True
+    seed: int = 0
+
+def localize_spec(**kwargs) -> EmulatorSpec:
+    """ An EmulatorSpec whose magnetometer has the hard and soft iron
+        distortion that localize() calibrates out, so the field it ends up
+        with is the true one
+    """
+    from api.localization.main import B, Ainv
+    return EmulatorSpec(hard_iron=B.tolist(), soft_iron=np.linalg.inv(Ainv).tolist(), **kwargs)
+
+class Truth(Struct):
+    """ The true motion at `timestamp`, world frame unless noted """
+    timestamp: float
+    position: arr
+    velocity: arr
+    acceleration: arr
+    rotation: arr # Body to world
+    angular_velocity: arr # Body frame, rad/s
+
+def rotation_matrix(q: arr) -> arr:
+    """ Body to world rotation of a unit quaternion (x, y, z, w) """
+    x, y, z, w = q
+    return np.array([
+        [1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w)],
+        [2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w)],
+        [2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)],
+    ])
+
+def truth_from_state(state: State, timestamp: float, acceleration: arr) -> Truth:
+    rotation = rotation_matrix(euler_to_quaternion(state.attitude, np.zeros(4, dtype=f64)))
+    return Truth(
+        timestamp=timestamp,
+        position=np.array(state.position, dtype=f64),
+        velocity=np.array(state.velocity, dtype=f64),
+        acceleration=acceleration,
+        rotation=rotation,
+        # The simulated angular velocity is in the world frame, in rad/s
+        angular_velocity=rotation.T @ state.angular_velocity,
+    )
+
+class ControllerTruth:
+    """ Truth from a MockController in this process, with the acceleration
+        straight from its motion model
+    """
+    def __init__(self, controller: MockController):
+        self.controller = controller
+
+    def __call__(self) -> Truth:
+        controller = self.controller
+        state = controller.get_state()
+        a_local = (state.local_force / state.mass).tolist()
+        alpha_local = np.linalg.solve(state.inertia, state.local_torque).tolist()
+        derivative = motion_model(controller.y.tolist(), a_local, alpha_local)
+        return truth_from_state(state, controller.clock.now(), np.array(derivative[3:6], dtype=f64))
+
+class SharedTruth:
+    """ Truth from the state in shared memory `name`, with the acceleration
+        from the change in velocity between writes. Attaches on first use, so
+        it can be handed to a PTask before it starts.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self._handle: Optional[SharedStateHandle] = None
+        self._state = State()
+        self._truth: Optional[Truth] = None
+
+    def __call__(self) -> Truth:
+        if self._handle is None:
+            self._handle = SharedStateHandle(self.name)
+        try:
+            updated = self._handle.read_into(self._state)
+        except SnapshotTimeout:
+            updated = False # Keep the last truth
+        if updated or self._truth is None:
+            timestamp = self._handle.last_timestamp
+            acceleration = np.zeros(3, dtype=f64)
+            previous = self._truth
+            if previous is not None and timestamp > previous.timestamp:
+                acceleration = (self._state.velocity - previous.velocity) / (timestamp - previous.timestamp)
+            self._truth = truth_from_state(self._state, timestamp, acceleration)
+        return self._truth
+
+    def close(self):
+        if self._handle:
+            self._handle.close()
+            self._handle = None
+
+class Channel:
+    """ One sensor output sampled at `rate`, with noise and bias """
+    def __init__(self, rate: float, noise: NoiseSpec, rng: np.random.Generator):
+        self.rate = rate
+        self.noise = noise
+        self.rng = rng
+        self.bias = np.array(noise.bias, dtype=f64)
+        self.index = -1
+        self.value: Tuple[float, ...] = (0.0, 0.0, 0.0)
+
+    def sample(self, index: int, true_value: arr) -> Tuple[float, ...]:
+        """ The sample `index` (time * rate), drawn once """
+        if index != self.index:
+            noise = self.noise
+            if noise.bias_walk and self.index >= 0:
+                steps = index - self.index
+                self.bias += self.rng.normal(0.0, noise.bias_walk * sqrt(steps / self.rate), 3)
+            value = true_value + self.bias
+            if noise.noise:
+                value = value + self.rng.normal(0.0, noise.noise, 3)
+            self.index = index
+            self.value = tuple(value.tolist())
+        return self.value
+
+class SensorEmulator:
+    """ The emulated sensors, all driven by `truth` and timed by `clock`:
+        `imu`, `magnetometer`, `gps_serial`, and `pressure_sensor`, plus
+        depth() to pass as Localization's depth_func.
+    """
+    def __init__(
+        self,
+        truth: Callable[[], Truth],
+        spec: Optional[EmulatorSpec] = None,
+        clock: Clock = REAL_CLOCK,
+    ):
+        self.truth = truth
+        self.spec = spec = spec or EmulatorSpec()
+        self.clock = clock
+        self.start = clock.now()
+        rng = np.random.default_rng(spec.seed)
+        self.rng = rng
+        self.accel = Channel(spec.imu_rate, spec.accel, rng)
+        self.gyro = Channel(spec.imu_rate, spec.gyro, rng)
+        self.mag = Channel(spec.mag_rate, spec.mag, rng)
+        self.magnetic_field = np.array(spec.magnetic_field, dtype=f64)
+        self.hard_iron = np.array(spec.hard_iron, dtype=f64)
+        self.soft_iron = np.array(spec.soft_iron, dtype=f64)
+        self.gravity = np.array([0.0, 0.0, -G], dtype=f64)
+        self.imu = EmulatedIMU(self)
+        self.magnetometer = EmulatedMagnetometer(self)
+        self.gps_serial = EmulatedGPSSerial(self)
+        self.pressure_sensor = EmulatedMS5837(self)
+
+    def elapsed(self) -> float:
+        return self.clock.now() - self.start
+
+    def index(self, rate: float) -> int:
+        return floor(self.elapsed() * rate)
+
+    def depth(self) -> float:
+        """ Depth as measured by the pressure sensor """
+        self.pressure_sensor.read()
+        return self.pressure_sensor.depth()
+
+class EmulatedIMU(AbstractAccelGyro):
+    def __init__(self, emulator: SensorEmulator):
+        self.emulator = emulator
+
+    @property
+    def acceleration(self) -> Tuple[float, float, float]:
+        emulator = self.emulator
+        rate = emulator.spec.imu_rate
+        index = emulator.index(rate)
+        if emulator.spec.data_ready and index <= emulator.accel.index:
+            # Wait for the next sample
+            index = emulator.accel.index + 1
+            emulator.clock.sleep(emulator.start + index / rate - emulator.clock.now())
+        truth = emulator.truth()
+        specific_force = truth.rotation.T @ (truth.acceleration - emulator.gravity)
+        return emulator.accel.sample(index, specific_force) # type: ignore
+
+    @property
+    def gyro(self) -> Tuple[float, float, float]:
+        emulator = self.emulator
+        index = max(emulator.index(emulator.spec.imu_rate), emulator.accel.index)
+        return emulator.gyro.sample(index, emulator.truth().angular_velocity) # type: ignore
+
+class EmulatedMagnetometer(AbstractMagnetometer):
+    def __init__(self, emulator: SensorEmulator):
+        self.emulator = emulator
+        self.reading: Tuple[float, ...] = (0.0, 0.0, 0.0)
+
+    @property
+    def magnetic(self) -> Tuple[float, float, float]:
+        emulator = self.emulator
+        index = emulator.index(emulator.spec.mag_rate)
+        if index != emulator.mag.index:
+            body_field = emulator.truth().rotation.T @ emulator.magnetic_field
+            # The noise is in microtesla, so it goes in before the distortion
+            measured = np.array(emulator.mag.sample(index, body_field))
+            self.reading = tuple((emulator.soft_iron @ measured + emulator.hard_iron).tolist())
+        return self.reading # type: ignore
+
+class EmulatedGPSSerial(AbstractSerial):
+    """ The GPS's serial port. readline() returns the newest $GPRMC sentence
+        not read yet, or b"" when there is none (like a timeout of 0), so
+        reading it never holds up the IMU.
+    """
+    def __init__(self, emulator: SensorEmulator):
+        self.emulator = emulator
+        self.index = -1
+
+    def readline(self) -> bytes:
+        emulator = self.emulator
+        index = emulator.index(emulator.spec.gps_rate)
+        if index <= self.index:
+            return b""
+        self.index = index
+        return rmc_sentence(emulator.truth(), emulator.spec, emulator.rng,
+                            emulator.spec.start_time + emulator.elapsed()).encode()
+
+class EmulatedMS5837(AbstractPressureSensor):
+    """ Same readings as MS5837 (pressure in mbar, depth from MS5837's
+        formula), sampled at the emulator's pressure rate
+    """
+    def __init__(self, emulator: SensorEmulator):
+        self.emulator = emulator
+        self.index = -1
+        self._pressure = SEA_LEVEL_PA / 100.0 # mbar
+        self._fluidDensity = emulator.spec.fluid_density
+
+    def setFluidDensity(self, density: float):
+        self._fluidDensity = density
+
+    def read(self) -> bool:
+        emulator = self.emulator
+        index = emulator.index(emulator.spec.pressure_rate)
+        if index != self.index:
+            self.index = index
+            depth = -float(emulator.truth().position[2])
+            pascals = SEA_LEVEL_PA + emulator.spec.fluid_density * G * max(depth, 0.0)
+            self._pressure = pascals / 100.0 + emulator.rng.normal(0.0, emulator.spec.pressure_noise)
+        return True
+
+    def pressure(self, conversion: float = 1.0) -> float:
+        return self._pressure * conversion
+
+    def temperature(self) -> float:
+        return self.emulator.spec.water_temperature
+
+    def depth(self) -> float:
+        return (self.pressure(100.0) - SEA_LEVEL_PA) / (self._fluidDensity * G)
+
+def nmea_checksum(body: str) -> str:
+    checksum = 0
+    for character in body.encode():
+        checksum ^= character
+    return "%02X" % checksum
+
+def nmea_coordinate(value: float, degree_digits: int) -> str:
+    value = abs(value)
+    whole = int(value)
+    return str(whole).zfill(degree_digits) + "%07.4f" % ((value - whole) * 60.0)
+
+def rmc_sentence(truth: Truth, spec: EmulatorSpec, rng: np.random.Generator, unix_time: float) -> str:
+    """ A $GPRMC sentence for `truth`, with no fix when under water """
+    stamp = datetime.fromtimestamp(unix_time, timezone.utc)
+    hhmmss = stamp.strftime("%H%M%S") + ".%02d" % (stamp.microsecond // 10000)
+    date = stamp.strftime("%d%m%y")
+    if -truth.position[2] > spec.gps_max_depth:
+        body = "GPRMC," + hhmmss + ",V,,,,,,," + date + ",,,N"
+    else:
+        north, west = truth.position[0:2] + rng.normal(0.0, spec.gps_position_noise, 2)
+        latitude = spec.origin[0] + degrees(north / EARTH_RADIUS)
+        longitude = spec.origin[1] - degrees(west / (EARTH_RADIUS * cos(radians(spec.origin[0]))))
+        v_north, v_west = truth.velocity[0:2] + rng.normal(0.0, spec.gps_speed_noise, 2)
+        speed = hypot(v_north, v_west) * KNOTS
+        course = degrees(atan2(-v_west, v_north)) % 360.0
+        body = ",".join((
+            "GPRMC", hhmmss, "A",
+            nmea_coordinate(latitude, 2), "N" if latitude >= 0 else "S",
+            nmea_coordinate(longitude, 3), "E" if longitude >= 0 else "W",
+            "%.2f" % speed, "%.1f" % course, date, "", "", "A",
+        ))
+    return "$" + body + "*" + nmea_checksum(body) + "\r\n"
+
+if __name__ == "__main__":
+    # Soak test: the real Localization process on emulated sensors at full
+    # rate, driven by a MockController holding constant motor speeds
+    import argparse
+    import json
+    import multiprocessing
+    import os
+    import time
+    from models.data_types import MotorSpeeds
+    from models.shared_memory import create_shared_state
+    from core.localization import Localization
+    from api.localization import localize, localize_setup
+
+    defaults = EmulatorSpec()
+    parser = argparse.ArgumentParser(description="Run localization on emulated sensors")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--imu-rate", type=float, default=defaults.imu_rate)
+    parser.add_argument("--gps-rate", type=float, default=defaults.gps_rate)
+    args = parser.parse_args()
+
+    controller = MockController(lambda message: None)
+    controller.set_speeds(MotorSpeeds(forward=0.5, turn=0.1, front=0.0, back=0.0))
+    emulator = SensorEmulator(
+        ControllerTruth(controller),
+        localize_spec(imu_rate=args.imu_rate, gps_rate=args.gps_rate),
+    )
+    shared_state = create_shared_state(name="emulated_state_" + str(os.getpid()))
+    logging_q: multiprocessing.Queue = multiprocessing.Queue()
+    localization = Localization(
+        logging_q=logging_q,
+        output_shared_memory=shared_state.name,
+        setup_args=localize_setup(emulator),
+        kalman_filter=localize,
+        depth_func=emulator.depth,
+    )
+    try:
+        localization.startup()
+        localization.activate()
+        time.sleep(args.seconds)
+    finally:
+        localization.shutdown()
+        localization.join()
+        shared_state.close()
+        shared_state.unlink()
+    summary = localization.stats.summary()
+    summary["ticks_per_s"] = summary["iterations"] / args.seconds
+    print(json.dumps(summary, indent=2))
@@ -0,0 +1,6 @@
+""" Benchmarks of the AUV hot paths, runnable without hardware:
+
+        python -m benchmarks [-k shared_state] [--save] [--compare BASELINE]
+
+    See cases.py for what is measured and harness.py for how.
+"""
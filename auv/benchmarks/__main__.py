@@ -0,0 +1,69 @@
+""" Runs the AUV benchmarks and prints the throughput and p50/p99 latency of
+    each. Results can be saved as a baseline and compared with a previous
+    one, in which case any benchmark slower than the threshold fails the run.
+"""
+
+from typing import Any
+from pathlib import Path
+import argparse
+import fnmatch
+import sys
+
+try:
+    from .harness import BENCHMARKS, Result, Skipped, run, save, load, compare, current_commit
+    from . import cases # Registers the benchmarks
+except:
+    from harness import BENCHMARKS, Result, Skipped, run, save, load, compare, current_commit
+    import cases
+
+BASELINE_DIR = Path("data/benchmarks")
+
+def print_result(result: Any):
+    if isinstance(result, Skipped):
+        print(f"{result.name:<36} skipped: {result.reason}")
+    else:
+        print(f"{result.name:<36} {result.ops_per_s:>12,.0f} ops/s"
+              f"  p50 {result.p50_us:>10.2f} us  p99 {result.p99_us:>10.2f} us")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__)
+    parser.add_argument("-k", dest="pattern", default="*",
+                        help="only the benchmarks whose names match this glob (substrings match too)")
+    parser.add_argument("--time", type=float, default=1.0, help="seconds to time each benchmark for")
+    parser.add_argument("--list", action="store_true", help="list the benchmarks and exit")
+    parser.add_argument("--save", nargs="?", const="", metavar="PATH",
+                        help="save the results as a baseline, by default to "
+                             + str(BASELINE_DIR) + "/<commit>.json")
+    parser.add_argument("--compare", metavar="PATH", help="baseline to compare the results with")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="p50 slowdown (fraction) that counts as a regression")
+    args = parser.parse_args()
+
+    pattern = args.pattern if any(c in args.pattern for c in "*?[") else "*" + args.pattern + "*"
+    names = [name for name in BENCHMARKS if fnmatch.fnmatch(name, pattern)]
+    if args.list:
+        print("\n".join(names))
+        return 0
+    baseline = load(Path(args.compare)) if args.compare else None
+
+    results = run(names, args.time, report=print_result)
+    measured = [result for result in results if isinstance(result, Result)]
+
+    if args.save is not None:
+        path = Path(args.save) if args.save else BASELINE_DIR / ((current_commit() or "baseline") + ".json")
+        save(measured, path)
+        print("Saved baseline to " + str(path))
+
+    if baseline:
+        print("\nCompared with " + args.compare + " (commit " + str(baseline.commit) + "):")
+        rows = compare(measured, baseline, args.threshold)
+        for row in rows:
+            flag = "  REGRESSED" if row["regressed"] else ""
+            print(f"{row['name']:<36} p50 {row['baseline_p50_us']:>10.2f} -> {row['p50_us']:>10.2f} us"
+                  f"  {row['change']:+7.1%}{flag}")
+        if any(row["regressed"] for row in rows):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
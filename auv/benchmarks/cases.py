@@ -0,0 +1,327 @@
+""" The benchmarks, one per hot path, none of which need hardware. Each one
+    sets up what the real loop would have and yields a single iteration.
+"""
+
+try:
+    from .harness import benchmark
+except:
+    from harness import benchmark
+
+from typing import Any
+from queue import Queue
+from pathlib import Path
+import asyncio
+import functools
+import os
+import threading
+
+import numpy as np
+
+from api.abstract import AbstractController
+from models.clock import Clock
+from models.data_types import State, Log, MotorSpeeds
+from models.outbound import OutboundQueue
+from models.shared_memory import (
+    create_shared_state, create_state_history, SharedStateHandle, StateHistoryHandle,
+    read_shared_state, write_shared_state,
+)
+from models.telemetry import encode_state
+
+def unique(name: str) -> str:
+    return "bench_" + name + "_" + str(os.getpid())
+
+def sample_state(rng: np.random.Generator) -> State:
+    return State(
+        position=rng.normal(size=3),
+        velocity=rng.normal(size=3),
+        attitude=rng.uniform(-180, 180, size=3),
+        angular_velocity=rng.normal(size=3),
+    )
+
+class NullController(AbstractController):
+    def set_speeds(self, input: MotorSpeeds, verbose=True):
+        self.record_speeds(input)
+
+    def set_last_time(self):
+        pass
+
+class SteppingClock(Clock):
+    """ Moves `period` forward every time it's read """
+    def __init__(self, period: float):
+        self.period = period
+        self.time = 0.
+
+    def now(self) -> float:
+        self.time += self.period
+        return self.time
+
+    def sleep(self, seconds: float):
+        raise RuntimeError("SteppingClock can't sleep")
+
+# Shared memory
+
+@benchmark("shared_state.read_shared_state")
+def read_shared_state_case():
+    shm = create_shared_state(name=unique("state"))
+    try:
+        yield lambda: read_shared_state(shm.name)
+    finally:
+        shm.close()
+        shm.unlink()
+
+@benchmark("shared_state.write_shared_state")
+def write_shared_state_case():
+    shm = create_shared_state(name=unique("state"))
+    state = sample_state(np.random.default_rng(0))
+    try:
+        yield lambda: write_shared_state(shm.name, state)
+    finally:
+        shm.close()
+        shm.unlink()
+
+@benchmark("shared_state.handle_read_into")
+def handle_read_into_case():
+    shm = create_shared_state(name=unique("state"))
+    handle = SharedStateHandle(shm.name)
+    handle.write_from(sample_state(np.random.default_rng(0)))
+    state = State()
+    try:
+        yield lambda: handle.read_into(state)
+    finally:
+        handle.close()
+        shm.close()
+        shm.unlink()
+
+@benchmark("shared_state.handle_write_from")
+def handle_write_from_case():
+    shm = create_shared_state(name=unique("state"))
+    handle = SharedStateHandle(shm.name)
+    state = sample_state(np.random.default_rng(0))
+    try:
+        yield lambda: handle.write_from(state)
+    finally:
+        handle.close()
+        shm.close()
+        shm.unlink()
+
+# Control
+
+@benchmark("control.tick")
+def control_tick_case():
+    """ A new state from localization (written to shared memory and the
+        history ring) and the Control tick that acts on it
+    """
+    from core.control import Control
+    shm = create_shared_state(name=unique("state"))
+    history_shm = create_state_history(name=unique("history"))
+    logs: Queue = Queue()
+    control = Control(
+        shared_state_name=shm.name,
+        logging_q=logs,
+        controller=NullController(),
+        shared_history_name=history_shm.name,
+    )
+    output = SharedStateHandle(shm.name)
+    history = StateHistoryHandle(history_shm.name)
+    states = [sample_state(np.random.default_rng(seed)) for seed in range(64)]
+    clock = SteppingClock(0.005)
+    count = [0]
+    def tick():
+        state = states[count[0] & 63]
+        timestamp = clock.now()
+        output.write_from(state, timestamp)
+        history.append(state, timestamp)
+        control.loop()
+        count[0] += 1
+        if count[0] & 0xFFF == 0:
+            logs.queue.clear() # Control logs every tick
+    try:
+        yield tick
+    finally:
+        control.shared_state.close()
+        control.history.close() # type: ignore
+        output.close()
+        history.close()
+        for memory in (shm, history_shm):
+            memory.close()
+            memory.unlink()
+
+# Localization filters
+
+@benchmark("localization.mukf_update_imu")
+def mukf_update_imu_case():
+    from api.localization.unscented_quat import MUKF
+    mukf = MUKF()
+    rng = np.random.default_rng(0)
+    samples = [
+        (rng.normal(0, 0.1, 3) + [0, 0, 9.81], rng.normal(0, 0.01, 3), rng.normal(0, 0.1, 3) + [0.2, 0, 0.4])
+        for _ in range(64)
+    ]
+    count = [0]
+    def update():
+        am, wm, mm = samples[count[0] & 63]
+        mukf.update_imu(am, wm, mm, 0.01)
+        count[0] += 1
+    yield update
+
+def initialized_ekf(EKF):
+    """ An EKF past its first GPS fix, as it is for all but the first tick """
+    from api.localization.extended_filter import GpsCoordinate, GpsVelocity
+    ekf = EKF()
+    ekf.initialize(
+        GpsVelocity(vN=0.4, vE=0.1, vD=0.0),
+        GpsCoordinate(lat=np.radians(32.7), lon=np.radians(-117.2), alt=0.0),
+    )
+    return ekf
+
+@benchmark("localization.ekf_predict")
+def ekf_predict_case():
+    from api.localization.extended_filter import EKF, ImuData
+    ekf = initialized_ekf(EKF)
+    imu = ImuData(accX=0.1, accY=-0.05, accZ=-9.81)
+    q = np.array([1.0, 0.0, 0.0, 0.0])
+    yield lambda: ekf.predict(0.01, imu, q)
+
+@benchmark("localization.ekf_correct")
+def ekf_correct_case():
+    from api.localization.extended_filter import EKF, GpsCoordinate, GpsVelocity
+    ekf = initialized_ekf(EKF)
+    coordinate = GpsCoordinate(lat=np.radians(32.7), lon=np.radians(-117.2), alt=0.0)
+    velocity = GpsVelocity(vN=0.5, vE=0.1, vD=0.0)
+    yield lambda: ekf.correct(velocity, coordinate)
+
+@benchmark("localization.localize_emulated")
+def localize_emulated_case():
+    """ One localize() step, as Localization runs it, on emulated sensors """
+    from api.localization import localize, localize_setup
+    from api.mock_controller import MockController
+    from api.sensor_emulator import SensorEmulator, ControllerTruth, localize_spec
+    clock = SteppingClock(0.) # Moved on one IMU sample per step
+    controller = MockController(lambda message: None, clock=clock)
+    controller.set_speeds(MotorSpeeds(forward=0.5, turn=0.2, front=0.0, back=0.0))
+    emulator = SensorEmulator(ControllerTruth(controller), localize_spec(data_ready=False), clock=clock)
+    setup_args = localize_setup(emulator)
+    def step():
+        previous = clock.time
+        clock.time += 1 / 1660
+        localize(previous, *setup_args, cur_time=clock.time)
+    yield step
+
+# Simulation
+
+@benchmark("mock_controller.get_state")
+def mock_controller_get_state_case():
+    """ One Control period (5 ms, so 5 integration steps) of the motion model """
+    from api.mock_controller import MockController
+    controller = MockController(lambda message: None, clock=SteppingClock(0.005))
+    controller.set_speeds(MotorSpeeds(forward=0.5, turn=0.2, front=0.1, back=-0.1))
+    yield controller.get_state
+
+# Logs to base
+
+@benchmark("main.handle_log_state_frame")
+def handle_log_state_frame_case():
+    from core.main import handle_log
+    queue_to_base = OutboundQueue(rates={"state": 20})
+    frame = encode_state(sample_state(np.random.default_rng(0)), 1, 1.0)
+    def handle():
+        handle_log(Log(source="LCAL", type="state", content=frame, dest="BASE"), queue_to_base)
+    yield handle
+
+@benchmark("main.handle_log_json")
+def handle_log_json_case():
+    from core.main import handle_log
+    queue_to_base = OutboundQueue(rates={"task_stats": 1})
+    content = {
+        name: {"iterations": 1000, "overruns": 0, "rate_hz": 200, "active": True,
+               "period_us": {"p50": 5000.0, "p99": 5100.0}}
+        for name in ("Control", "Localization", "Navigation")
+    }
+    def handle():
+        handle_log(Log(source="MAIN", type="task_stats", content=content, dest="BASE"), queue_to_base)
+    yield handle
+
+# Websocket
+
+@benchmark("websocket.round_trip")
+def websocket_round_trip_case():
+    """ A command from base over loopback to the AUV server and its ack back """
+    from websockets.asyncio.server import serve
+    from websockets.sync.client import connect
+    from core.websocket_handler import socket_handler
+
+    queue_from_base: Queue = Queue()
+    handler = functools.partial(
+        socket_handler,
+        queue_to_base=OutboundQueue(),
+        queue_from_base=queue_from_base,
+        log=lambda message: None,
+    )
+    ready = threading.Event()
+    server_info: Any = {}
+    async def serve_forever():
+        async with serve(handler, host="127.0.0.1", port=0) as server:
+            server_info["server"] = server
+            server_info["loop"] = asyncio.get_running_loop()
+            server_info["port"] = server.sockets[0].getsockname()[1]
+            ready.set()
+            await server.wait_closed()
+    thread = threading.Thread(target=asyncio.run, args=(serve_forever(),), daemon=True)
+    thread.start()
+    ready.wait()
+    client = connect("ws://127.0.0.1:" + str(server_info["port"]))
+    client.recv() # Hello
+    message = '{"command": "tasks", "content": {"sub": "info"}}'
+    def round_trip():
+        client.send(message)
+        client.recv()
+        queue_from_base.get_nowait()
+    try:
+        yield round_trip
+    finally:
+        client.close()
+        server_info["loop"].call_soon_threadsafe(server_info["server"].close)
+        thread.join()
+
+# Video
+
+@benchmark("video.jpegenc_publish")
+def jpegenc_publish_case():
+    """ A 640x480 camera frame through the web app's video path: JPEG encoded
+        by GStreamer's jpegenc into an appsink, wrapped as a part of the MJPEG
+        stream, published to LatestFrame, and taken by a viewer. Only the
+        H264 receive and decode in front of it are left out.
+    """
+    import sys
+    sys.path.append(str(Path(__file__).resolve().parent.parent.parent / "web_app"))
+    try:
+        from video import Gst, LatestFrame, sample_to_part
+    except ValueError as err: # gi is there but GStreamer isn't
+        raise ImportError(str(err))
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(0, 255, 640, dtype=np.float32)[None, :, None]
+    frame = np.clip(gradient + rng.normal(0, 12, (480, 640, 3)), 0, 255).astype(np.uint8)
+    frame_bytes = frame.tobytes()
+    pipeline = Gst.parse_launch(
+        'appsrc name=src format=time do-timestamp=true '
+            'caps="video/x-raw, format=RGB, width=640, height=480, framerate=30/1" '
+            '! videoconvert ! jpegenc quality=85 ! appsink name=sink sync=false'
+    )
+    src = pipeline.get_by_name("src")
+    sink = pipeline.get_by_name("sink")
+    pipeline.set_state(Gst.State.PLAYING)
+    loop = asyncio.new_event_loop()
+    async def make_latest():
+        return LatestFrame()
+    latest = loop.run_until_complete(make_latest())
+    sequence = 0
+    def step():
+        nonlocal sequence
+        src.emit("push-buffer", Gst.Buffer.new_wrapped(frame_bytes))
+        latest.publish(sample_to_part(sink.emit("pull-sample")))
+        sequence, _ = loop.run_until_complete(latest.next(sequence))
+    try:
+        yield step
+    finally:
+        pipeline.set_state(Gst.State.NULL)
+        loop.close()
@@ -0,0 +1,162 @@
+""" Timing, registry, and JSON baselines for the benchmarks in cases.py. """
+
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter, time
+import platform
+import subprocess
+import sys
+
+from msgspec import Struct, json
+import numpy as np
+
+class Result(Struct):
+    name: str
+    ops_per_s: float
+    p50_us: float
+    p99_us: float
+    mean_us: float
+    operations: int
+    batch: int # Operations per timed sample, latencies are per operation
+
+class Skipped(Struct):
+    name: str
+    reason: str
+
+class Baseline(Struct):
+    commit: Optional[str]
+    created: float
+    machine: Dict[str, str]
+    results: List[Result]
+
+# Name: setup generator, see benchmark()
+BENCHMARKS: Dict[str, Callable[[], Iterator[Callable[[], Any]]]] = {}
+
+def benchmark(name: str):
+    """ Registers a benchmark. The decorated function is a generator that
+        sets up, yields the operation to time (called with no arguments), and
+        cleans up after the yield. Raise ImportError before yielding when an
+        optional dependency is missing, and the benchmark is skipped.
+    """
+    def register(setup: Callable[[], Iterator[Callable[[], Any]]]):
+        if name in BENCHMARKS:
+            raise ValueError("Duplicate benchmark: " + name)
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+def measure(
+    name: str,
+    operation: Callable[[], Any],
+    min_time: float = 1.0,
+    min_samples: int = 50,
+    sample_time: float = 50e-6,
+) -> Result:
+    """ Times `operation` for at least `min_time` seconds. Fast operations are
+        timed in batches that take about `sample_time` each, so the timer's own
+        cost doesn't count, and the percentiles are over those batches.
+    """
+    # Warm up, and find how many calls make a sample
+    begin = perf_counter()
+    operation()
+    estimate = perf_counter() - begin
+    calls = 1
+    while estimate * calls < sample_time and calls < 1 << 20:
+        calls *= 2
+        begin = perf_counter()
+        for _ in range(calls):
+            operation()
+        estimate = (perf_counter() - begin) / calls
+    batch = max(1, int(sample_time / estimate)) if estimate > 0 else 1 << 20
+
+    samples: List[float] = []
+    started = perf_counter()
+    while perf_counter() - started < min_time or len(samples) < min_samples:
+        begin = perf_counter()
+        for _ in range(batch):
+            operation()
+        samples.append((perf_counter() - begin) / batch)
+    latencies = np.array(samples) * 1e6
+    operations = len(samples) * batch
+    return Result(
+        name=name,
+        ops_per_s=1e6 / float(latencies.mean()),
+        p50_us=float(np.percentile(latencies, 50)),
+        p99_us=float(np.percentile(latencies, 99)),
+        mean_us=float(latencies.mean()),
+        operations=operations,
+        batch=batch,
+    )
+
+def run(
+    names: List[str],
+    min_time: float = 1.0,
+    report: Callable[[Any], None] = lambda result: None,
+) -> List[Any]:
+    """ Runs the named benchmarks in order, returning a Result or Skipped for
+        each, which is also passed to `report` as soon as it's done
+    """
+    results: List[Any] = []
+    for name in names:
+        try:
+            with contextmanager(BENCHMARKS[name])() as operation:
+                result: Any = measure(name, operation, min_time)
+        except ImportError as err:
+            result = Skipped(name=name, reason=str(err))
+        results.append(result)
+        report(result)
+    return results
+
+def current_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True, cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def save(results: List[Result], path: Path) -> Baseline:
+    baseline = Baseline(
+        commit=current_commit(),
+        created=time(),
+        machine={
+            "node": platform.node(),
+            "processor": platform.processor() or platform.machine(),
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+        },
+        results=results,
+    )
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(json.format(json.encode(baseline), indent=2))
+    return baseline
+
+def load(path: Path) -> Baseline:
+    return json.decode(path.read_bytes(), type=Baseline)
+
+def compare(
+    results: List[Result],
+    baseline: Baseline,
+    threshold: float = 0.1,
+) -> List[Dict[str, Any]]:
+    """ Each result against the baseline's result of the same name. A
+        benchmark regressed when its p50 latency is more than `threshold`
+        (a fraction) above the baseline's.
+    """
+    previous = {result.name: result for result in baseline.results}
+    rows = []
+    for result in results:
+        before = previous.get(result.name)
+        if before is None:
+            continue
+        change = result.p50_us / before.p50_us - 1. if before.p50_us > 0 else 0.
+        rows.append({
+            "name": result.name,
+            "baseline_p50_us": before.p50_us,
+            "p50_us": result.p50_us,
+            "change": change,
+            "regressed": change > threshold,
+        })
+    return rows
@@ -1,15 +1,16 @@
-from typing import Union
+from typing import Union, Optional
 from queue import Queue, Empty
 from functools import partial
-from time import sleep, time
 
 import numpy as np
 from numpy import array as ar, float64 as f64
 
 from api.abstract import AbstractController
 from models.data_types import State, Log, MotorSpeeds, logger
-from models.shared_memory import read_shared_state
+from models.shared_memory import SharedStateHandle, StateHistoryHandle, SnapshotTimeout, HISTORY_DTYPE
 from models.tasks import TTask
+from models.clock import Clock
+from models.pid import VectorPID, wrap_degrees
 
 def sigmoid(x):
     """ Maps from input of all real numbers to output between 0 and 1
@@ -22,16 +23,24 @@ class Control(TTask):
         in order to keep the system critically damped so that the error between
         the current state and desired state is minimized.
     """
+    rate_hz = 200
     def __init__(
             self, 
             shared_state_name: str, 
             logging_q: Queue, 
             controller: AbstractController, 
+            shared_history_name: Optional[str] = None,
+            clock: Optional[Clock] = None,
     ):
-        super().__init__(name="Control")
+        super().__init__(name="Control", clock=clock)
         self.shared_state_name = shared_state_name 
+        self.shared_state = SharedStateHandle(shared_state_name)
+        # With a history ring the derivative term uses the measured rate
+        # between the last two samples instead of differencing the error
+        self.history = StateHistoryHandle(shared_history_name) if shared_history_name else None
+        self._recent = np.zeros(2, dtype=HISTORY_DTYPE)
         self.mc = controller
-        self.estimated_state = read_shared_state(name=shared_state_name)
+        self.estimated_state = self.shared_state.read()
         self.desired_state = State(
                 position = ar([10.0, 0.0, 10.0], dtype=f64),
                 velocity = ar([0.0, 0.0, 0.0], dtype=f64),
@@ -39,9 +48,7 @@ class Control(TTask):
                 angular_velocity = ar([0.0, 0.0, 0.0], dtype=f64),
         )
         self.log = partial(logger, q=logging_q, source="CTRL", verbose=True)
-        self._last_time = time()
-        self._last_err = 0.
-        self._integral = np.zeros(6, dtype=f64)
+        self._last_time = self.clock.now()
         self.thrust_allocation = np.linalg.pinv(np.array([
                 [ 1, 0, 0, 0],
                 [ 0, 0, 0, 0],
@@ -50,9 +57,18 @@ class Control(TTask):
                 [ 0, 0, -1, 1],
                 [ 0, 1, 0, 0],
         ]))
-        self.Kp = ar([0.5, 0.5, 0.5, 0., 0., 0.5])
-        self.Ki = ar([0.05, 0.05, 0.05, 0., 0., 0.0])
-        self.Kd = ar([0., 0., 0., 0., 0., 0.1])
+        # Axes are surge, sway, heave, roll, pitch, yaw
+        self.pid = VectorPID(
+                Kp = [0.5, 0.5, 0.5, 0., 0., 0.5],
+                Ki = [0.05, 0.05, 0.05, 0., 0., 0.0],
+                Kd = [0., 0., 0., 0., 0., 0.1],
+                wrap = [False, False, False, True, True, True],
+                windup = 1.,
+        )
+        self._setpoint = np.zeros(6, dtype=f64)
+        self._measured = np.zeros(6, dtype=f64)
+        self._rate = np.zeros(6, dtype=f64)
+        self._speeds = np.zeros(4, dtype=f64)
     
     def run(self):
         meta = self.meta
@@ -60,67 +76,104 @@ class Control(TTask):
         log("Control alive")
         mc = self.mc
         mc.set_last_time()
-        while True:
-            if not meta.started_event.is_set() or not meta.enabled_event.is_set():
-                if not meta.enabled_event.is_set():
-                    meta.enabled_event.wait()
-                if not meta.started_event.is_set():
-                    break;
-            sleep(0.0001)
-            try:
-                msg = meta.input_q.get_nowait()
-                if msg:
-                    log("Control input received")
-                    try:
-                        if msg["command"] == "control":
-                            log("Desired State: " + str(msg["content"]))
-                            self.desired_state.position = msg["content"].position
-                            self.desired_state.attitude = msg["content"].attitude
-                        elif msg["command"] == "pid":
-                            log("PID constants changed: " + str(msg["content"]))
-                            indices = ["surge", "sway", "heave", "roll", "pitch", "yaw"]
-                            index = indices.index(msg["content"]["axis"])
-                            self.Kp[index] = msg["content"]["p"]
-                            self.Ki[index] = msg["content"]["i"]
-                            self.Kd[index] = msg["content"]["d"]
-                    except:
-                        log("Control input failed to parse")
-            except Empty:
-                pass
+        stats = self.stats
+        scheduler = self.make_scheduler()
+        try:
+            while True:
+                if not meta.started_event.is_set() or not meta.enabled_event.is_set():
+                    if not meta.enabled_event.is_set():
+                        with self.clock.idle():
+                            meta.enabled_event.wait()
+                    if not meta.started_event.is_set():
+                        self.shared_state.close()
+                        if self.history:
+                            self.history.close()
+                        break;
+                    stats.pause()
+                    scheduler.reset()
+                scheduler.wait()
+                stats.begin()
+                self.loop()
+                stats.end(scheduler)
+        finally:
+            # Even if the loop raises, or the other tasks on a VirtualClock would
+            # wait for this one forever
+            self.clock.leave()
 
-            try:
-                self.estimated_state: State = read_shared_state(name=self.shared_state_name)
-                if self.estimated_state:
-                    setpoint = np.concatenate((self.desired_state.position, self.desired_state.attitude))
-                    estimated = np.concatenate((self.estimated_state.position, self.estimated_state.attitude))
-                    err = setpoint - estimated
+    def loop(self):
+        """ One tick: take any new input, and set the motors if localization
+            has written a new state since the last tick
+        """
+        meta = self.meta
+        log = self.log
+        try:
+            msg = meta.input_q.get_nowait()
+            if msg:
+                log("Control input received")
+                try:
+                    if msg["command"] == "control":
+                        log("Desired State: " + str(msg["content"]))
+                        self.desired_state.position = msg["content"].position
+                        self.desired_state.attitude = msg["content"].attitude
+                    elif msg["command"] == "pid":
+                        log("PID constants changed: " + str(msg["content"]))
+                        indices = ["surge", "sway", "heave", "roll", "pitch", "yaw"]
+                        index = indices.index(msg["content"]["axis"])
+                        self.pid.set_gains(
+                            index,
+                            p=msg["content"]["p"],
+                            i=msg["content"]["i"],
+                            d=msg["content"]["d"],
+                        )
+                except:
+                    log("Control input failed to parse")
+        except Empty:
+            pass
 
-                    # Solves wrap-around angle problem
-                    err[3] = (err[3] + 540) % 360 - 180
-                    err[4] = (err[4] + 540) % 360 - 180
-                    err[5] = (err[5] + 540) % 360 - 180
+        try:
+            # Only recompute when localization has written a new state
+            if self.shared_state.read_into(self.estimated_state):
+                setpoint = self._setpoint
+                setpoint[0:3] = self.desired_state.position
+                setpoint[3:6] = self.desired_state.attitude
+                measured = self._measured
+                measured[0:3] = self.estimated_state.position
+                measured[3:6] = self.estimated_state.attitude
 
-                    current_time = time()
-                    dt = current_time - self._last_time
-                    self._last_time = current_time
+                current_time = self.clock.now()
+                dt = current_time - self._last_time
+                self._last_time = current_time
 
-                    self._integral += err * dt
-                    integral = np.maximum(np.minimum(self._integral, 1) ,-1)
-                    derivative = (err - self._last_err) / dt
-                    self._last_err = err
+                rate = None
+                if self.history and self.history.read_last(2, self._recent) == 2:
+                    recent = self._recent
+                    sample_dt = recent[1]["timestamp"] - recent[0]["timestamp"]
+                    if sample_dt > 0:
+                        # Measured rate between the last two samples
+                        rate = self._rate
+                        np.subtract(recent[1]["position"], recent[0]["position"], out=rate[0:3])
+                        np.subtract(recent[1]["attitude"], recent[0]["attitude"], out=rate[3:6])
+                        wrap_degrees(rate[3:6], rate[3:6])
+                        rate /= sample_dt
 
-                    signal = self.Kp * err + self.Ki * integral + self.Kd * derivative
-                    # Thruster allocation with final values between 0 and 1
-                    speeds = np.maximum(np.minimum(np.dot(self.thrust_allocation, signal), 1), -1)
-                    log("ERR: " + str(err.round(2)))
-                    #log("SGL: " + str(signal.round(2)))
-                    #log("SPD: " + str(speeds))
-                    self.mc.set_speeds(MotorSpeeds(
-                        forward=speeds[0],
-                        turn=speeds[1],
-                        front=speeds[2],
-                        back=speeds[3],
-                    ),
-                    )
-            except Empty:
-                pass
+                signal = self.pid.update(setpoint, measured, dt, rate=rate)
+                err = self.pid.error
+                # Thruster allocation with final values between 0 and 1
+                speeds = self._speeds
+                np.matmul(self.thrust_allocation, signal, out=speeds)
+                np.clip(speeds, -1, 1, out=speeds)
+                log("ERR: " + str(err.round(2)))
+                #log("SGL: " + str(signal.round(2)))
+                #log("SPD: " + str(speeds))
+                self.mc.set_speeds(MotorSpeeds(
+                    forward=speeds[0],
+                    turn=speeds[1],
+                    front=speeds[2],
+                    back=speeds[3],
+                ),
+                )
+        except SnapshotTimeout:
+            # Localization was writing the whole time, try again next tick
+            log("Skipped tick, shared state was busy")
+        except Empty:
+            pass
@@ -1,83 +1,162 @@
-from models.data_types import State, Log, SerialState, logger
-from models.shared_memory import write_shared_state
+from models.data_types import State, Log, logger
+from models.telemetry import encode_state
+from models.shared_memory import SharedStateHandle, StateHistoryHandle
 from models.tasks import PTask, TTask
+from models.clock import Clock
+from models.recorder import (
+    FlightRecorder, RecordingAccelGyro, RecordingMagnetometer, RecordingSerial,
+    recording_depth, KIND_TICK,
+)
 
 import multiprocessing
 import threading
 import queue
-from time import time
-from typing import Tuple, Callable, Union, Literal
+from time import time, monotonic
+from typing import Tuple, Callable, Union, Literal, Optional
 from functools import partial
 
 import numpy as np
 
 class Localization(PTask):
+    """ Runs `kalman_filter` (api.localization.localize) on the sensors in
+        `setup_args` (from localize_setup()) as fast as they allow, and writes
+        the state to shared memory. With `sensor_recording` set to a directory,
+        every raw sensor sample is recorded there for api/replay.py.
+    """
     def __init__(
         self,
         logging_q: multiprocessing.Queue,
         output_shared_memory: str,
         setup_args: Tuple,
         kalman_filter: Callable,
-        depth_func: Callable[[], float]
+        depth_func: Callable[[], float],
+        output_history: Optional[str] = None,
+        sensor_recording: Optional[str] = None,
     ):
         super().__init__(name="Localization")
         self.output_shared_memory = output_shared_memory
+        self.output_history = output_history
         self.setup_args = setup_args
         self.kalman_filter = kalman_filter
         self.depth_func = depth_func
+        self.sensor_recording = sensor_recording
         self.log = partial(logger, q=logging_q, source="LCAL", verbose=True)
 
     def run(self):
         meta = self.meta
         self.log("Localization started")
+        # Attached here since this runs in the child process
+        output = SharedStateHandle(self.output_shared_memory)
+        history = StateHistoryHandle(self.output_history) if self.output_history else None
+        output_state = State()
+        stats = self.stats
+        setup_args = self.setup_args
+        depth_func = self.depth_func
+        recorder = None
+        if self.sensor_recording:
+            # Started here since a thread doesn't survive the fork
+            recorder = FlightRecorder(self.sensor_recording, name="sensors")
+            recorder.start()
+            i2c, ag_sensor, m_sensor, ser, ekf, mukf = setup_args
+            setup_args = (
+                i2c,
+                RecordingAccelGyro(ag_sensor, recorder),
+                RecordingMagnetometer(m_sensor, recorder),
+                RecordingSerial(ser, recorder),
+                ekf,
+                mukf,
+            )
+            depth_func = recording_depth(depth_func, recorder)
+        prev_time = time()
         while True:
             if not meta.started_event.is_set() or not meta.enabled_event.is_set():
                 if not meta.enabled_event.is_set():
                     meta.enabled_event.wait()
                 if not meta.started_event.is_set():
+                    output.close()
+                    if history:
+                        history.close()
+                    if recorder:
+                        recorder.stop()
                     break;
-            kf_output = self.kalman_filter()
-            output_state = State(
-                position=np.array([kf_output.position[0], kf_output.position[1], -self.depth_func()]),
-                velocity=np.array([0., 0., 0.]),
-                attitude=kf_output["attitude"],
-                angular_velocity=kf_output["angular_velocity"],
-            )
-            write_shared_state(name=self.output_shared_memory, state=output_state)
+                stats.pause()
+            stats.begin()
+            cur_time = time()
+            kf_output = self.kalman_filter(prev_time, *setup_args, cur_time=cur_time)
+            output_state.position[0] = kf_output.position[0]
+            output_state.position[1] = kf_output.position[1]
+            output_state.position[2] = -depth_func()
+            output_state.velocity[:] = kf_output.velocity
+            output_state.attitude[:] = kf_output.attitude
+            output_state.angular_velocity[:] = kf_output.angular_velocity
+            timestamp = monotonic()
+            output.write_from(output_state, timestamp)
+            if history:
+                history.append(output_state, timestamp)
+            if recorder:
+                # After the samples it read, see api/replay.py
+                recorder.sample(KIND_TICK, (prev_time, cur_time, timestamp))
+            prev_time = cur_time
+            stats.end()
 
 class Mock_Localization(TTask):
+    rate_hz = 400
+
     def __init__(
         self,
         logging_q: queue.Queue,
         output: str,
         localize_func: Callable[[], Union[State, None]],
+        output_history: Optional[str] = None,
+        clock: Optional[Clock] = None,
+        name: str = "Localization",
     ):
-        super().__init__(name="Localization")
+        super().__init__(name=name, clock=clock)
         self.output = output
+        self.output_history = output_history
         self.logging_q = logging_q
         self.localize_func = localize_func
         self.log = partial(logger, q=logging_q, source="LCAL", verbose=True)
 
     def run(self):
         meta = self.meta
-        self.log("Localization started", source="LCAL")
-        while True:
-            if not meta.started_event.is_set() or not meta.enabled_event.is_set():
-                if not meta.enabled_event.is_set():
-                    meta.enabled_event.wait()
-                if not meta.started_event.is_set():
-                    break;
-            state = self.localize_func()
-            if state:
-                write_shared_state(name=self.output, state=state)
-                self.logging_q.put(Log(
-                        source="LCAL",
-                        type="state",
-                        content=SerialState(
-                                position=state.position.tolist(),
-                                velocity=state.velocity.tolist(),
-                                attitude=state.attitude.tolist(),
-                                angular_velocity=state.angular_velocity.tolist(),
-                        ),
-                        dest="BASE",
-                ))
+        self.log(self.name + " started", source="LCAL")
+        output = SharedStateHandle(self.output)
+        history = StateHistoryHandle(self.output_history) if self.output_history else None
+        stats = self.stats
+        scheduler = self.make_scheduler()
+        clock = self.clock
+        sequence = 0 # Of the telemetry frames sent to base
+        try:
+            while True:
+                if not meta.started_event.is_set() or not meta.enabled_event.is_set():
+                    if not meta.enabled_event.is_set():
+                        with clock.idle():
+                            meta.enabled_event.wait()
+                    if not meta.started_event.is_set():
+                        output.close()
+                        if history:
+                            history.close()
+                        break;
+                    stats.pause()
+                    scheduler.reset()
+                scheduler.wait()
+                stats.begin()
+                state = self.localize_func()
+                if state:
+                    timestamp = clock.now()
+                    output.write_from(state, timestamp)
+                    if history:
+                        history.append(state, timestamp)
+                    sequence += 1
+                    self.logging_q.put(Log(
+                            source="LCAL",
+                            type="state",
+                            content=encode_state(state, sequence, timestamp),
+                            dest="BASE",
+                    ))
+                stats.end(scheduler)
+        finally:
+            # Even if the loop raises, or the other tasks on a VirtualClock would
+            # wait for this one forever
+            clock.leave()
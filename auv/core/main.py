@@ -11,6 +11,8 @@ import msgspec
 from api.abstract import AbstractController
 from models.data_types import Promise, MotorSpeeds, Log, State, SerialState
 from models.tasks import Task
+from models.timers import TimerService
+from models.outbound import OutboundQueue, Priority
 
 # This is the shorthand log function used in the main thread
 def log(x: Any):
@@ -26,21 +28,38 @@ log_prefixes: Dict[str, str] = {
     "PRCP": "\033[46mPERCEPT:\033[0m ",
 }
 
-def handle_log(message: Union[Log, str], base_q: Queue):
+# Log types that are replies to base or problems, which must always get there
+CRITICAL_TYPES = {"tasks", "task_info", "ack", "error"}
+# Log types where base only needs the latest, sent at the configured rate
+TELEMETRY_TYPES = {"state", "task_stats"}
+
+def log_priority(message: Log) -> Priority:
+    """ Priority class of a log going to base, see OutboundQueue """
+    if message.type in CRITICAL_TYPES:
+        return "critical"
+    if message.type in TELEMETRY_TYPES:
+        return "telemetry"
+    return "normal"
+
+def handle_log(message: Union[Log, str], base_q: OutboundQueue):
     try:
         if isinstance(message, str):
             raise Exception
         print_log: bool = True
+        if isinstance(message.content, bytes):
+            # Binary telemetry frame (models/telemetry.py), sent to base as is
+            if message.dest == "BASE":
+                base_q.put(message.content, log_priority(message), topic=message.type)
+            return
         if message.type == "state" and isinstance(message.content, SerialState): 
             print_log = False
             message.content = message.content.model_dump_json()
+        elif message.type in ("task_stats", "task_info"):
+            print_log = False # Periodic and long, only useful on the GUI
         # Since message: Log, we must convert Log to JSON
         result = msgspec.json.encode(message).decode()
         if message.dest == "BASE":
-            try:
-                base_q.put_nowait(result)
-            except Full:
-                pass
+            base_q.put(result, log_priority(message), topic=message.type)
         if print_log:
             if message.dest == "BASE":
                 print("\033[101mTO BASE: " + str(message) + "\033[0m")
@@ -52,13 +71,13 @@ def motor_test(
     speeds:Tuple[float, float, float, float],
     *,
     motor_controller:AbstractController,
-    promises: List[Promise],
+    timers: TimerService,
     disable_controller: Callable,
     time_to_zero: float = 10.0
 ) -> None:
     """ Safely parse the speeds and dispatch them to the motor controller. Also
         handles disabling any PID control execution while the motor test is
-        underway. Also adds a promise to zero the motors after a default of 10
+        underway. Also sets a timer to zero the motors after a default of 10
         seconds, which can be customized via `time_to_zero`.
     """
     try:
@@ -75,25 +94,33 @@ def motor_test(
         log("Motor speeds invalid: " + str(speeds))
         log(e)
     finally:
-        noExistingPromise = True 
-        for promise in promises:
-            if promise.name=="motorReset":
-                promise.init = time()
-                noExistingPromise = False 
-                log("Mutated existing motor reset promise")
-        if noExistingPromise: 
-            promises.append(Promise(
+        if timers.rearm("motorReset", time_to_zero):
+            log("Re-armed existing motor reset timer")
+        else:
+            timers.schedule(
                 name="motorReset",
-                duration = time_to_zero,
-                callback = lambda: motor_controller.set_zeros()
-            ))
-            log("Appended motor reset promise")
+                delay=time_to_zero,
+                callback=lambda: motor_controller.set_zeros(),
+            )
+            log("Scheduled motor reset timer")
+
+def report_task_stats(tasks: List[Task], logging_q: Queue, reply: bool = False):
+    """ Sends the loop timing stats and queue depths of every task to base.
+        A `reply` to a request from base goes as "task_info", which is never
+        rate limited or superseded like the periodic "task_stats".
+    """
+    logging_q.put(Log(
+        source="MAIN",
+        type="task_info" if reply else "task_stats",
+        content={task.meta.name: task.info() for task in tasks},
+        dest="BASE",
+    ))
 
 def manage_tasks(msg, tasks: List[Task], logging_q: Queue):
     subcommand: str = msg["content"]["sub"]
     try:
         if subcommand == "info":
-            pass
+            report_task_stats(tasks, logging_q, reply=True)
         elif subcommand == "enable":
             matching_task = [task for task in tasks if task.meta.name == msg["content"]["task"]][0]
             log("Activating task: " + matching_task.meta.name)
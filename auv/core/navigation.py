@@ -13,6 +13,7 @@ class Navigation(TTask):
         desired state of the submarine is. It is not meant to directly
         control the state of the submarine, merely produce a desired state.
     """
+    rate_hz = 50
     def __init__(
             self,
             logging_q: Queue,
@@ -1,71 +1,180 @@
-from websockets.sync.server import serve, ServerConnection
+from websockets.asyncio.server import serve, ServerConnection
 from websockets.exceptions import ConnectionClosedOK, ConnectionClosedError
 
 from models.data_types import Log
+from models.instrumentation import LoopStats
 from models.tasks import TTask, TaskInfo
+from models.outbound import OutboundQueue
+from models.telemetry import encode_batch
 
 import json
-from queue import Queue, Empty, Full
+import asyncio
 import time
+from queue import Queue, Empty
 import functools
 import threading
-from typing import Callable
+from typing import Any, Callable, List, Literal, Optional, Union
 
-def socket_handler(
+# Most messages sent in one go before yielding to the reader
+MAX_BATCH = 64
+
+def encode_for_base(message: Any) -> Union[str, bytes]:
+    # Telemetry frames go as binary messages and everything else is already
+    # JSON text, so neither is encoded again here
+    if isinstance(message, (bytes, str)):
+        return message
+    return json.dumps(message)
+
+def drain(queue_to_base: OutboundQueue, limit: int) -> List[Any]:
+    """ Everything queue_to_base has ready to send now, up to `limit` """
+    batch: List[Any] = []
+    try:
+        while len(batch) < limit:
+            batch.append(queue_to_base.get_nowait())
+    except Empty:
+        pass
+    return batch
+
+async def read_from_base(
         base_websocket:ServerConnection,
-        stop_event:threading.Event,
-        ping_interval:int,
-        queue_to_base:Queue,
+        queue_to_base:OutboundQueue,
         queue_from_base:Queue,
         log:Callable[[str], None],
 ):
-    log("New websocket connection from base")
-    base_websocket.send("Hello from AUV")
-    """last_ping = time.time()
-    time_since_last_ping = 0"""
-    while True:
-        #log("Websocket loop")
-        if stop_event.is_set():
-            log("Websocket stop event")
-            base_websocket.close()
-        time.sleep(0.001)
+    """ Forwards every message from base to queue_from_base as it arrives,
+        and acknowledges it. Returns when base disconnects cleanly.
+    """
+    async for raw_message in base_websocket:
+        try:
+            message_from_base = json.loads(raw_message)
+        except ValueError:
+            log("Message from base isn't JSON: " + str(raw_message))
+            continue
+        if not isinstance(message_from_base, dict):
+            log("Message from base isn't a JSON object: " + str(raw_message))
+            continue
+        if message_from_base:
+            log("Message from base: " + str(message_from_base))
+            queue_from_base.put(message_from_base)
+            # Send acknowledgement back to base
+            message_from_base["ack"] = True
+            queue_to_base.put(json.dumps(message_from_base), "critical")
 
+async def collect_batch(
+        batch:List[Union[str, bytes]],
+        queue_to_base:OutboundQueue,
+        ready:asyncio.Event,
+        window:float,
+        max_bytes:int,
+):
+    """ Adds to `batch` whatever else becomes ready within `window` seconds,
+        until it holds `max_bytes` or more.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + window
+    size = sum(len(message) for message in batch)
+    while size < max_bytes:
+        ready.clear()
+        more = [encode_for_base(message) for message in drain(queue_to_base, MAX_BATCH)]
+        if more:
+            batch.extend(more)
+            size += sum(len(message) for message in more)
+            continue
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return
+        due = queue_to_base.time_until_ready()
         try:
-            message_from_base = json.loads(base_websocket.recv(timeout=0)) # Doesn't block since timeout=0
-            if message_from_base:
-                log("Message from base: " + str(message_from_base))
-                queue_from_base.put(message_from_base)
-                # Send acknowledgement back to base
-                message_from_base["ack"] = True 
-                queue_to_base.put_nowait(json.dumps(message_from_base))
+            await asyncio.wait_for(ready.wait(), remaining if due is None else min(due, remaining))
         except TimeoutError:
-            #log("Timeout")
-            pass
-        except ConnectionClosedOK:
-            log("Base disconnected (OK)")
-            return
-        except ConnectionClosedError as err:
-            log("Base disconnected (ERROR)")
-            log(str(err))
-            return
-        except Full:
             pass
 
-        try:
-            message_to_base = queue_to_base.get(block=False)
-            if message_to_base:
-                base_websocket.send(json.dumps(message_to_base))
-        except Empty:
-            #log("Empty")
-            pass
-        except ConnectionClosedOK:
-            log("Base disconnected (OK)")
-            return
-        except ConnectionClosedError as err:
-            log("Base disconnected (ERROR)")
-            log(str(err))
-            return
-            
+async def write_to_base(
+        base_websocket:ServerConnection,
+        queue_to_base:OutboundQueue,
+        stats:Optional[LoopStats] = None,
+        batch_window:float = 0.,
+        batch_bytes:int = 1024,
+        batch_compression:Optional[Literal["zlib"]] = None,
+):
+    """ Sends everything in queue_to_base as soon as it's ready. The putting
+        threads wake this up through a listener on the queue, so an idle link
+        costs nothing and a message goes out without waiting for a poll.
+
+        With no `batch_window`, each message is its own websocket message and
+        a backlog is sent back to back. Otherwise the first ready message
+        opens a window of `batch_window` seconds (closed early at
+        `batch_bytes`), and everything ready by then goes out as a single
+        FRAME_BATCH (see models/telemetry.py), optionally compressed.
+    """
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    def wake():
+        loop.call_soon_threadsafe(ready.set)
+    queue_to_base.add_listener(wake)
+    sequence = 0
+    try:
+        while True:
+            ready.clear()
+            batch = [encode_for_base(message) for message in drain(queue_to_base, MAX_BATCH)]
+            if batch:
+                if batch_window > 0:
+                    await collect_batch(batch, queue_to_base, ready, batch_window, batch_bytes)
+                if stats:
+                    stats.begin()
+                if len(batch) > 1 and batch_window > 0:
+                    await base_websocket.send(encode_batch(
+                        batch, sequence, time.monotonic(), compress=batch_compression == "zlib",
+                    ))
+                    sequence += 1
+                else:
+                    for message_to_base in batch:
+                        await base_websocket.send(message_to_base)
+                if stats:
+                    stats.end()
+                continue
+            # Nothing ready; sleep until a put, or until a rate limited
+            # telemetry topic is due
+            try:
+                await asyncio.wait_for(ready.wait(), queue_to_base.time_until_ready())
+            except TimeoutError:
+                pass
+    finally:
+        queue_to_base.remove_listener(wake)
+
+async def socket_handler(
+        base_websocket:ServerConnection,
+        queue_to_base:OutboundQueue,
+        queue_from_base:Queue,
+        log:Callable[[str], None],
+        stats:Optional[LoopStats] = None,
+        batch_window:float = 0.,
+        batch_bytes:int = 1024,
+        batch_compression:Optional[Literal["zlib"]] = None,
+):
+    log("New websocket connection from base")
+    await base_websocket.send("Hello from AUV")
+    if stats:
+        stats.pause()
+    # Reading and writing run independently, so neither waits on the other
+    reader = asyncio.create_task(read_from_base(base_websocket, queue_to_base, queue_from_base, log))
+    writer = asyncio.create_task(write_to_base(
+        base_websocket, queue_to_base, stats, batch_window, batch_bytes, batch_compression,
+    ))
+    done, pending = await asyncio.wait({reader, writer}, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    errors = [task.exception() for task in done if task.exception()]
+    closed_with_error = [err for err in errors if isinstance(err, ConnectionClosedError)]
+    if closed_with_error:
+        log("Base disconnected (ERROR)")
+        log(str(closed_with_error[0]))
+    elif all(isinstance(err, ConnectionClosedOK) for err in errors):
+        log("Base disconnected (OK)")
+    else:
+        raise errors[0]
+
 def custom_log(message:str, verbose:bool, queue:Queue):
     if verbose:
         queue.put(Log(
@@ -78,17 +187,23 @@ class WebsocketHandler(TTask):
     """ Websocket server that binds to the given network interface & port.
         Anything in queue_to_base will be forwarded into the websocket.
         Anything that shows up in the websocket will be forwarded to queue_from_base.
+        Runs its own asyncio event loop in this thread.
+        Messages to base are coalesced into batches when `batch_window` is
+        set, see write_to_base().
     """
     def __init__(
         self,
         websocket_interface:str,
         websocket_port:int,
         ping_interval:int,
-        queue_to_base:Queue,
+        queue_to_base:OutboundQueue,
         queue_from_base:Queue,
         verbose:bool,
         shutdown_q:Queue,
         logging_q:Queue,
+        batch_window:float = 0.,
+        batch_bytes:int = 1024,
+        batch_compression:Optional[Literal["zlib"]] = None,
     ):
         super().__init__(name="WebsocketHandler")
         # Overriding self.meta for custom queues
@@ -108,19 +223,29 @@ class WebsocketHandler(TTask):
         self.ping_interval = ping_interval
         self.host = websocket_interface
         self.port = websocket_port
-    
+        self.batch_window = batch_window
+        self.batch_bytes = batch_bytes
+        self.batch_compression = batch_compression
+
     # Overriding run() since the websocket isn't a spinloop
     def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
         initialized_handler = functools.partial(
             socket_handler,
-            stop_event=self.meta.started_event,
-            ping_interval=self.ping_interval,
             queue_to_base=self.queue_to_base,
             queue_from_base=self.queue_from_base,
             log=self.log,
+            stats=self.stats,
+            batch_window=self.batch_window,
+            batch_bytes=self.batch_bytes,
+            batch_compression=self.batch_compression,
         )
         self.log("AUV websocket server is alive")
         self.log("Hosting on " + self.host + ":" + str(self.port))
-        with serve(initialized_handler, host=self.host, port=self.port, origins=None) as server:
-            self.shutdown_q.put(server.shutdown)
-            server.serve_forever()
+        loop = asyncio.get_running_loop()
+        async with serve(initialized_handler, host=self.host, port=self.port, origins=None) as server:
+            # Called from the main thread, so handed over to this loop
+            self.shutdown_q.put(lambda: loop.call_soon_threadsafe(server.close))
+            await server.wait_closed()
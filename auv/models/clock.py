@@ -0,0 +1,184 @@
+""" Time source for the simulation. Everything that reads or sleeps on time in
+    the simulated loop (MockController, Control, Mock_Localization) goes
+    through a Clock, so the same code can run against the real monotonic clock
+    or against a VirtualClock that runs as fast as the CPU allows.
+"""
+
+from typing import List, Optional, Tuple
+from abc import ABC as abc, abstractmethod
+from contextlib import contextmanager, nullcontext
+from time import monotonic, sleep
+from math import ceil
+import heapq
+import itertools
+import threading
+
+class Clock(abc):
+    """ Monotonic time in seconds plus a way to sleep on it. A task that sleeps
+        on a clock first join()s it and then uses the clock that returns.
+    """
+    @abstractmethod
+    def now(self) -> float:
+        raise NotImplementedError
+
+    @abstractmethod
+    def sleep(self, seconds: float):
+        raise NotImplementedError
+
+    def join(self, name: str) -> "Clock":
+        """ Registers a task that will sleep on this clock and returns the
+            clock it should use from then on.
+        """
+        return self
+
+    def leave(self):
+        """ Call when the task that joined is finished with the clock """
+        pass
+
+    def idle(self):
+        """ Context manager around anything the task blocks on other than this
+            clock (e.g. waiting to be re-enabled), so that time is not held up
+            waiting for the task meanwhile.
+        """
+        return nullcontext()
+
+    def wake(self):
+        """ Call from the thread that ends the task's idle() (e.g. just before
+            setting the event it waits on), so that time can't move on while
+            the task is waking up.
+        """
+        pass
+
+class RealClock(Clock):
+    """ The monotonic clock, with time.sleep() """
+    def now(self) -> float:
+        return monotonic()
+
+    def sleep(self, seconds: float):
+        if seconds > 0:
+            sleep(seconds)
+
+REAL_CLOCK = RealClock()
+
+class VirtualClock(Clock):
+    """ Simulated time advanced in lockstep by the tasks that joined it.
+
+        Time only moves when every joined task is asleep on the clock. It then
+        jumps straight to the earliest deadline (rounded up to a whole `tick`)
+        and wakes exactly one task, the one that was due first, ties going to
+        the task that joined first. Only one task ever runs at a time and the
+        order they run in depends only on their deadlines, so a run is
+        bit-for-bit reproducible and takes no longer than the work itself.
+
+        Reading the time (MockController does) needs no joining. Tasks that
+        sleep must join, and must leave() or be idle() whenever they block on
+        anything else, or time stops for everyone. Whoever ends a task's
+        idle() must wake() it first, or time may move on without it.
+    """
+    def __init__(self, tick: float = 0.0005, start: float = 0.):
+        if tick <= 0:
+            raise ValueError("tick must be positive")
+        self.tick = tick
+        self.start = start
+        self._ticks = 0
+        self._cond = threading.Condition()
+        self._active = 0 # Joined tasks that are not idle
+        self._sleepers: List[Tuple[int, int, "VirtualClockParticipant"]] = []
+        self._ids = itertools.count()
+
+    def now(self) -> float:
+        return self.start + self._ticks * self.tick
+
+    def sleep(self, seconds: float):
+        raise RuntimeError("join() the VirtualClock to sleep on it")
+
+    def to_ticks(self, deadline: float) -> int:
+        """ First tick at or after `deadline`. Deadlines built by adding
+            periods together are rounded first, so float error can't push
+            one past the tick it was meant to land on.
+        """
+        return ceil(round((deadline - self.start) / self.tick, 6))
+
+    def join(self, name: str) -> "VirtualClockParticipant":
+        with self._cond:
+            self._active += 1
+            return VirtualClockParticipant(self, next(self._ids), name)
+
+    def _sleep_until(self, participant: "VirtualClockParticipant", deadline: float):
+        target = self.to_ticks(deadline)
+        with self._cond:
+            if target <= self._ticks:
+                return
+            participant.wake_tick = target
+            heapq.heappush(self._sleepers, (target, participant.id, participant))
+            self._advance()
+            while participant.wake_tick is not None:
+                self._cond.wait()
+
+    def _release(self):
+        with self._cond:
+            self._active -= 1
+            self._advance()
+
+    def _idle_begin(self, participant: "VirtualClockParticipant"):
+        with self._cond:
+            participant.idling = True
+            self._active -= 1
+            self._advance()
+
+    def _idle_end(self, participant: "VirtualClockParticipant"):
+        with self._cond:
+            participant.idling = False
+            if participant.woken:
+                participant.woken = False # Already counted by _wake()
+            else:
+                self._active += 1
+
+    def _wake(self, participant: "VirtualClockParticipant"):
+        with self._cond:
+            if participant.idling and not participant.woken:
+                participant.woken = True
+                self._active += 1
+
+    def _advance(self):
+        """ With the lock held, wakes the next task once all are asleep """
+        if self._sleepers and len(self._sleepers) == self._active:
+            ticks, _, participant = heapq.heappop(self._sleepers)
+            self._ticks = max(self._ticks, ticks)
+            participant.wake_tick = None
+            self._cond.notify_all()
+
+class VirtualClockParticipant(Clock):
+    """ What a task gets from VirtualClock.join(). Only the task that joined
+        may sleep on it.
+    """
+    def __init__(self, clock: VirtualClock, id: int, name: str):
+        self.clock = clock
+        self.id = id
+        self.name = name
+        self.wake_tick: Optional[int] = None
+        self.joined = True
+        self.idling = False
+        self.woken = False
+
+    def now(self) -> float:
+        return self.clock.now()
+
+    def sleep(self, seconds: float):
+        self.clock._sleep_until(self, self.clock.now() + seconds)
+
+    def leave(self):
+        if self.joined:
+            self.joined = False
+            self.clock._release()
+
+    @contextmanager
+    def idle(self):
+        self.clock._idle_begin(self)
+        try:
+            yield
+        finally:
+            self.clock._idle_end(self)
+
+    def wake(self):
+        self.clock._wake(self)
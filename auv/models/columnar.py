@@ -0,0 +1,301 @@
+""" Columnar export of flight recordings (models/recorder.py) for analysis.
+
+    A recording is split into channels, one per record kind, and every column
+    of a channel is stored as its own series of .npy chunks:
+
+        <directory>/meta.json
+        <directory>/<channel>/<column>/<chunk:04d>.npy
+
+    so reading a few columns of a long dive only touches those files, and
+    every channel has a `timestamp` column (seconds, the recorder's clock) as
+    its time index. meta.json lists each channel's columns and, per chunk,
+    its row count and first and last timestamp, so a time range only loads
+    the chunks that overlap it. Text channels (commands, task events, NMEA
+    lines) are stored like Arrow strings: UTF-8 bytes in `data` and int64
+    `offsets` into them, one more than the rows.
+
+    ColumnarWriter takes records as they come, a chunk at a time, so a run
+    of any length is converted in bounded memory. Read back with
+    read_channel(), or to_dataframe() for pandas.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple, Union
+from pathlib import Path
+import json
+
+import numpy as np
+
+try:
+    from .recorder import (
+        RECORD_DTYPE, TEXT_BYTES, read_chunk, chunk_paths,
+        KIND_STATE, KIND_MOTORS, KIND_COMMAND, KIND_TASK, KIND_GAP,
+        KIND_TICK, KIND_ACCEL, KIND_GYRO, KIND_MAG, KIND_DEPTH, KIND_NMEA,
+    )
+except:
+    from recorder import (
+        RECORD_DTYPE, TEXT_BYTES, read_chunk, chunk_paths,
+        KIND_STATE, KIND_MOTORS, KIND_COMMAND, KIND_TASK, KIND_GAP,
+        KIND_TICK, KIND_ACCEL, KIND_GYRO, KIND_MAG, KIND_DEPTH, KIND_NMEA,
+    )
+
+FORMAT = "auv-columnar"
+FORMAT_VERSION = 1
+
+STATE_COLUMNS = [
+    name + "_" + axis
+    for name in ("position", "velocity", "attitude", "angular_velocity")
+    for axis in "xyz"
+]
+
+# Channel name: record kind and the columns its data holds, in order
+NUMERIC_CHANNELS: Dict[str, Tuple[int, List[str]]] = {
+    "state": (KIND_STATE, STATE_COLUMNS),
+    "motors": (KIND_MOTORS, ["forward", "turn", "front", "back"]),
+    "gap": (KIND_GAP, ["lost"]),
+    "tick": (KIND_TICK, ["prev_time", "cur_time", "written"]),
+    "accel": (KIND_ACCEL, ["x", "y", "z"]),
+    "gyro": (KIND_GYRO, ["x", "y", "z"]),
+    "mag": (KIND_MAG, ["x", "y", "z"]),
+    "depth": (KIND_DEPTH, ["depth"]),
+}
+# Channels that also keep the record's history sequence number
+SEQUENCE_CHANNELS = {"state", "gap"}
+TEXT_CHANNELS: Dict[str, int] = {
+    "command": KIND_COMMAND,
+    "task": KIND_TASK,
+    "nmea": KIND_NMEA,
+}
+
+class ColumnarWriter:
+    """ Writes records into the layout above, `chunk_rows` rows per chunk.
+        Call write() with consecutive slices of a recording, then close().
+    """
+    def __init__(
+        self,
+        directory: Union[str, Path],
+        chunk_rows: int = 1 << 16,
+        source: Optional[List[str]] = None,
+    ):
+        self.directory = Path(directory)
+        self.chunk_rows = chunk_rows
+        self.source = source or []
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.numeric: Dict[str, List[np.ndarray]] = {name: [] for name in NUMERIC_CHANNELS}
+        self.text: Dict[str, List[Tuple[float, bytes]]] = {name: [] for name in TEXT_CHANNELS}
+        self.chunks: Dict[str, List[Dict[str, Any]]] = {
+            name: [] for name in list(NUMERIC_CHANNELS) + list(TEXT_CHANNELS)
+        }
+        # Head of a text record whose continuation hasn't arrived yet
+        self._carry = np.zeros(0, dtype=RECORD_DTYPE)
+
+    def write(self, records: np.ndarray):
+        if len(self._carry):
+            records = np.concatenate((self._carry, records))
+            self._carry = records[:0]
+        kinds = records["kind"]
+        text_heads = np.flatnonzero(np.isin(kinds, list(TEXT_CHANNELS.values())))
+        if len(text_heads):
+            last = int(text_heads[-1])
+            needed = max(1, -(-int(records["length"][last]) // TEXT_BYTES))
+            if last + needed > len(records):
+                self._carry = np.array(records[last:])
+                records = records[:last]
+                kinds = kinds[:last]
+                text_heads = text_heads[:-1]
+        for name, (kind, _) in NUMERIC_CHANNELS.items():
+            selected = records[kinds == kind]
+            if len(selected):
+                self.numeric[name].append(np.array(selected))
+                self._flush_numeric(name, final=False)
+        if len(text_heads):
+            last = int(text_heads[-1])
+            stop = last + max(1, -(-int(records["length"][last]) // TEXT_BYTES))
+            raw = np.ascontiguousarray(records["data"][:stop]).view(np.uint8).reshape(-1)
+            for name, kind in TEXT_CHANNELS.items():
+                rows = self.text[name]
+                for index in text_heads[kinds[text_heads] == kind]:
+                    begin = int(index) * TEXT_BYTES
+                    rows.append((
+                        float(records["timestamp"][index]),
+                        raw[begin:begin + int(records["length"][index])].tobytes(),
+                    ))
+                if len(rows) >= self.chunk_rows:
+                    self._flush_text(name)
+
+    def close(self):
+        """ Writes out what's left and meta.json """
+        for name in NUMERIC_CHANNELS:
+            self._flush_numeric(name, final=True)
+        for name in TEXT_CHANNELS:
+            self._flush_text(name)
+        channels: Dict[str, Any] = {}
+        for name, (_, columns) in NUMERIC_CHANNELS.items():
+            channels[name] = {
+                "type": "numeric",
+                "columns": ["timestamp"] + (["sequence"] if name in SEQUENCE_CHANNELS else []) + columns,
+                "chunks": self.chunks[name],
+            }
+        for name in TEXT_CHANNELS:
+            channels[name] = {
+                "type": "text",
+                "columns": ["timestamp", "offsets", "data"],
+                "chunks": self.chunks[name],
+            }
+        with open(self.directory / "meta.json", "w") as file:
+            json.dump({
+                "format": FORMAT,
+                "version": FORMAT_VERSION,
+                "source": self.source,
+                "channels": channels,
+            }, file, indent=2)
+
+    def _flush_numeric(self, name: str, final: bool):
+        pending = self.numeric[name]
+        rows = sum(len(part) for part in pending)
+        if rows == 0 or (rows < self.chunk_rows and not final):
+            return
+        records = np.concatenate(pending)
+        pending.clear()
+        while len(records) >= self.chunk_rows or (final and len(records)):
+            chunk, records = records[:self.chunk_rows], records[self.chunk_rows:]
+            columns = {"timestamp": chunk["timestamp"]}
+            if name in SEQUENCE_CHANNELS:
+                columns["sequence"] = chunk["sequence"]
+            for index, column in enumerate(NUMERIC_CHANNELS[name][1]):
+                columns[column] = chunk["data"][:, index]
+            self._save(name, columns)
+        if len(records):
+            pending.append(records)
+
+    def _flush_text(self, name: str):
+        rows = self.text[name]
+        while rows:
+            chunk, rows = rows[:self.chunk_rows], rows[self.chunk_rows:]
+            lengths = np.array([len(text) for _, text in chunk], dtype=np.int64)
+            offsets = np.zeros(len(chunk) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            self._save(name, {
+                "timestamp": np.array([timestamp for timestamp, _ in chunk], dtype=np.float64),
+                "offsets": offsets,
+                "data": np.frombuffer(b"".join(text for _, text in chunk), dtype=np.uint8),
+            })
+        self.text[name] = []
+
+    def _save(self, name: str, columns: Dict[str, np.ndarray]):
+        chunks = self.chunks[name]
+        timestamps = columns["timestamp"]
+        for column, values in columns.items():
+            path = self.directory / name / column
+            path.mkdir(parents=True, exist_ok=True)
+            np.save(path / (str(len(chunks)).zfill(4) + ".npy"), np.ascontiguousarray(values))
+        chunks.append({
+            "rows": len(timestamps),
+            "start": float(timestamps.min()),
+            "end": float(timestamps.max()),
+        })
+
+def export(
+    paths: List[Path],
+    directory: Union[str, Path],
+    chunk_rows: int = 1 << 16,
+    batch: int = 1 << 16,
+) -> Path:
+    """ Converts the chunk files of one recording (see chunk_paths()) into a
+        columnar directory, reading `batch` records at a time
+    """
+    writer = ColumnarWriter(directory, chunk_rows, source=[path.name for path in paths])
+    for path in paths:
+        records = read_chunk(path)
+        for begin in range(0, len(records), batch):
+            writer.write(records[begin:begin + batch])
+    writer.close()
+    return Path(directory)
+
+def read_meta(directory: Union[str, Path]) -> Dict[str, Any]:
+    with open(Path(directory) / "meta.json") as file:
+        meta = json.load(file)
+    if meta.get("format") != FORMAT or meta.get("version") != FORMAT_VERSION:
+        raise ValueError(str(directory) + " is not a columnar export this version can read")
+    return meta
+
+def read_channel(
+    directory: Union[str, Path],
+    channel: str,
+    columns: Optional[List[str]] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+) -> Dict[str, np.ndarray]:
+    """ Columns of `channel` (all by default, always with `timestamp`) for
+        the rows with start <= timestamp <= end. Only the chunks and columns
+        asked for are read. A text channel's `text` column is an object
+        array of str.
+    """
+    meta = read_meta(directory)
+    if channel not in meta["channels"]:
+        raise ValueError("Unknown channel: " + channel)
+    info = meta["channels"][channel]
+    text = info["type"] == "text"
+    available = ["timestamp", "text"] if text else info["columns"]
+    wanted = list(available) if columns is None else ["timestamp"] + [c for c in columns if c != "timestamp"]
+    unknown = set(wanted) - set(available)
+    if unknown:
+        raise ValueError("Unknown columns: " + ", ".join(sorted(unknown)))
+    base = Path(directory) / channel
+    parts: Dict[str, List[np.ndarray]] = {column: [] for column in wanted}
+    for index, chunk in enumerate(info["chunks"]):
+        if (start is not None and chunk["end"] < start) or (end is not None and chunk["start"] > end):
+            continue
+        name = str(index).zfill(4) + ".npy"
+        timestamps = np.load(base / "timestamp" / name, mmap_mode="r")
+        keep = np.ones(len(timestamps), dtype=bool)
+        if start is not None:
+            keep &= timestamps >= start
+        if end is not None:
+            keep &= timestamps <= end
+        for column in wanted:
+            if column == "text":
+                offsets = np.load(base / "offsets" / name)
+                data = np.load(base / "data" / name, mmap_mode="r").tobytes()
+                rows = np.flatnonzero(keep)
+                values = np.array([
+                    data[offsets[row]:offsets[row + 1]].decode() for row in rows
+                ], dtype=object)
+            else:
+                values = np.load(base / column / name, mmap_mode="r")[keep]
+            parts[column].append(values)
+    result: Dict[str, np.ndarray] = {}
+    for column in wanted:
+        if parts[column]:
+            result[column] = np.concatenate(parts[column])
+        elif column == "text":
+            result[column] = np.zeros(0, dtype=object)
+        else:
+            result[column] = np.zeros(0, dtype=np.uint32 if column == "sequence" else np.float64)
+    return result
+
+def to_dataframe(
+    directory: Union[str, Path],
+    channel: str,
+    columns: Optional[List[str]] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+):
+    """ read_channel() as a pandas DataFrame indexed by timestamp """
+    import pandas as pd
+    result = read_channel(directory, channel, columns, start, end)
+    timestamps = result.pop("timestamp")
+    return pd.DataFrame(result, index=pd.Index(timestamps, name="timestamp"))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Export flight recordings to columnar .npy chunks")
+    parser.add_argument("directory", nargs="?", default="data/recordings")
+    parser.add_argument("output", nargs="?", help="where to export to, the recording directory by default")
+    parser.add_argument("--chunk-rows", type=int, default=1 << 16)
+    args = parser.parse_args()
+    output = Path(args.output or args.directory)
+    for name in ("flight", "sensors"):
+        paths = chunk_paths(args.directory, name=name)
+        if paths:
+            prefix = paths[0].name.rsplit("_", 1)[0]
+            print("Exported " + str(export(paths, output / prefix, args.chunk_rows)))
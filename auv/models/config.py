@@ -0,0 +1,47 @@
+""" The AUV's configuration: data/config.yaml, with whatever
+    data/local/config.yaml sets on top of it.
+"""
+
+from typing import Dict, Literal, Optional, Union
+from pathlib import Path
+
+from pydantic import BaseModel
+from pydantic_yaml import parse_yaml_file_as
+from ruamel.yaml import YAML
+yaml = YAML(typ='safe')
+
+class ConfigSchema(BaseModel):
+    simulation: bool
+    socket_ip: str
+    socket_port: int
+    perception: bool
+    video_ip: str
+    video_port: int
+    camera_path: str
+    ping_interval: int
+    gps_path: str
+    stats_interval: float
+    virtual_time: bool
+    sensor_emulation: bool
+    telemetry_rates: Dict[str, float]
+    batch_window: float
+    batch_bytes: int
+    batch_compression: Optional[Literal["zlib"]]
+    recorder_path: Optional[str]
+    recorder_chunk_records: int
+
+def load_config(directory: Union[str, Path] = 'data') -> ConfigSchema:
+    """ Every key in the local config replaces the default, including ones
+        set to null, false, or 0 (e.g. `recorder_path: null` turns the
+        recorder off)
+    """
+    directory = Path(directory)
+    default_config = parse_yaml_file_as(ConfigSchema, directory / 'config.yaml').model_dump()
+    local_path = directory / 'local' / 'config.yaml'
+    if local_path.exists():
+        local_file = open(local_path, 'r')
+        local_config = yaml.load(local_file)
+        local_file.close()
+        if local_config:
+            default_config.update(local_config)
+    return ConfigSchema(**default_config)
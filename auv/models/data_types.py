@@ -51,14 +51,14 @@ class MotorSpeeds(BaseModel):
 class Log(msgspec.Struct):
     source: Literal["MAIN", "CTRL", "NAV", "WSKT", "LCAL", "PRCP"]
     type: str
-    content: Union[State, SerialState, dict, str]
+    content: Union[State, SerialState, dict, str, bytes] # bytes are telemetry frames
     dest: Union[Literal["BASE", "LOG"], str] = "LOG"
 
 class Promise(msgspec.Struct):
     """ This is a not really a javascript-style "Promise" but is instead a
-        simple scheduled callback. If appended to the promises array of the
-        main loop, the callback function will be called after the approximate
-        time of the duration has elapsed. 
+        simple scheduled callback. Passed to TimerService.add(), the callback
+        is called once `duration` seconds have passed since it was created.
+        Only for use within the AUV, since a callback can't come from base.
     """
     name: str
     duration: float
@@ -0,0 +1,41 @@
+""" Lets the main loop block on several queues at once. Every queue the main
+    loop reads from is a NotifyingQueue sharing one threading.Event, so the
+    loop can sleep on that event (with a timeout for the next timer) instead
+    of polling each queue with get_nowait().
+"""
+
+from typing import Union
+from queue import Queue
+import multiprocessing.queues
+import threading
+
+class NotifyingQueue(Queue):
+    """ A queue.Queue that sets `wakeup` whenever something is put into it.
+    """
+    def __init__(self, wakeup: threading.Event, maxsize: int = 0):
+        super().__init__(maxsize=maxsize)
+        self.wakeup = wakeup
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block=block, timeout=timeout)
+        self.wakeup.set()
+
+def forward_queue(
+    source: Union[multiprocessing.queues.Queue, Queue],
+    destination: Queue,
+    name: str = "QueueForwarder",
+) -> threading.Thread:
+    """ Starts a daemon thread that blocks on `source` and moves everything
+        into `destination`. Used to bring multiprocessing queues, which cannot
+        set a threading.Event from the child process, into the main loop.
+        Putting None into `source` stops the thread.
+    """
+    def forward():
+        while True:
+            item = source.get()
+            if item is None:
+                return
+            destination.put(item)
+    thread = threading.Thread(target=forward, name=name, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,163 @@
+from typing import Optional, Dict, Any
+import multiprocessing
+from time import perf_counter_ns
+
+import numpy as np
+
+try:
+    from .scheduler import RateScheduler
+except:
+    from scheduler import RateScheduler
+
+# HDR-style log-linear histogram over integer microseconds. Values below
+# SUB_BUCKETS get a bucket each, and every power of two above that is split
+# into SUB_BUCKETS/2 linear buckets, so any recorded value is known to within
+# ~6% no matter its magnitude. The top bucket holds everything from ~35 min up.
+SUB_BUCKETS = 32
+HALF_SUB_BUCKETS = SUB_BUCKETS // 2
+SUB_BUCKET_BITS = SUB_BUCKETS.bit_length() - 1
+HISTOGRAM_BUCKETS = SUB_BUCKETS + 26 * HALF_SUB_BUCKETS
+
+def bucket_index(value_us: int) -> int:
+    """ Histogram bucket for a non-negative value in microseconds """
+    if value_us < SUB_BUCKETS:
+        return value_us
+    shift = value_us.bit_length() - SUB_BUCKET_BITS
+    index = SUB_BUCKETS + (shift - 1) * HALF_SUB_BUCKETS \
+        + (value_us >> shift) - HALF_SUB_BUCKETS
+    return min(index, HISTOGRAM_BUCKETS - 1)
+
+def bucket_value(index: int) -> int:
+    """ Lowest value in microseconds that falls into bucket `index` """
+    if index < SUB_BUCKETS:
+        return index
+    shift = (index - SUB_BUCKETS) // HALF_SUB_BUCKETS + 1
+    return ((index - SUB_BUCKETS) % HALF_SUB_BUCKETS + HALF_SUB_BUCKETS) << shift
+
+def percentile(counts: np.ndarray, p: float) -> float:
+    """ Approximate `p`th percentile (0-100) in microseconds of a histogram """
+    total = int(counts.sum())
+    if total == 0:
+        return 0.
+    cumulative = np.cumsum(counts)
+    index = int(np.searchsorted(cumulative, total * p / 100.))
+    return float(bucket_value(min(index, HISTOGRAM_BUCKETS - 1)))
+
+# Layout of the int64 buffer behind LoopStats
+ITERATIONS = 0
+OVERRUNS = 1
+MISSED = 2
+MAX_LATENESS_NS = 3
+LAST_EXEC_NS = 4
+MAX_EXEC_NS = 5
+LAST_PERIOD_NS = 6
+MAX_PERIOD_NS = 7
+COUNTERS = 8
+PERIOD_HIST = COUNTERS
+EXEC_HIST = COUNTERS + HISTOGRAM_BUCKETS
+STATS_LENGTH = COUNTERS + 2 * HISTOGRAM_BUCKETS
+
+class LoopStats:
+    """ Timing instrumentation for the loop of a task: iteration count, the
+        period between iterations and the execution time of each iteration
+        (both as histograms), and the overruns of the task's RateScheduler.
+
+        Everything lives in one flat int64 buffer. For a PTask it is a
+        multiprocessing.Array created before the fork, so the main process can
+        read the stats the child writes without any messages passing between
+        them. The single writer is the task itself; readers may see a
+        snapshot that is an iteration out of date, which is fine for stats.
+
+        Usage from a run() loop:
+            stats.begin()
+            loop()
+            stats.end(scheduler)
+    """
+    def __init__(self, shared: bool = False):
+        if shared:
+            self._backing = multiprocessing.Array("q", STATS_LENGTH, lock=False)
+        else:
+            self._backing = np.zeros(STATS_LENGTH, dtype=np.int64)
+        self._buffer: Optional[np.ndarray] = None
+        self._last_begin = 0
+        self._start = 0
+
+    @property
+    def buffer(self) -> np.ndarray:
+        # Created lazily so that a PTask builds its view after the fork
+        if self._buffer is None:
+            self._buffer = np.frombuffer(self._backing, dtype=np.int64) \
+                if not isinstance(self._backing, np.ndarray) else self._backing
+        return self._buffer
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_buffer"] = None
+        return state
+
+    def begin(self):
+        """ Call at the start of every iteration """
+        buffer = self.buffer
+        now = perf_counter_ns()
+        if self._last_begin:
+            period = now - self._last_begin
+            buffer[LAST_PERIOD_NS] = period
+            if period > buffer[MAX_PERIOD_NS]:
+                buffer[MAX_PERIOD_NS] = period
+            buffer[PERIOD_HIST + bucket_index(period // 1000)] += 1
+        self._last_begin = now
+        self._start = now
+
+    def end(self, scheduler: Optional[RateScheduler] = None):
+        """ Call at the end of every iteration, before the scheduler waits.
+            Does nothing if begin() was not called since the last end().
+        """
+        if not self._start:
+            return
+        buffer = self.buffer
+        elapsed = perf_counter_ns() - self._start
+        self._start = 0
+        buffer[ITERATIONS] += 1
+        buffer[LAST_EXEC_NS] = elapsed
+        if elapsed > buffer[MAX_EXEC_NS]:
+            buffer[MAX_EXEC_NS] = elapsed
+        buffer[EXEC_HIST + bucket_index(elapsed // 1000)] += 1
+        if scheduler:
+            buffer[OVERRUNS] = scheduler.overruns
+            buffer[MISSED] = scheduler.missed
+            buffer[MAX_LATENESS_NS] = int(scheduler.max_lateness * 1e9)
+
+    def pause(self):
+        """ Call when the loop resumes after being disabled, so the time spent
+            disabled is not recorded as one very long period.
+        """
+        self._last_begin = 0
+        self._start = 0
+
+    def summary(self) -> Dict[str, Any]:
+        """ JSON-friendly snapshot of the stats, times in microseconds """
+        buffer = self.buffer.copy()
+        period = buffer[PERIOD_HIST:PERIOD_HIST + HISTOGRAM_BUCKETS]
+        execution = buffer[EXEC_HIST:EXEC_HIST + HISTOGRAM_BUCKETS]
+        return {
+            "iterations": int(buffer[ITERATIONS]),
+            "overruns": int(buffer[OVERRUNS]),
+            "missed": int(buffer[MISSED]),
+            "max_lateness_us": float(buffer[MAX_LATENESS_NS]) / 1000.,
+            "period_us": {
+                "last": float(buffer[LAST_PERIOD_NS]) / 1000.,
+                "p50": percentile(period, 50),
+                "p99": percentile(period, 99),
+                "max": float(buffer[MAX_PERIOD_NS]) / 1000.,
+            },
+            "exec_us": {
+                "last": float(buffer[LAST_EXEC_NS]) / 1000.,
+                "p50": percentile(execution, 50),
+                "p99": percentile(execution, 99),
+                "max": float(buffer[MAX_EXEC_NS]) / 1000.,
+            },
+        }
+
+    def reset(self):
+        self.buffer[:] = 0
+        self.pause()
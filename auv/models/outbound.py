@@ -0,0 +1,145 @@
+""" The queue between the AUV and one destination (the base link), which
+    decides what gets sent and when instead of dropping whatever doesn't fit.
+"""
+
+from typing import Any, Callable, Deque, Dict, List, Literal, Optional
+from collections import deque
+from queue import Empty
+from time import monotonic
+import threading
+
+Priority = Literal["critical", "telemetry", "normal"]
+
+class OutboundQueue:
+    """ Queue-like buffer of messages for one destination, with three priority
+        classes that are always served in this order:
+        * "critical" - commands, acks, and errors, sent in order. Only dropped
+          if more than `critical_size` pile up (e.g. while the link is down),
+          oldest first, and counted in `dropped["critical"]`
+        * "telemetry" - only the latest message per topic is kept, and each
+          topic is sent at most at its rate in `rates` (Hz). Topics without a
+          rate are sent as fast as the destination takes them, still latest
+          only. Superseded samples are counted in `dropped["telemetry"]`
+        * "normal" - everything else, in order, keeping the newest
+          `normal_size` if the destination falls behind (e.g. while the link
+          is down). Dropped ones are counted in `dropped["normal"]`
+
+        Thread safe. Has the parts of the queue.Queue API that the websocket
+        handler and the main loop use, and put() never blocks or raises Full.
+        Consumers that can't block a thread on get() (e.g. an asyncio loop)
+        can add_listener() to be called after every put() instead, and sleep
+        for time_until_ready() in between.
+    """
+    def __init__(
+        self,
+        rates: Optional[Dict[str, float]] = None,
+        normal_size: int = 256,
+        critical_size: int = 4096,
+        clock: Callable[[], float] = monotonic,
+    ):
+        self.periods: Dict[str, float] = {
+            topic: 1. / rate for topic, rate in (rates or {}).items() if rate > 0
+        }
+        self.clock = clock
+        self._cond = threading.Condition()
+        self._critical: Deque[Any] = deque(maxlen=critical_size)
+        self._normal: Deque[Any] = deque(maxlen=normal_size)
+        self._latest: Dict[str, Any] = {}
+        self._next_due: Dict[str, float] = {}
+        self.dropped: Dict[str, int] = {"critical": 0, "telemetry": 0, "normal": 0}
+        self._listeners: List[Callable[[], None]] = []
+
+    def put(self, item: Any, priority: Priority = "normal", topic: Optional[str] = None):
+        with self._cond:
+            if priority == "critical":
+                if len(self._critical) == self._critical.maxlen:
+                    self.dropped["critical"] += 1
+                self._critical.append(item)
+            elif priority == "telemetry":
+                if topic is None:
+                    raise ValueError("telemetry needs a topic")
+                if topic in self._latest:
+                    self.dropped["telemetry"] += 1
+                self._latest[topic] = item
+            else:
+                if len(self._normal) == self._normal.maxlen:
+                    self.dropped["normal"] += 1
+                self._normal.append(item)
+            self._cond.notify()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    put_nowait = put
+
+    def add_listener(self, callback: Callable[[], None]):
+        """ Calls `callback` (from the putting thread) after every put() """
+        with self._cond:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback: Callable[[], None]):
+        with self._cond:
+            self._listeners.remove(callback)
+
+    def _pop(self, now: float) -> Any:
+        """ Next message to send, or None. Called with the lock held """
+        if self._critical:
+            return self._critical.popleft()
+        for topic in self._latest:
+            due = self._next_due.get(topic, now)
+            if now >= due:
+                period = self.periods.get(topic)
+                if period:
+                    # Stay on the grid of the rate unless a whole period behind
+                    self._next_due[topic] = due + period if now - due < period else now + period
+                return self._latest.pop(topic)
+        if self._normal:
+            return self._normal.popleft()
+        return None
+
+    def _wait_time(self, now: float) -> Optional[float]:
+        """ Seconds until the next rate limited topic is due, None if nothing
+            is pending. Called with the lock held.
+        """
+        waits = [self._next_due.get(topic, now) - now for topic in self._latest]
+        return max(min(waits), 0.) if waits else None
+
+    def time_until_ready(self) -> Optional[float]:
+        """ Seconds until get() would return something, 0 if it would now,
+            None if nothing is pending at all.
+        """
+        with self._cond:
+            if self._critical or self._normal:
+                return 0.
+            return self._wait_time(self.clock())
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Any:
+        """ Returns the next message to send. Raises queue.Empty if there is
+            none (within `timeout` if blocking).
+        """
+        with self._cond:
+            deadline = None if timeout is None else self.clock() + timeout
+            while True:
+                now = self.clock()
+                item = self._pop(now)
+                if item is not None:
+                    return item
+                if not block:
+                    raise Empty
+                wait = self._wait_time(now)
+                if deadline is not None:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise Empty
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._cond.wait(wait)
+
+    def get_nowait(self) -> Any:
+        return self.get(block=False)
+
+    def qsize(self) -> int:
+        with self._cond:
+            return len(self._critical) + len(self._latest) + len(self._normal)
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
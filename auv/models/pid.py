@@ -0,0 +1,158 @@
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+from numpy import ndarray as arr
+from numpy import float64 as f64
+
+ArrayLike = Union[float, Sequence[float], arr]
+
+def wrap_degrees(x: arr, out: arr) -> arr:
+    """ Wraps angles in degrees to [-180, 180) """
+    np.add(x, 540., out=out)
+    np.mod(out, 360., out=out)
+    out -= 180.
+    return out
+
+class VectorPID:
+    """ PID controller for any number of axes at once, optionally for a batch
+        of independent controllers (`batch` is prepended to the shape of the
+        gains, e.g. batch=(N,) for N vehicles with 6 axes each).
+
+        All state lives in preallocated arrays and update() is a handful of
+        in-place NumPy operations, so the cost per tick barely depends on the
+        number of axes. The gains are plain arrays (Kp, Ki, Kd) that can be
+        changed at any time, directly or with set_gains().
+
+        * Axes set in `wrap` are angles in degrees, their error and derivative
+          are wrapped to [-180, 180)
+        * Anti-windup: the integral is clamped to +/- `windup`, and with an
+          `output_limit` it stops integrating on an axis whose output is
+          saturated in the direction the error pushes it
+        * The derivative is on the measurement by default, so setpoint steps
+          don't kick, and is low-pass filtered with time constant
+          `derivative_filter` seconds (0 disables the filter)
+    """
+    def __init__(
+        self,
+        Kp: ArrayLike,
+        Ki: ArrayLike,
+        Kd: ArrayLike,
+        wrap: Optional[Sequence[bool]] = None,
+        windup: ArrayLike = np.inf,
+        output_limit: ArrayLike = np.inf,
+        derivative_filter: float = 0.,
+        derivative_on_measurement: bool = True,
+        batch: Tuple[int, ...] = (),
+    ):
+        self.Kp = np.array(Kp, dtype=f64, ndmin=1)
+        axes = self.Kp.shape
+        self.Ki = np.broadcast_to(np.asarray(Ki, dtype=f64), axes).copy()
+        self.Kd = np.broadcast_to(np.asarray(Kd, dtype=f64), axes).copy()
+        self.wrap = np.zeros(axes, dtype=bool) if wrap is None \
+            else np.broadcast_to(np.asarray(wrap, dtype=bool), axes).copy()
+        self.windup = np.broadcast_to(np.asarray(windup, dtype=f64), axes).copy()
+        self.output_limit = np.broadcast_to(np.asarray(output_limit, dtype=f64), axes).copy()
+        self.derivative_filter = derivative_filter
+        self.derivative_on_measurement = derivative_on_measurement
+
+        shape = tuple(batch) + axes
+        self.error = np.zeros(shape, dtype=f64)
+        self.integral = np.zeros(shape, dtype=f64)
+        self.derivative = np.zeros(shape, dtype=f64) # Filtered
+        self.output = np.zeros(shape, dtype=f64)
+        self._last = np.zeros(shape, dtype=f64) # Last measurement (or error)
+        self._raw = np.zeros(shape, dtype=f64)
+        self._tmp = np.zeros(shape, dtype=f64)
+        self._hold = np.zeros(shape, dtype=bool)
+        self._primed = False
+
+    def set_gains(
+        self,
+        index,
+        p: Optional[float] = None,
+        i: Optional[float] = None,
+        d: Optional[float] = None,
+    ):
+        """ Changes the gains of the axis (or axes) at `index` """
+        if p is not None:
+            self.Kp[index] = p
+        if i is not None:
+            self.Ki[index] = i
+        if d is not None:
+            self.Kd[index] = d
+
+    def reset(self):
+        """ Clears the integral and derivative, e.g. after being disabled """
+        self.integral[...] = 0.
+        self.derivative[...] = 0.
+        self._primed = False
+
+    def _wrap(self, x: arr):
+        if self.wrap.any():
+            np.copyto(x, wrap_degrees(x, self._tmp), where=self.wrap)
+
+    def update(
+        self,
+        setpoint: ArrayLike,
+        measurement: ArrayLike,
+        dt: float,
+        rate: Optional[arr] = None,
+    ) -> arr:
+        """ Advances the controller by `dt` seconds and returns the output
+            (self.output, overwritten on the next update). If the rate of
+            change of the measurement is known (e.g. from the state history)
+            pass it as `rate` instead of having it differenced here.
+        """
+        err = self.error
+        np.subtract(setpoint, measurement, out=err)
+        self._wrap(err)
+
+        # Derivative
+        raw = self._raw
+        if rate is not None:
+            np.negative(rate, out=raw)
+        elif not self._primed or dt <= 0:
+            raw[...] = 0.
+        elif self.derivative_on_measurement:
+            np.subtract(self._last, measurement, out=raw)
+            self._wrap(raw)
+            raw /= dt
+        else:
+            np.subtract(err, self._last, out=raw)
+            raw /= dt
+        if self.derivative_on_measurement:
+            self._last[...] = measurement
+        else:
+            self._last[...] = err
+        if self.derivative_filter > 0 and self._primed:
+            # First order low-pass
+            alpha = dt / (self.derivative_filter + dt)
+            raw -= self.derivative
+            raw *= alpha
+            self.derivative += raw
+        else:
+            self.derivative[...] = raw
+        self._primed = True
+
+        # P + D, then the integral if it would not push a saturated output
+        # further into saturation
+        output = self.output
+        tmp = self._tmp
+        np.multiply(self.Kp, err, out=output)
+        np.multiply(self.Kd, self.derivative, out=tmp)
+        output += tmp
+        np.multiply(err, dt, out=tmp)
+        self.integral += tmp
+        np.clip(self.integral, -self.windup, self.windup, out=self.integral)
+        if np.isfinite(self.output_limit).any():
+            hold = self._hold
+            np.multiply(self.Ki, self.integral, out=tmp)
+            tmp += output
+            np.greater(np.abs(tmp), self.output_limit, out=hold)
+            hold &= (tmp * err) > 0
+            np.multiply(err, dt, out=tmp)
+            np.subtract(self.integral, tmp, out=self.integral, where=hold)
+        np.multiply(self.Ki, self.integral, out=tmp)
+        output += tmp
+        np.clip(output, -self.output_limit, self.output_limit, out=output)
+        return output
@@ -0,0 +1,445 @@
+""" Flight data recorder: an append-only binary log of every state, motor
+    output, command from base, and task event of a run, and (in a separate
+    "sensors" recording made by the localization process) of every raw
+    sensor sample, for replaying the run offline (see api/replay.py).
+
+    Records are fixed size (RECORD_DTYPE, 112 bytes) and written into chunk
+    files that are memory-mapped and preallocated, so writing one is a memory
+    copy. Producers never touch the files: they append a tuple to a bounded
+    deque (about a microsecond, no lock), and a background thread moves
+    everything into the current chunk every `flush_interval`. States aren't even passed
+    in, the thread tails the state history ring in shared memory, so every
+    State written by localization (in any process) is recorded at no cost to
+    the writer.
+
+    Chunk files are named <name>_<start>_<chunk:04d>.fdr, and each starts with a
+    CHUNK_HEADER_BYTES header (CHUNK_HEADER_DTYPE) whose `count` is the
+    number of valid records. A chunk that was not closed cleanly still has
+    every record up to the last flush. Use load() to read a recording.
+
+    Record kinds and what their fields hold:
+        KIND_STATE    sequence: history sequence, data: position, velocity,
+                      attitude, angular_velocity
+        KIND_MOTORS   data[:4]: forward, turn, front, back
+        KIND_COMMAND  the command from base as JSON text (see below)
+        KIND_TASK     "<task name> <event>" as text (see below)
+        KIND_GAP      sequence: first lost history sequence, data[0]: how
+                      many states were lost because the ring lapped the
+                      recorder (it falls further behind than `slots`). With
+                      sequence 0, data[0] is how many of the other records
+                      were lost because the writer fell `pending_size`
+                      behind (e.g. stalled on slow storage)
+    and in sensor recordings:
+        KIND_TICK     data[:3]: prev_time and cur_time given to localize(),
+                      and the timestamp its State was written with. Written
+                      after the tick's samples, so those of a tick are the
+                      ones since the KIND_TICK before it
+        KIND_ACCEL    data[:3]: raw acceleration as read from the IMU
+        KIND_GYRO     data[:3]: raw angular velocity as read from the IMU
+        KIND_MAG      data[:3]: raw magnetic field as read (uncalibrated)
+        KIND_DEPTH    data[0]: depth as read
+        KIND_NMEA     a line read from the GPS serial port as text, bytes
+                      mapped 1:1 to characters (latin-1) so it round trips
+    Text is UTF-8, `length` bytes long, packed into the 96 bytes of `data`
+    of the record and of as many KIND_TEXT records as needed right after it.
+"""
+
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple, Union
+from collections import deque
+from pathlib import Path
+from time import monotonic, time
+import json
+import mmap
+import threading
+
+import numpy as np
+
+try:
+    from .shared_memory import StateHistoryHandle, HISTORY_DTYPE
+    from .data_types import MotorSpeeds
+except:
+    from shared_memory import StateHistoryHandle, HISTORY_DTYPE
+    from data_types import MotorSpeeds
+
+FORMAT_VERSION = 1
+MAGIC = b"AUVFDR" # Null padded to 8 bytes
+
+KIND_STATE = 1
+KIND_MOTORS = 2
+KIND_COMMAND = 3
+KIND_TASK = 4
+KIND_GAP = 5
+KIND_TEXT = 6 # Continuation of the text of the record before it
+KIND_TICK = 7
+KIND_ACCEL = 8
+KIND_GYRO = 9
+KIND_MAG = 10
+KIND_DEPTH = 11
+KIND_NMEA = 12
+
+TEXT_KINDS = {KIND_COMMAND, KIND_TASK, KIND_NMEA}
+
+RECORD_DTYPE = np.dtype([
+    ("timestamp", "<f8"),
+    ("kind", "u1"),
+    ("flags", "u1"), # Reserved
+    ("length", "<u2"),
+    ("sequence", "<u4"),
+    ("data", "<f8", (12,)),
+])
+TEXT_BYTES = RECORD_DTYPE["data"].itemsize
+
+CHUNK_HEADER_DTYPE = np.dtype([
+    ("magic", "S8"),
+    ("version", "<u4"),
+    ("record_size", "<u4"),
+    ("count", "<u8"),
+    ("chunk", "<u4"),
+    ("capacity", "<u4"),
+    ("started", "<f8"), # Wall clock time the recording started, for humans
+])
+CHUNK_HEADER_BYTES = 64
+
+class Chunk:
+    """ One preallocated, memory-mapped chunk file being written """
+    def __init__(self, path: Path, index: int, capacity: int, started: float):
+        self.path = path
+        self.file = open(path, "w+b")
+        self.file.truncate(CHUNK_HEADER_BYTES + capacity * RECORD_DTYPE.itemsize)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.header = np.ndarray((), dtype=CHUNK_HEADER_DTYPE, buffer=self.map)
+        self.records = np.ndarray((capacity,), dtype=RECORD_DTYPE,
+                                  buffer=self.map, offset=CHUNK_HEADER_BYTES)
+        self.header["magic"] = MAGIC
+        self.header["version"] = FORMAT_VERSION
+        self.header["record_size"] = RECORD_DTYPE.itemsize
+        self.header["chunk"] = index
+        self.header["capacity"] = capacity
+        self.header["started"] = started
+        self.count = 0
+
+    def free(self) -> int:
+        return len(self.records) - self.count
+
+    def write(self, records: np.ndarray):
+        n = len(records)
+        self.records[self.count:self.count + n] = records
+        self.count += n
+        # Committed after the records, so a reader never sees a partial one
+        self.header["count"] = self.count
+
+    def close(self):
+        """ Flushes and trims the file to the records actually written """
+        count = self.count
+        del self.header, self.records
+        self.map.flush()
+        self.map.close()
+        self.file.truncate(CHUNK_HEADER_BYTES + count * RECORD_DTYPE.itemsize)
+        self.file.close()
+
+class FlightRecorder(threading.Thread):
+    """ Records a run into chunk files under `directory`, see the top of this
+        file. The methods that record things are cheap and thread safe, and
+        can be called from control loops. `history` is the name of the state
+        history ring to record states from, and `clock` gives the timestamps
+        of everything else (pass the VirtualClock's now() in virtual time).
+    """
+    def __init__(
+        self,
+        directory: Union[str, Path],
+        history: Optional[str] = None,
+        history_slots: int = 256,
+        chunk_records: int = 1 << 17,
+        flush_interval: float = 0.01,
+        clock: Callable[[], float] = monotonic,
+        name: str = "flight",
+        pending_size: int = 1 << 16,
+    ):
+        super().__init__(name="FlightRecorder", daemon=True)
+        self.directory = Path(directory)
+        self.history_name = history
+        self.history_slots = history_slots
+        self.chunk_records = chunk_records
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.started_at = time()
+        self.prefix = name + "_" + str(int(self.started_at))
+        # Bounded so a stalled writer can't run the Pi out of memory, the
+        # oldest are dropped and counted once it's full
+        self.pending: Deque[Tuple[float, int, Any]] = deque(maxlen=pending_size)
+        self.records_written = 0
+        self.states_lost = 0
+        self.records_lost = 0
+        self._records_lost_recorded = 0
+        self._stopping = threading.Event()
+        self._chunk: Optional[Chunk] = None
+        self._chunks = 0
+
+    # Producers
+
+    def _append(self, item: Tuple[float, int, Any]):
+        pending = self.pending
+        if len(pending) == pending.maxlen:
+            self.records_lost += 1 # Written as a KIND_GAP at the next flush
+        pending.append(item)
+
+    def motors(self, speeds: MotorSpeeds):
+        self._append((self.clock(), KIND_MOTORS,
+                      (speeds.forward, speeds.turn, speeds.front, speeds.back)))
+
+    def command(self, message: Dict[str, Any]):
+        # Encoded now since the message may still be changed afterwards
+        self._append((self.clock(), KIND_COMMAND, json.dumps(message)))
+
+    def task_event(self, name: str, event: str):
+        self._append((self.clock(), KIND_TASK, name + " " + event))
+
+    def sample(self, kind: int, values: Tuple[float, ...]):
+        """ A numeric sensor sample of `kind` (KIND_TICK to KIND_DEPTH) """
+        self._append((self.clock(), kind, values))
+
+    def nmea(self, line: bytes):
+        self._append((self.clock(), KIND_NMEA, line.decode("latin-1")))
+
+    # Writer
+
+    def run(self):
+        history = StateHistoryHandle(self.history_name, self.history_slots) \
+            if self.history_name else None
+        # Only states written from now on
+        last_sequence = history.count() if history else 0
+        states = np.zeros(self.history_slots, dtype=HISTORY_DTYPE)
+        try:
+            while True:
+                stopping = self._stopping.wait(self.flush_interval)
+                batch: List[np.ndarray] = []
+                if history:
+                    last_sequence = self._drain_history(history, last_sequence, states, batch)
+                self._drain_pending(batch)
+                if batch:
+                    records = np.concatenate(batch)
+                    # One timeline across sources; stable so text stays in order
+                    records = records[np.argsort(records["timestamp"], kind="stable")]
+                    self._write(records)
+                if stopping:
+                    return
+        finally:
+            if history:
+                history.close()
+            if self._chunk:
+                self._chunk.close()
+                self._chunk = None
+
+    def _drain_history(
+        self,
+        history: StateHistoryHandle,
+        last_sequence: int,
+        states: np.ndarray,
+        batch: List[np.ndarray],
+    ) -> int:
+        count = history.count()
+        new = count - last_sequence
+        if new <= 0:
+            return last_sequence
+        readable = self.history_slots - 2 # read_last() needs k < slots
+        n = history.read_last(min(new, readable), states)
+        # The ring may have moved on since count(), only keep what's new
+        fresh = states[:n][states["sequence"][:n] > last_sequence]
+        if len(fresh) == 0:
+            return last_sequence
+        lost = int(fresh["sequence"][0]) - last_sequence - 1
+        if lost > 0:
+            # Lapped by the writer, say so instead of silently skipping
+            gap = np.zeros(1, dtype=RECORD_DTYPE)
+            gap["timestamp"] = fresh["timestamp"][0]
+            gap["kind"] = KIND_GAP
+            gap["sequence"] = last_sequence + 1
+            gap["data"][0, 0] = lost
+            self.states_lost += lost
+            batch.append(gap)
+        records = np.zeros(len(fresh), dtype=RECORD_DTYPE)
+        records["timestamp"] = fresh["timestamp"]
+        records["kind"] = KIND_STATE
+        records["sequence"] = fresh["sequence"]
+        data = records["data"]
+        data[:, 0:3] = fresh["position"]
+        data[:, 3:6] = fresh["velocity"]
+        data[:, 6:9] = fresh["attitude"]
+        data[:, 9:12] = fresh["angular_velocity"]
+        batch.append(records)
+        return int(fresh["sequence"][-1])
+
+    def _drain_pending(self, batch: List[np.ndarray]):
+        pending = self.pending
+        items = []
+        while True:
+            try:
+                items.append(pending.popleft())
+            except IndexError:
+                break
+        lost = self.records_lost - self._records_lost_recorded
+        if lost > 0:
+            # The oldest were pushed out before this flush, say so
+            self._records_lost_recorded += lost
+            gap = np.zeros(1, dtype=RECORD_DTYPE)
+            gap["timestamp"] = items[0][0] if items else self.clock()
+            gap["kind"] = KIND_GAP
+            gap["data"][0, 0] = lost
+            batch.append(gap)
+        if not items:
+            return
+        # Motor outputs and sensor samples come at loop rates, so they are
+        # converted all at once; the rest is rare
+        numeric = [item for item in items if item[1] not in TEXT_KINDS]
+        if numeric:
+            records = np.zeros(len(numeric), dtype=RECORD_DTYPE)
+            records["timestamp"] = [timestamp for timestamp, _, _ in numeric]
+            records["kind"] = [kind for _, kind, _ in numeric]
+            kinds = records["kind"]
+            data = records["data"]
+            for kind in np.unique(kinds):
+                rows = np.flatnonzero(kinds == kind)
+                values = np.array([numeric[row][2] for row in rows], dtype=np.float64)
+                data[rows, :values.shape[1]] = values
+            batch.append(records)
+        for timestamp, kind, payload in items:
+            if kind in TEXT_KINDS:
+                batch.append(encode_text(timestamp, kind, payload))
+
+    def _write(self, records: np.ndarray):
+        while len(records):
+            if self._chunk is None or self._chunk.free() == 0:
+                self._rotate()
+            assert self._chunk
+            n = min(self._chunk.free(), len(records))
+            self._chunk.write(records[:n])
+            records = records[n:]
+            self.records_written += n
+
+    def _rotate(self):
+        if self._chunk:
+            self._chunk.close()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / (self.prefix + "_" + str(self._chunks).zfill(4) + ".fdr")
+        self._chunk = Chunk(path, self._chunks, self.chunk_records, self.started_at)
+        self._chunks += 1
+
+    def stop(self):
+        """ Writes out everything recorded so far, closes the files, and
+            returns once the thread has exited.
+        """
+        self._stopping.set()
+        self.join()
+
+def encode_text(timestamp: float, kind: int, text: str) -> np.ndarray:
+    """ A record of `kind` holding `text`, followed by KIND_TEXT records for
+        whatever doesn't fit in it.
+    """
+    data = text.encode()[:0xFFFF]
+    n = max(1, -(-len(data) // TEXT_BYTES))
+    records = np.zeros(n, dtype=RECORD_DTYPE)
+    records["timestamp"] = timestamp
+    records["kind"] = KIND_TEXT
+    records["kind"][0] = kind
+    records["length"][0] = len(data)
+    raw = np.zeros(n * TEXT_BYTES, dtype=np.uint8)
+    raw[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+    records["data"] = raw.view(RECORD_DTYPE["data"].base).reshape(n, -1)
+    return records
+
+def decode_text(records: np.ndarray, index: int) -> str:
+    """ Text of the record at `index`, which must be a text record's head """
+    length = int(records["length"][index])
+    n = max(1, -(-length // TEXT_BYTES))
+    raw = np.ascontiguousarray(records["data"][index:index + n]).view(np.uint8)
+    return raw.reshape(-1)[:length].tobytes().decode()
+
+def chunk_paths(
+    directory: Union[str, Path],
+    prefix: Optional[str] = None,
+    name: str = "flight",
+) -> List[Path]:
+    """ Chunk files of a recording in order. Without `prefix`, those of the
+        newest recording called `name` in `directory`.
+    """
+    paths = sorted(Path(directory).glob(name + "_*.fdr"))
+    if prefix is None:
+        if not paths:
+            return []
+        prefix = paths[-1].name.rsplit("_", 1)[0]
+    return [path for path in paths if path.name.rsplit("_", 1)[0] == prefix]
+
+def read_chunk(path: Union[str, Path]) -> np.ndarray:
+    """ The valid records of one chunk file, memory-mapped read only """
+    header = np.fromfile(path, dtype=CHUNK_HEADER_DTYPE, count=1)[0]
+    if header["magic"] != MAGIC:
+        raise ValueError(str(path) + " is not a flight recording")
+    if header["version"] != FORMAT_VERSION or header["record_size"] != RECORD_DTYPE.itemsize:
+        raise ValueError(str(path) + " has an unsupported format version")
+    count = int(header["count"])
+    if count == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode="r",
+                     offset=CHUNK_HEADER_BYTES, shape=(count,))
+
+def load(paths: List[Path]) -> np.ndarray:
+    """ All records of a recording (see chunk_paths()) as one array """
+    chunks = [read_chunk(path) for path in paths]
+    if not chunks:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.concatenate(chunks)
+
+def texts(records: np.ndarray, kind: int) -> Iterator[Tuple[float, str]]:
+    """ Timestamp and text of every record of a text `kind` """
+    for index in np.flatnonzero(records["kind"] == kind):
+        yield float(records["timestamp"][index]), decode_text(records, int(index))
+
+# Sensor wrappers for recording, duck typed like the sensors they wrap
+
+class RecordingAccelGyro:
+    """ Records every read of an accelerometer/gyroscope like LSM6DS """
+    def __init__(self, sensor, recorder: FlightRecorder):
+        self.sensor = sensor
+        self.recorder = recorder
+
+    @property
+    def acceleration(self) -> Tuple[float, float, float]:
+        value = self.sensor.acceleration
+        self.recorder.sample(KIND_ACCEL, value)
+        return value
+
+    @property
+    def gyro(self) -> Tuple[float, float, float]:
+        value = self.sensor.gyro
+        self.recorder.sample(KIND_GYRO, value)
+        return value
+
+class RecordingMagnetometer:
+    """ Records every read of a magnetometer like LIS3MDL """
+    def __init__(self, sensor, recorder: FlightRecorder):
+        self.sensor = sensor
+        self.recorder = recorder
+
+    @property
+    def magnetic(self) -> Tuple[float, float, float]:
+        value = self.sensor.magnetic
+        self.recorder.sample(KIND_MAG, value)
+        return value
+
+class RecordingSerial:
+    """ Records every line read from a serial port like serial.Serial """
+    def __init__(self, serial, recorder: FlightRecorder):
+        self.serial = serial
+        self.recorder = recorder
+
+    def readline(self) -> bytes:
+        line = self.serial.readline()
+        self.recorder.nmea(line)
+        return line
+
+def recording_depth(depth_func: Callable[[], float], recorder: FlightRecorder) -> Callable[[], float]:
+    def depth() -> float:
+        value = depth_func()
+        recorder.sample(KIND_DEPTH, (value,))
+        return value
+    return depth
@@ -0,0 +1,96 @@
+from typing import Callable, Literal
+from time import monotonic, sleep
+
+CatchUp = Literal["skip", "burst", "reset"]
+
+class RateScheduler:
+    """ Paces a loop at a fixed rate. Every iteration is given an absolute
+        deadline on the monotonic clock (start + k * period) and wait() sleeps
+        until that deadline, so time spent in the loop body never accumulates
+        as drift the way a fixed sleep() after every iteration does. On Linux,
+        Python's sleep() is itself a clock_nanosleep() on CLOCK_MONOTONIC.
+
+        If an iteration runs past its deadline it counts as an overrun and the
+        `catch_up` policy decides what happens to the deadlines that were
+        missed:
+        * "skip" - run the next iteration immediately, then rejoin the original
+          grid of deadlines, dropping the ones that were missed
+        * "burst" - run the missed iterations back to back until caught up, so
+          the long-run iteration count matches the rate (at most `max_burst`
+          behind, beyond which it falls back to "skip")
+        * "reset" - run the next iteration immediately and start a new grid of
+          deadlines from now
+
+        Usage:
+            scheduler = RateScheduler(200)
+            while True:
+                do_work()
+                scheduler.wait()
+    """
+    def __init__(
+        self,
+        rate_hz: float,
+        catch_up: CatchUp = "skip",
+        max_burst: int = 10,
+        clock: Callable[[], float] = monotonic,
+        sleep_func: Callable[[float], None] = sleep,
+    ):
+        if rate_hz <= 0:
+            raise ValueError("rate_hz must be positive")
+        if catch_up not in ("skip", "burst", "reset"):
+            raise ValueError("catch_up must be one of 'skip', 'burst', 'reset'")
+        self.rate_hz = rate_hz
+        self.period = 1.0 / rate_hz
+        self.catch_up = catch_up
+        self.max_burst = max_burst
+        self.clock = clock
+        self.sleep = sleep_func
+        self.next_deadline: float = 0.
+        self.overruns = 0 # Times the loop fell behind its deadlines
+        self.missed = 0 # Deadlines skipped entirely because of overruns
+        self._catching_up = False # Bursting through missed deadlines
+        self.lateness = 0. # How late the last iteration started, in seconds
+        self.max_lateness = 0.
+        self.reset()
+
+    def reset(self):
+        """ Starts a new grid of deadlines from now. Call this after the loop
+            has been paused (e.g. its task was disabled) so that the pause is
+            not counted as an overrun.
+        """
+        self.next_deadline = self.clock() + self.period
+        self._catching_up = False
+
+    def wait(self) -> int:
+        """ Sleeps until the next deadline. Returns the number of deadlines
+            that were dropped because the iteration overran (the ones "burst"
+            runs late don't count).
+        """
+        deadline = self.next_deadline
+        now = self.clock()
+        if now < deadline:
+            self.sleep(deadline - now)
+            now = self.clock()
+            self.next_deadline = deadline + self.period
+            self._catching_up = False
+            missed = 0
+        else:
+            if not self._catching_up:
+                # The rest of a burst is the same overrun catching up
+                self.overruns += 1
+            missed = int((now - deadline) // self.period)
+            if self.catch_up == "burst" and missed <= self.max_burst:
+                self.next_deadline = deadline + self.period
+                self._catching_up = missed > 0
+                missed = 0
+            elif self.catch_up == "reset":
+                self.next_deadline = now + self.period
+                self._catching_up = False
+            else:
+                self.next_deadline = deadline + (missed + 1) * self.period
+                self._catching_up = False
+            self.missed += missed
+        self.lateness = now - deadline
+        if self.lateness > self.max_lateness:
+            self.max_lateness = self.lateness
+        return missed
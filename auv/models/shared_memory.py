@@ -1,91 +1,400 @@
 try:
     import sys
     sys.path.append("..")
-    from data_types import State 
+    from data_types import State
 except:
-    from .data_types import State 
+    from .data_types import State
+
+from typing import Callable, Optional, Tuple
 
 import numpy as np
 from multiprocessing import shared_memory, Process
+from time import monotonic
+import ctypes
+import mmap
+import os
+import platform
+import struct
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None # type: ignore
 
+# Layout of the shared state segment:
+#   header - uint64 sequence counter, float64 monotonic write timestamp
+#   state  - four float64[3] arrays back to back
+# The sequence counter is a seqlock: it is odd while a write is in progress
+# and is bumped to the next even number when the write is done, so a reader
+# that sees the same even value before and after copying has a clean snapshot.
+#
+# The seqlock only works if the stores (and loads) to the counter and the
+# state happen in program order, which x86 does by itself. ARM (the Pi)
+# doesn't, and Python can't issue memory barriers, so there the handles call
+# a function of two instructions, a barrier and a return, mapped into
+# executable memory and called through ctypes. That costs a few hundred ns
+# and no syscall. Where no such function can be loaded (another CPU, or an OS
+# that refuses executable mappings) the handles take an flock() on the
+# segment around every read and write instead, which costs two syscalls per
+# call. The counter is still kept then, to tell new from stale.
+STRONGLY_ORDERED = platform.machine().lower() in ("x86_64", "amd64", "i386", "i686", "x86")
+_BARRIER_CODE = {
+    "aarch64": "bf3b03d5" "c0035fd6", # dmb ish; ret
+    "arm": "5bf07ff5" "1eff2fe1", # dmb ish; bx lr (ARMv7 and up)
+    "x86": "0faef0" "c3", # mfence; ret. Not needed, but lets this be tested on a PC
+}
+
+def load_barrier(machine: str = platform.machine()) -> Optional[Callable[[], None]]:
+    """ Returns a function issuing a full memory barrier on `machine`, or None
+        if there is none for it or executable memory can't be mapped.
+    """
+    machine = machine.lower()
+    if machine in ("aarch64", "arm64"):
+        # A 32 bit OS can run on a 64 bit kernel
+        code = _BARRIER_CODE["aarch64" if struct.calcsize("P") == 8 else "arm"]
+    elif machine.startswith("armv7") or machine == "armv8l":
+        code = _BARRIER_CODE["arm"]
+    elif machine in ("x86_64", "amd64"):
+        code = _BARRIER_CODE["x86"]
+    else:
+        return None
+    try:
+        page = mmap.mmap(-1, mmap.PAGESIZE, prot=mmap.PROT_READ | mmap.PROT_WRITE | mmap.PROT_EXEC)
+    except (AttributeError, OSError, TypeError): # No prot on Windows
+        return None
+    page.write(bytes.fromhex(code))
+    barrier = ctypes.CFUNCTYPE(None)(ctypes.addressof(ctypes.c_char.from_buffer(page)))
+    barrier.page = page # The mapping must live as long as the function
+    return barrier
+
+MEMORY_BARRIER = None if STRONGLY_ORDERED else load_barrier()
+STATE_DTYPE = np.float64
+STATE_FIELDS = ("position", "velocity", "attitude", "angular_velocity")
+ELEMENTS_PER_FIELD = 3
+STATE_ELEMENTS = ELEMENTS_PER_FIELD * len(STATE_FIELDS)
+SEQUENCE_OFFSET = 0
+TIMESTAMP_OFFSET = 8
+HEADER_BYTES = 16
+STATE_BYTES = HEADER_BYTES + STATE_ELEMENTS * np.dtype(STATE_DTYPE).itemsize
 
 def create_shared_state(name: str) -> shared_memory.SharedMemory:
-    data_type = np.float64
-    num_elements_per_array = 3
-    num_arrays = 4
-    total_elements = num_elements_per_array * num_arrays
-    total_bytes = total_elements * np.dtype(data_type).itemsize
-    # Create shared memory
-    shm = shared_memory.SharedMemory(create=True, size=total_bytes, name=name)
-    # Create initial NumPy array views in the master process
-    array1_offset = 0
-    array2_offset = np.dtype(data_type).itemsize * num_elements_per_array
-    array3_offset = np.dtype(data_type).itemsize * num_elements_per_array * 2
-    array4_offset = np.dtype(data_type).itemsize * num_elements_per_array * 3
-
-    master_array1 = np.ndarray((num_elements_per_array,), dtype=data_type, buffer=shm.buf, offset=array1_offset)
-    master_array2 = np.ndarray((num_elements_per_array,), dtype=data_type, buffer=shm.buf, offset=array2_offset)
-    master_array3 = np.ndarray((num_elements_per_array,), dtype=data_type, buffer=shm.buf, offset=array3_offset)
-    master_array4 = np.ndarray((num_elements_per_array,), dtype=data_type, buffer=shm.buf, offset=array4_offset)
-
-    master_array1[:] = [0, 0, 0]
-    master_array2[:] = [0, 0, 0]
-    master_array3[:] = [0, 0, 0]
-    master_array4[:] = [0, 0, 0]
- 
+    # Create shared memory (a fresh segment is zero-filled, so the sequence
+    # counter starts at 0, meaning "never written")
+    shm = shared_memory.SharedMemory(create=True, size=STATE_BYTES, name=name)
+    # Zero the state through a temporary view in the master process
+    master_array = np.ndarray((STATE_BYTES,), dtype=np.uint8, buffer=shm.buf)
+    master_array[:] = 0
+    del master_array
     return shm
 
-def write_shared_state(name: str, state: State):
-    existing_shm = shared_memory.SharedMemory(name=name)
-    data_type = np.float64
-    num_elements_per_array = 3
+class SnapshotTimeout(TimeoutError):
+    """ A reader kept overlapping writes and gave up """
+
+def _open_lock(shm: shared_memory.SharedMemory) -> int:
+    """ Opens a descriptor of the segment to flock(), kept by the handle """
+    return os.open(os.path.join("/dev/shm", shm.name), os.O_RDONLY)
+
+class SharedStateHandle:
+    """ Attaches to an existing shared state segment once and keeps NumPy
+        views of it, so that reading and writing the state is just a memory
+        copy instead of a shm_open/mmap per call. Each process (or thread)
+        should create its own handle, reuse it in its loop, and call close()
+        when it exits.
+
+        Writes are guarded by a seqlock, so there must be exactly one writer
+        per segment. Readers never block the writer: they retry until they
+        copy a snapshot that was not written to in the meantime. With
+        `locked` (the default only where MEMORY_BARRIER is needed but could
+        not be loaded) they take a lock on the segment instead.
+    """
+    def __init__(self, name: str, max_retries: int = 1000, locked: Optional[bool] = None):
+        self.name = name
+        self.max_retries = max_retries
+        self.shm = shared_memory.SharedMemory(name=name)
+        if locked is None:
+            locked = not STRONGLY_ORDERED and MEMORY_BARRIER is None and fcntl is not None
+        self.locked = locked
+        self._barrier = None if locked else MEMORY_BARRIER
+        self._lock_fd = _open_lock(self.shm) if locked else -1
+        buf = self.shm.buf
+        self._sequence = np.ndarray((1,), dtype=np.uint64, buffer=buf, offset=SEQUENCE_OFFSET)
+        self._timestamp = np.ndarray((1,), dtype=np.float64, buffer=buf, offset=TIMESTAMP_OFFSET)
+        self._data = np.ndarray((STATE_ELEMENTS,), dtype=STATE_DTYPE, buffer=buf, offset=HEADER_BYTES)
+        # Readers copy into here first so a torn copy never reaches the caller
+        self._snapshot = np.zeros(STATE_ELEMENTS, dtype=STATE_DTYPE)
+        self.position, self.velocity, self.attitude, self.angular_velocity = \
+            np.split(self._data, len(STATE_FIELDS))
+        # Sequence and write timestamp of the last snapshot this handle read
+        self.last_sequence = 0
+        self.last_timestamp = 0.
+
+    def sequence(self) -> int:
+        """ Current value of the write counter. Odd while a write is underway.
+        """
+        return int(self._sequence[0])
+
+    def has_update(self) -> bool:
+        """ Whether the state has been written since this handle last read
+            it. Cheap enough to call every tick before deciding to read.
+        """
+        return int(self._sequence[0]) != self.last_sequence
+
+    def read_into(self, state: State) -> bool:
+        """ Copies a consistent snapshot of the shared state into the arrays of
+            an existing State without allocating. The arrays of `state` must be
+            float64[3]. Returns True if the snapshot is newer than the previous
+            one this handle read, and False if it is stale. Raises
+            SnapshotTimeout, leaving `state` untouched, if a consistent
+            snapshot could not be taken within `max_retries`.
+        """
+        sequence = self._sequence
+        snapshot = self._snapshot
+        if self.locked:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_SH)
+            try:
+                before = int(sequence[0])
+                np.copyto(snapshot, self._data)
+                timestamp = float(self._timestamp[0])
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        else:
+            barrier = self._barrier
+            for _ in range(self.max_retries):
+                before = int(sequence[0])
+                if before & 1:
+                    continue
+                if barrier is not None:
+                    barrier()
+                np.copyto(snapshot, self._data)
+                timestamp = float(self._timestamp[0])
+                if barrier is not None:
+                    barrier()
+                if int(sequence[0]) == before:
+                    break
+            else:
+                raise SnapshotTimeout(
+                    "No consistent snapshot of " + self.name + " in "
+                    + str(self.max_retries) + " tries"
+                )
+        np.copyto(state.position, snapshot[0:3])
+        np.copyto(state.velocity, snapshot[3:6])
+        np.copyto(state.attitude, snapshot[6:9])
+        np.copyto(state.angular_velocity, snapshot[9:12])
+        is_new = before != self.last_sequence
+        self.last_sequence = before
+        self.last_timestamp = timestamp
+        return is_new
+
+    def write_from(self, state: State, timestamp: Optional[float] = None):
+        """ Copies the arrays of `state` into the shared state without
+            allocating, stamping it with `timestamp` (defaults to now, on the
+            monotonic clock). Only one task may write to a segment.
+        """
+        barrier = self._barrier
+        if self.locked:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            sequence = self._sequence
+            sequence[0] += 1 # Odd, write in progress
+            if barrier is not None:
+                barrier()
+            np.copyto(self.position, state.position)
+            np.copyto(self.velocity, state.velocity)
+            np.copyto(self.attitude, state.attitude)
+            np.copyto(self.angular_velocity, state.angular_velocity)
+            self._timestamp[0] = monotonic() if timestamp is None else timestamp
+            if barrier is not None:
+                barrier()
+            sequence[0] += 1 # Even, write complete
+        finally:
+            if self.locked:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
 
-    array1_offset = 0
-    array2_offset = np.dtype(data_type).itemsize * num_elements_per_array
-    array3_offset = np.dtype(data_type).itemsize * num_elements_per_array * 2
-    array4_offset = np.dtype(data_type).itemsize * num_elements_per_array * 3
+    def read(self) -> State:
+        """ Returns a newly allocated copy of the shared state. Prefer
+            read_into() inside of loops.
+        """
+        state = State()
+        self.read_into(state)
+        return state
 
-    shared_array1 = np.ndarray((3,), dtype=data_type, buffer=existing_shm.buf, offset=array1_offset)
-    shared_array2 = np.ndarray((3,), dtype=data_type, buffer=existing_shm.buf, offset=array2_offset)
-    shared_array3 = np.ndarray((3,), dtype=data_type, buffer=existing_shm.buf, offset=array3_offset)
-    shared_array4 = np.ndarray((3,), dtype=data_type, buffer=existing_shm.buf, offset=array4_offset)
+    def close(self):
+        """ Releases the views and detaches from the segment. Does not unlink
+            it, since that is the job of whoever called create_shared_state().
+        """
+        # The views must be dropped first or the mmap refuses to close
+        del self.position, self.velocity, self.attitude, self.angular_velocity
+        del self._sequence, self._timestamp, self._data
+        if self._lock_fd >= 0:
+            os.close(self._lock_fd)
+        self.shm.close()
 
-    shared_array1[:] = state.position
-    shared_array2[:] = state.velocity
-    shared_array3[:] = state.attitude
-    shared_array4[:] = state.angular_velocity
+# Layout of the state history segment:
+#   header  - uint64 count of records committed so far
+#   records - 2 * slots records of HISTORY_DTYPE
+# Record n (counting from 1) is written to slot (n - 1) % slots and mirrored
+# to that slot + slots, so the newest k records are always one contiguous
+# slice of the record array and can be handed out as a view without copying.
+# The single writer commits a record by bumping the count after both copies
+# are written. A window of k records read while the count was c stays intact
+# as long as the count has not advanced by slots - k or more. Like the shared
+# state, this needs the stores kept in order, so where they may not be (see
+# STRONGLY_ORDERED) it uses MEMORY_BARRIER, or failing that append() and
+# read_last() lock the segment.
+HISTORY_DTYPE = np.dtype([
+    ("sequence", np.uint64),
+    ("timestamp", np.float64),
+    ("position", STATE_DTYPE, (3,)),
+    ("velocity", STATE_DTYPE, (3,)),
+    ("attitude", STATE_DTYPE, (3,)),
+    ("angular_velocity", STATE_DTYPE, (3,)),
+])
+HISTORY_HEADER_BYTES = 8
+
+def _history_bytes(slots: int) -> int:
+    return HISTORY_HEADER_BYTES + 2 * slots * HISTORY_DTYPE.itemsize
+
+def create_state_history(name: str, slots: int = 256) -> shared_memory.SharedMemory:
+    """ Creates a zeroed shared memory ring of `slots` timestamped State
+        records. Attach to it with StateHistoryHandle.
+    """
+    shm = shared_memory.SharedMemory(create=True, size=_history_bytes(slots), name=name)
+    master_array = np.ndarray((_history_bytes(slots),), dtype=np.uint8, buffer=shm.buf)
+    master_array[:] = 0
+    del master_array
+    return shm
+
+class StateHistoryHandle:
+    """ Attaches to an existing state history ring once. Exactly one task may
+        append() to a ring, any number may read it, and unless `locked` nobody
+        takes a lock.
+
+        `slots` must match what the ring was created with, and `locked` is
+        as for SharedStateHandle.
+    """
+    def __init__(self, name: str, slots: int = 256, locked: Optional[bool] = None):
+        self.name = name
+        self.slots = slots
+        self.shm = shared_memory.SharedMemory(name=name)
+        if locked is None:
+            locked = not STRONGLY_ORDERED and MEMORY_BARRIER is None and fcntl is not None
+        self.locked = locked
+        self._barrier = None if locked else MEMORY_BARRIER
+        self._lock_fd = _open_lock(self.shm) if locked else -1
+        buf = self.shm.buf
+        self._count = np.ndarray((1,), dtype=np.uint64, buffer=buf, offset=0)
+        self.records = np.ndarray((2 * slots,), dtype=HISTORY_DTYPE,
+                                  buffer=buf, offset=HISTORY_HEADER_BYTES)
+
+    def count(self) -> int:
+        """ Number of records appended since the ring was created.
+        """
+        return int(self._count[0])
+
+    def append(self, state: State, timestamp: float):
+        """ Writes `state` as the newest record. Only one task may append.
+        """
+        barrier = self._barrier
+        if self.locked:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            # The last count must be seen before the slot it frees is reused
+            if barrier is not None:
+                barrier()
+            n = int(self._count[0]) + 1
+            slot = (n - 1) % self.slots
+            for index in (slot, slot + self.slots):
+                record = self.records[index]
+                record["sequence"] = n
+                record["timestamp"] = timestamp
+                record["position"] = state.position
+                record["velocity"] = state.velocity
+                record["attitude"] = state.attitude
+                record["angular_velocity"] = state.angular_velocity
+            if barrier is not None:
+                barrier()
+            self._count[0] = n
+        finally:
+            if self.locked:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def window(self, k: int) -> Tuple[np.ndarray, int]:
+        """ Returns a zero-copy view of the newest `k` records, oldest first,
+            along with the count it was taken at. Fewer than `k` records are
+            returned if fewer have been written. The view aliases the ring, so
+            check intact() once done with it to know the writer did not lap it.
+            Not safe with `locked`, use read_last().
+        """
+        if not 0 < k < self.slots:
+            raise ValueError("k must be between 1 and slots - 1")
+        count = int(self._count[0])
+        if self._barrier is not None:
+            self._barrier()
+        k = min(k, count)
+        start = (count - k) % self.slots
+        return self.records[start:start + k], count
+
+    def intact(self, count: int, k: int) -> bool:
+        """ Whether a window of `k` records taken at `count` is still
+            unmodified.
+        """
+        if self._barrier is not None:
+            self._barrier()
+        return int(self._count[0]) - count < self.slots - k
+
+    def read_last(self, k: int, out: np.ndarray) -> int:
+        """ Copies the newest `k` records into the front of the preallocated
+            HISTORY_DTYPE array `out` and returns how many were copied, retrying
+            if the writer laps the window mid-copy. Use this instead of window()
+            when the records must outlive the next few writes.
+        """
+        if self.locked:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_SH)
+            try:
+                view, _count = self.window(k)
+                np.copyto(out[:len(view)], view)
+                return len(view)
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        while True:
+            view, count = self.window(k)
+            n = len(view)
+            np.copyto(out[:n], view)
+            if self.intact(count, k):
+                return n
+
+    def close(self):
+        del self._count, self.records
+        if self._lock_fd >= 0:
+            os.close(self._lock_fd)
+        self.shm.close()
+
+def write_shared_state(name: str, state: State):
+    """ One-off write. Attaches and detaches every call, so use a
+        SharedStateHandle for anything that runs in a loop.
+    """
+    handle = SharedStateHandle(name)
+    handle.write_from(state)
+    handle.close()
 
 def read_shared_state(name: str) -> State:
-    existing_shm = shared_memory.SharedMemory(name=name)
-    data_type = np.float64
-
-    array1_offset = 0
-    array2_offset = np.dtype(data_type).itemsize * 3
-    array3_offset = np.dtype(data_type).itemsize * 3 * 2
-    array4_offset = np.dtype(data_type).itemsize * 3 * 3
-
-    shared_array1 = np.ndarray((3,), dtype=data_type, buffer=existing_shm.buf, offset=array1_offset)
-    shared_array2 = np.ndarray((3,), dtype=data_type, buffer=existing_shm.buf, offset=array2_offset)
-    shared_array3 = np.ndarray((3,), dtype=data_type, buffer=existing_shm.buf, offset=array3_offset)
-    shared_array4 = np.ndarray((3,), dtype=data_type, buffer=existing_shm.buf, offset=array4_offset)
-
-    state = State(
-        position=shared_array1.copy(),
-        velocity=shared_array2.copy(),
-        attitude=shared_array3.copy(),
-        angular_velocity=shared_array4.copy(),
-    )
-    existing_shm.close()
+    """ One-off read. Attaches and detaches every call, so use a
+        SharedStateHandle for anything that runs in a loop.
+    """
+    handle = SharedStateHandle(name)
+    state = handle.read()
+    handle.close()
     return state
 
 def test_process(name:str):
     print("Worker process alive")
+    handle = SharedStateHandle(name)
     print("Reading shared state:")
-    readState1 = read_shared_state(name=name)
+    readState1 = handle.read()
     print(repr(readState1))
     print("Writing shared state with position[0] = 10.0")
     readState1.position[0] = 10.0
-    write_shared_state(name=name, state=readState1)
+    handle.write_from(readState1)
+    handle.close()
 
 if __name__ == "__main__":
     print("Initializing shared state")
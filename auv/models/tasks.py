@@ -7,6 +7,15 @@ from msgspec import Struct
 from abc import ABC as abc, abstractmethod
 from time import sleep
 
+try:
+    from .scheduler import RateScheduler, CatchUp
+    from .instrumentation import LoopStats
+    from .clock import Clock, REAL_CLOCK
+except:
+    from scheduler import RateScheduler, CatchUp
+    from instrumentation import LoopStats
+    from clock import Clock, REAL_CLOCK
+
 class TaskInfo(Struct):
     name: str
     type: Union[Literal["Process"], Literal["Thread"]]
@@ -18,8 +27,49 @@ class TaskInfo(Struct):
     active: bool = False
 
 class Task(abc):
+    # Set rate_hz on a subclass (or pass it to the constructor) to run loop()
+    # at that fixed rate instead of as fast as possible. See RateScheduler.
+    rate_hz: Optional[float] = None
+    catch_up: CatchUp = "skip"
+    # What the scheduler reads and sleeps on. A TTask can be given a shared
+    # VirtualClock instead, see models/clock.py
+    clock: Clock = REAL_CLOCK
+    # Set to a models.recorder.FlightRecorder to record task events
+    recorder = None
+
     def __init__(self):
         self.meta: TaskInfo
+        self.scheduler: Optional[RateScheduler] = None
+        self.stats: LoopStats
+
+    def make_scheduler(self) -> Optional[RateScheduler]:
+        """ Builds the scheduler for this task's loop, or returns None if the
+            task has no rate. Call it from inside run() so that for a PTask it
+            is created in the child process.
+        """
+        if self.rate_hz:
+            self.scheduler = RateScheduler(
+                self.rate_hz,
+                self.catch_up,
+                clock=self.clock.now,
+                sleep_func=self.clock.sleep,
+            )
+        return self.scheduler
+
+    def record_event(self, event: str):
+        if self.recorder:
+            self.recorder.task_event(self.meta.name, event)
+
+    def info(self) -> dict:
+        """ Loop timing stats plus current queue depths, for reporting """
+        info = self.stats.summary()
+        info["rate_hz"] = self.rate_hz
+        info["active"] = self.meta.active
+        try:
+            info["input_q_depth"] = self.meta.input_q.qsize()
+        except NotImplementedError: # multiprocessing.Queue on macOS
+            info["input_q_depth"] = None
+        return info
 
     @abstractmethod
     def run(self):
@@ -53,8 +103,21 @@ class Task(abc):
         raise NotImplementedError
 
 class TTask(threading.Thread, Task): # type: ignore
-    def __init__(self, name: str):
+    def __init__(
+        self,
+        name: str,
+        rate_hz: Optional[float] = None,
+        clock: Optional[Clock] = None,
+    ):
         super().__init__(name=name)
+        self.scheduler = None
+        self.stats = LoopStats()
+        if rate_hz is not None:
+            self.rate_hz = rate_hz
+        if clock is not None:
+            # Joined here, in construction order, so a VirtualClock orders
+            # its tasks the same way every run
+            self.clock = clock.join(name)
         self.meta = TaskInfo(
             name=name,
             type="Thread",
@@ -89,19 +152,35 @@ class TTask(threading.Thread, Task): # type: ignore
         """
         meta = self.meta
         loop = self.loop
-        while True:
-            if not meta.started_event.is_set() or not meta.enabled_event.is_set():
-                if not meta.enabled_event.is_set():
-                    meta.enabled_event.wait()
-                if not meta.started_event.is_set():
-                    break;
-            loop()
+        stats = self.stats
+        scheduler = self.make_scheduler()
+        try:
+            while True:
+                if not meta.started_event.is_set() or not meta.enabled_event.is_set():
+                    if not meta.enabled_event.is_set():
+                        with self.clock.idle():
+                            meta.enabled_event.wait()
+                    if not meta.started_event.is_set():
+                        break;
+                    stats.pause()
+                    if scheduler:
+                        scheduler.reset()
+                stats.begin()
+                loop()
+                stats.end(scheduler)
+                if scheduler:
+                    scheduler.wait()
+        finally:
+            # Even if the loop raises, or the other tasks on a VirtualClock would
+            # wait for this one forever
+            self.clock.leave()
     
     def loop(self):
         raise NotImplementedError("You must either override the run() method \
             or the loop() method with custom code")
 
     def startup(self):
+        self.record_event("startup")
         self.meta.started = True
         self.meta.started_event.set()
         self.start()
@@ -110,6 +189,7 @@ class TTask(threading.Thread, Task): # type: ignore
         """ If the task has been started already, it cannot be shutdown and
             this method will return `False`. Otherwise, it will return `True`.
         """
+        self.record_event("shutdown")
         if self.meta.started:
             self.meta.enabled_event.set()
             self.meta.started_event.clear()
@@ -118,10 +198,13 @@ class TTask(threading.Thread, Task): # type: ignore
             return False
 
     def activate(self):
+        self.record_event("activate")
+        self.clock.wake() # Before the event, see Clock.wake()
         self.meta.enabled_event.set()
         self.meta.active = True
 
     def deactivate(self):
+        self.record_event("deactivate")
         self.meta.enabled_event.clear()
         self.meta.active = False
 
@@ -129,8 +212,13 @@ class TTask(threading.Thread, Task): # type: ignore
         self.meta.input_q.put(x)
 
 class PTask(multiprocessing.Process, Task): # type: ignore
-    def __init__(self, name: str):
+    def __init__(self, name: str, rate_hz: Optional[float] = None):
         super().__init__(name=name)
+        self.scheduler = None
+        # Shared so the main process can read what the child records
+        self.stats = LoopStats(shared=True)
+        if rate_hz is not None:
+            self.rate_hz = rate_hz
         self.meta = TaskInfo(
             name=name,
             type="Process",
@@ -144,19 +232,29 @@ class PTask(multiprocessing.Process, Task): # type: ignore
     def run(self):
         meta = self.meta
         loop = self.loop
+        stats = self.stats
+        scheduler = self.make_scheduler()
         while True:
             if not meta.started_event.is_set() or not meta.enabled_event.is_set():
                 if not meta.enabled_event.is_set():
                     meta.enabled_event.wait()
                 if not meta.started_event.is_set():
                     break;
+                stats.pause()
+                if scheduler:
+                    scheduler.reset()
+            stats.begin()
             loop()
+            stats.end(scheduler)
+            if scheduler:
+                scheduler.wait()
     
     def loop(self):
         raise NotImplementedError("You must either override the run() method \
             or the loop() method with custom code")
 
     def startup(self):
+        self.record_event("startup")
         self.meta.started = True
         self.meta.started_event.set()
         self.start()
@@ -165,6 +263,7 @@ class PTask(multiprocessing.Process, Task): # type: ignore
         """ If the task has been started already, it cannot be shutdown and
             this method will return `False`. Otherwise, it will return `True`.
         """
+        self.record_event("shutdown")
         if self.meta.started:
             self.meta.enabled_event.set()
             self.meta.started_event.clear()
@@ -173,9 +272,11 @@ class PTask(multiprocessing.Process, Task): # type: ignore
             return False
 
     def activate(self):
+        self.record_event("activate")
         self.meta.enabled_event.set()
 
     def deactivate(self):
+        self.record_event("deactivate")
         self.meta.enabled_event.clear()
 
     def input(self, x):
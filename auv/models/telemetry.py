@@ -0,0 +1,143 @@
+""" Binary telemetry frames sent to base as websocket binary messages, for
+    data that is sent often enough that JSON would dominate the radio link and
+    the CPU (so far, just the state).
+
+    Every frame is little-endian and starts with the same 8 byte header:
+        version    u8   FRAME_VERSION
+        type       u8   one of the FRAME_* types
+        sequence   u16  per-stream counter, wraps around
+        timestamp  u32  milliseconds on the AUV's monotonic clock, wraps around
+    followed by a fixed layout payload for that type:
+        FRAME_STATE  position as 3 f32, then velocity, attitude, and
+                     angular_velocity as 3 f16 each (30 bytes)
+        FRAME_BATCH  several messages to base packed into one websocket
+                     message, each as a BATCH_ENTRY (u8 kind, u32 length)
+                     followed by the message: JSON text (ENTRY_TEXT) or a
+                     frame of its own (ENTRY_FRAME)
+        FRAME_BATCH_ZLIB  the same, with the entries zlib compressed
+
+    Half floats keep the state frame at 38 bytes, a tenth of the same state as
+    JSON, and are still good to about 0.1 degrees of attitude and 1 mm/s of
+    velocity, which is plenty for display at base.
+
+    This is the one definition of the layout: web_app/telemetry.py imports
+    it from here to decode them at base, so this file must only need the
+    standard library at runtime.
+"""
+
+from typing import Dict, List, Sequence, Tuple, Union, TYPE_CHECKING
+import struct
+import zlib
+
+if TYPE_CHECKING:
+    from .data_types import State
+
+FRAME_VERSION = 1
+FRAME_STATE = 1
+FRAME_BATCH = 2
+FRAME_BATCH_ZLIB = 3
+
+ENTRY_TEXT = 0
+ENTRY_FRAME = 1
+
+HEADER = struct.Struct("<BBHI")
+STATE_FRAME = struct.Struct("<BBHI3f9e")
+BATCH_ENTRY = struct.Struct("<BI")
+
+def encode_state(state: "State", sequence: int, timestamp: float) -> bytes:
+    """ Packs a state into a FRAME_STATE frame. `timestamp` is in seconds """
+    return STATE_FRAME.pack(
+        FRAME_VERSION,
+        FRAME_STATE,
+        sequence & 0xFFFF,
+        int(timestamp * 1000) & 0xFFFFFFFF,
+        *state.position.tolist(),
+        *state.velocity.tolist(),
+        *state.attitude.tolist(),
+        *state.angular_velocity.tolist(),
+    )
+
+def decode_header(frame: bytes) -> Tuple[int, int, float]:
+    """ Returns the type, sequence, and timestamp (seconds) of a frame.
+        Raises ValueError if it isn't a frame of this version.
+    """
+    if len(frame) < HEADER.size:
+        raise ValueError("Frame too short")
+    version, frame_type, sequence, timestamp_ms = HEADER.unpack_from(frame)
+    if version != FRAME_VERSION:
+        raise ValueError("Unsupported telemetry frame version " + str(version))
+    return frame_type, sequence, timestamp_ms / 1000.
+
+def decode_state(frame: bytes) -> Dict[str, List[float]]:
+    """ Inverse of encode_state(), without the header. Raises ValueError if
+        the frame is the wrong size.
+    """
+    if len(frame) != STATE_FRAME.size:
+        raise ValueError(
+            "State frame is " + str(len(frame)) + " bytes, not " + str(STATE_FRAME.size)
+        )
+    values = STATE_FRAME.unpack(frame)[4:]
+    return {
+        "position": list(values[0:3]),
+        "velocity": list(values[3:6]),
+        "attitude": list(values[6:9]),
+        "angular_velocity": list(values[9:12]),
+    }
+
+def encode_batch(
+    messages: Sequence[Union[str, bytes]],
+    sequence: int,
+    timestamp: float,
+    compress: bool = False,
+) -> bytes:
+    """ Packs messages (JSON text or frames) into a FRAME_BATCH frame, or a
+        FRAME_BATCH_ZLIB one if `compress` and compression actually makes it
+        smaller. `timestamp` is in seconds.
+    """
+    parts: List[bytes] = []
+    for message in messages:
+        if isinstance(message, str):
+            data = message.encode()
+            parts.append(BATCH_ENTRY.pack(ENTRY_TEXT, len(data)))
+        else:
+            data = message
+            parts.append(BATCH_ENTRY.pack(ENTRY_FRAME, len(data)))
+        parts.append(data)
+    payload = b"".join(parts)
+    frame_type = FRAME_BATCH
+    if compress:
+        compressed = zlib.compress(payload)
+        if len(compressed) < len(payload):
+            payload = compressed
+            frame_type = FRAME_BATCH_ZLIB
+    return HEADER.pack(
+        FRAME_VERSION,
+        frame_type,
+        sequence & 0xFFFF,
+        int(timestamp * 1000) & 0xFFFFFFFF,
+    ) + payload
+
+def decode_batch(frame: bytes) -> List[Union[str, bytes]]:
+    """ Inverse of encode_batch(), without the header. Raises ValueError for
+        a malformed batch.
+    """
+    frame_type = frame[1]
+    payload = memoryview(frame)[HEADER.size:]
+    if frame_type == FRAME_BATCH_ZLIB:
+        try:
+            payload = memoryview(zlib.decompress(payload))
+        except zlib.error as err:
+            raise ValueError("Bad compressed batch: " + str(err))
+    messages: List[Union[str, bytes]] = []
+    offset = 0
+    while offset < len(payload):
+        if offset + BATCH_ENTRY.size > len(payload):
+            raise ValueError("Truncated batch")
+        kind, length = BATCH_ENTRY.unpack_from(payload, offset)
+        offset += BATCH_ENTRY.size
+        if offset + length > len(payload):
+            raise ValueError("Truncated batch")
+        data = bytes(payload[offset:offset + length])
+        offset += length
+        messages.append(data.decode() if kind == ENTRY_TEXT else data)
+    return messages
@@ -0,0 +1,152 @@
+from typing import Callable, Dict, List, Optional
+from time import monotonic, time
+import heapq
+import itertools
+
+try:
+    from .data_types import Promise
+except:
+    from data_types import Promise
+
+class Timer:
+    """ A single scheduled callback. Only TimerService should create these.
+    """
+    __slots__ = ("deadline", "order", "name", "callback", "interval", "cancelled")
+
+    def __init__(
+        self,
+        deadline: float,
+        order: int,
+        name: str,
+        callback: Callable,
+        interval: Optional[float],
+    ):
+        self.deadline = deadline
+        self.order = order
+        self.name = name
+        self.callback = callback
+        self.interval = interval
+        self.cancelled = False
+
+    def __lt__(self, other: "Timer") -> bool:
+        # Ties are broken by creation order so callbacks due at the same time
+        # run in the order they were scheduled
+        return (self.deadline, self.order) < (other.deadline, other.order)
+
+class TimerService:
+    """ Named, cancellable, re-armable timers kept in a min-heap keyed by
+        deadline (on the monotonic clock). Scheduling, cancelling, and
+        re-arming are all O(log n), and timeout() tells the main loop exactly
+        how long it may sleep before the next timer is due.
+
+        Cancelled or re-armed timers are left in the heap and skipped when they
+        reach the top, so nothing ever has to be searched for or removed from
+        the middle of the heap.
+
+        Not thread safe: schedule and run timers from the main loop only.
+    """
+    def __init__(self, clock: Callable[[], float] = monotonic):
+        self.clock = clock
+        self._heap: List[Timer] = []
+        self._timers: Dict[str, Timer] = {}
+        self._order = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._timers
+
+    def schedule(
+        self,
+        name: str,
+        delay: float,
+        callback: Callable,
+        interval: Optional[float] = None,
+    ) -> Timer:
+        """ Calls `callback` after `delay` seconds. If `interval` is given the
+            timer then repeats every `interval` seconds until cancelled.
+            Scheduling a name that is already pending replaces that timer.
+        """
+        self.cancel(name)
+        timer = Timer(self.clock() + delay, next(self._order), name, callback, interval)
+        self._timers[name] = timer
+        heapq.heappush(self._heap, timer)
+        return timer
+
+    def add(self, promise: Promise) -> Timer:
+        """ Schedules a Promise, counting down from when it was created.
+        """
+        remaining = promise.duration - (time() - promise.init)
+        return self.schedule(promise.name, max(remaining, 0.), promise.callback)
+
+    def rearm(self, name: str, delay: Optional[float] = None) -> bool:
+        """ Restarts a pending timer with the same callback, `delay` seconds
+            from now (or its interval, for repeating timers). Returns False if
+            there is no pending timer with that name.
+        """
+        timer = self._timers.get(name)
+        if timer is None:
+            return False
+        if delay is None:
+            if timer.interval is None:
+                raise ValueError("delay is required to re-arm a one-shot timer")
+            delay = timer.interval
+        self.schedule(name, delay, timer.callback, timer.interval)
+        return True
+
+    def cancel(self, name: str) -> bool:
+        """ Cancels a pending timer. Returns False if there was none.
+        """
+        timer = self._timers.pop(name, None)
+        if timer is None:
+            return False
+        timer.cancelled = True
+        # Drop dead entries once they outnumber the live ones, so re-arming
+        # the same timer over and over can't grow the heap without bound
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._timers):
+            self._heap = [t for t in self._heap if not t.cancelled]
+            heapq.heapify(self._heap)
+        return True
+
+    def _peek(self) -> Optional[Timer]:
+        heap = self._heap
+        while heap and heap[0].cancelled:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def next_deadline(self) -> Optional[float]:
+        timer = self._peek()
+        return timer.deadline if timer else None
+
+    def timeout(self) -> Optional[float]:
+        """ Seconds until the next timer is due (never negative), or None if
+            there are no timers, meaning the caller can sleep indefinitely.
+        """
+        deadline = self.next_deadline()
+        if deadline is None:
+            return None
+        return max(deadline - self.clock(), 0.)
+
+    def run_due(self) -> int:
+        """ Runs the callbacks of all timers that are due and returns how many
+            ran. Repeating timers are put back on their original schedule.
+        """
+        now = self.clock()
+        ran = 0
+        while True:
+            timer = self._peek()
+            if timer is None or timer.deadline > now:
+                return ran
+            heapq.heappop(self._heap)
+            if timer.interval is None:
+                del self._timers[timer.name]
+            else:
+                # Advance from the old deadline, not from now, to avoid drift
+                timer.deadline += timer.interval
+                if timer.deadline <= now: # Fell behind, skip the missed runs
+                    timer.deadline = now + timer.interval
+                timer.order = next(self._order)
+                heapq.heappush(self._heap, timer)
+            timer.callback()
+            ran += 1
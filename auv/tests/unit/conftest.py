@@ -0,0 +1,69 @@
+""" Unit tests for the AUV's own modules. Run `python -m pytest tests/unit`
+    from auv/. The pytest.ini here makes this directory the root, and it has
+    no __init__.py, so pytest never imports tests/__init__.py (and the
+    hardware test scripts it pulls in) or the entry point in auv/__init__.py.
+"""
+
+import os
+import itertools
+
+import pytest
+
+import models.shared_memory
+from models.shared_memory import create_shared_state, create_state_history, load_barrier
+
+_names = itertools.count()
+
+@pytest.fixture
+def shm_name():
+    """ Returns a function creating uniquely named shared memory segments, all
+        unlinked after the test.
+    """
+    created = []
+    def make(kind: str = "state", **kwargs) -> str:
+        name = "test_" + kind + "_" + str(os.getpid()) + "_" + str(next(_names))
+        if kind == "state":
+            created.append(create_shared_state(name))
+        else:
+            created.append(create_state_history(name, **kwargs))
+        return name
+    yield make
+    for shm in created:
+        shm.close()
+        shm.unlink()
+
+@pytest.fixture(params=["seqlock", "barrier", "locked"])
+def locked(request, monkeypatch) -> bool:
+    """ Runs a test with handles using the plain seqlock (as on x86), the
+        seqlock with memory barriers (as on ARM), and the lock. Pass it on as
+        their `locked`.
+    """
+    barrier = None
+    if request.param == "barrier":
+        barrier = load_barrier()
+        if barrier is None:
+            pytest.skip("No memory barrier for this CPU")
+    monkeypatch.setattr(models.shared_memory, "MEMORY_BARRIER", barrier)
+    return request.param == "locked"
+
+class FakeTime:
+    """ A clock that only moves when slept on or set by hand. Call it (or its
+        clock method) for the time.
+    """
+    def __init__(self):
+        self.now = 0.
+        self.slept = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def clock(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.slept.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def time() -> FakeTime:
+    return FakeTime()
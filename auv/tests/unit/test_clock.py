@@ -0,0 +1,129 @@
+import threading
+from typing import List, Tuple
+
+import pytest
+
+from models.clock import VirtualClock
+
+def run_tasks(clock: VirtualClock, periods: dict, iterations: int) -> List[Tuple[float, str]]:
+    """ Runs a thread per task that sleeps `period` on the clock `iterations`
+        times, and returns the (time, name) of every wakeup in order.
+    """
+    events: List[Tuple[float, str]] = []
+    def task(participant, period):
+        try:
+            for _ in range(iterations):
+                participant.sleep(period)
+                events.append((round(participant.now(), 9), participant.name))
+        finally:
+            participant.leave()
+    # Joined up front, as tasks do in their constructors
+    threads = [
+        threading.Thread(target=task, args=(clock.join(name), period))
+        for name, period in periods.items()
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+    return events
+
+def test_lockstep_order():
+    clock = VirtualClock(tick=0.001)
+    events = run_tasks(clock, {"a": 0.010, "b": 0.015}, 6)
+    expected = sorted(
+        [(round(0.010 * k, 9), "a") for k in range(1, 7)]
+        + [(round(0.015 * k, 9), "b") for k in range(1, 7)]
+    ) # Ties go to "a", which joined first
+    assert events == expected
+    assert clock.now() == pytest.approx(0.09)
+
+def test_reproducible():
+    periods = {"a": 0.0025, "b": 0.004, "c": 0.005}
+    first = run_tasks(VirtualClock(), periods, 50)
+    assert run_tasks(VirtualClock(), periods, 50) == first
+
+def test_leaving_task_does_not_stall_others():
+    clock = VirtualClock(tick=0.001)
+    events = []
+    def short(participant):
+        try:
+            participant.sleep(0.01)
+            raise RuntimeError("Task loop failed")
+        except RuntimeError:
+            pass
+        finally:
+            participant.leave()
+    def long(participant):
+        try:
+            for _ in range(5):
+                participant.sleep(0.01)
+                events.append(participant.now())
+        finally:
+            participant.leave()
+    threads = [
+        threading.Thread(target=short, args=(clock.join("short"),)),
+        threading.Thread(target=long, args=(clock.join("long"),)),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+    assert events == pytest.approx([0.01, 0.02, 0.03, 0.04, 0.05])
+
+def test_leave_is_idempotent():
+    clock = VirtualClock(tick=0.001)
+    participant = clock.join("a")
+    other = clock.join("b")
+    participant.leave()
+    participant.leave()
+    # "b" is never woken if "a" still counts, or if it stopped counting too
+    thread = threading.Thread(target=other.sleep, args=(0.005,))
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert clock.now() == pytest.approx(0.005)
+    other.leave()
+
+def test_idle_task_does_not_hold_up_time():
+    clock = VirtualClock(tick=0.001)
+    idler = clock.join("idler")
+    runner = clock.join("runner")
+    resume = threading.Event()
+    woke_at = []
+    def idle():
+        try:
+            with idler.idle():
+                resume.wait()
+            woke_at.append(idler.now())
+            idler.sleep(0.001)
+        finally:
+            idler.leave()
+    def run():
+        try:
+            for _ in range(10):
+                runner.sleep(0.01)
+            idler.wake() # Before ending its idle(), so time waits for it
+            resume.set()
+            runner.sleep(0.01)
+        finally:
+            runner.leave()
+    threads = [threading.Thread(target=idle), threading.Thread(target=run)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+    assert woke_at == pytest.approx([0.1])
+
+def test_sleep_needs_join():
+    clock = VirtualClock()
+    with pytest.raises(RuntimeError):
+        clock.sleep(0.01)
+
+def test_to_ticks_rounding():
+    clock = VirtualClock(tick=0.0005)
+    assert clock.to_ticks(0.1 + 0.2) == 600
+    assert clock.to_ticks(0.30001) == 601
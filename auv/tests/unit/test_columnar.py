@@ -0,0 +1,77 @@
+import itertools
+import json
+
+import numpy as np
+import pytest
+
+from models.data_types import MotorSpeeds
+from models.recorder import (
+    FlightRecorder, chunk_paths, load, texts, KIND_COMMAND, KIND_MOTORS, KIND_TICK,
+)
+from models.columnar import export, read_channel, read_meta
+
+@pytest.fixture
+def recording(tmp_path):
+    """ A recording of 50 motor outputs and ticks, with a command (some
+        longer than a record) after every 5th
+    """
+    recorder = FlightRecorder(tmp_path / "recordings", chunk_records=32,
+                              clock=itertools.count(1).__next__)
+    commands = []
+    for index in range(50):
+        recorder.motors(MotorSpeeds(forward=index / 50, turn=-index / 50, front=0., back=1.))
+        recorder.sample(KIND_TICK, (index, index + 1., index + 2.))
+        if index % 5 == 0:
+            command = {"command": "pid", "content": "é" * (index * 5)}
+            commands.append(command)
+            recorder.command(command)
+    recorder._stopping.set()
+    recorder.run()
+    return chunk_paths(tmp_path / "recordings"), commands
+
+@pytest.mark.parametrize("chunk_rows, batch", [(1 << 16, 1 << 16), (7, 3)])
+def test_round_trip(tmp_path, recording, chunk_rows, batch):
+    paths, commands = recording
+    records = load(paths)
+    directory = export(paths, tmp_path / "columnar", chunk_rows=chunk_rows, batch=batch)
+    meta = read_meta(directory)
+    assert meta["source"] == [path.name for path in paths]
+    assert sum(chunk["rows"] for chunk in meta["channels"]["motors"]["chunks"]) == 50
+
+    motors = read_channel(directory, "motors")
+    assert list(motors) == ["timestamp", "forward", "turn", "front", "back"]
+    np.testing.assert_array_equal(motors["forward"], np.arange(50) / 50)
+    np.testing.assert_array_equal(motors["turn"], -np.arange(50) / 50)
+    np.testing.assert_array_equal(motors["timestamp"], records["timestamp"][records["kind"] == KIND_MOTORS])
+
+    tick = read_channel(directory, "tick", ["cur_time"])
+    assert list(tick) == ["timestamp", "cur_time"]
+    np.testing.assert_array_equal(tick["cur_time"], np.arange(50) + 1.)
+
+    command = read_channel(directory, "command")
+    assert [json.loads(text) for text in command["text"]] == commands
+    assert command["timestamp"].tolist() == [timestamp for timestamp, _ in texts(records, KIND_COMMAND)]
+
+    # Channels with nothing recorded are still there, empty
+    assert len(read_channel(directory, "state")["sequence"]) == 0
+    assert len(read_channel(directory, "nmea")["text"]) == 0
+
+def test_time_range(tmp_path, recording):
+    paths, _ = recording
+    directory = export(paths, tmp_path / "columnar", chunk_rows=8)
+    motors = read_channel(directory, "motors", ["forward"])
+    start, end = motors["timestamp"][10], motors["timestamp"][20]
+    part = read_channel(directory, "motors", ["forward"], start=start, end=end)
+    np.testing.assert_array_equal(part["forward"], np.arange(10, 21) / 50)
+    assert len(read_channel(directory, "command", start=end, end=start)["text"]) == 0
+
+def test_unknown(tmp_path, recording):
+    paths, _ = recording
+    directory = export(paths, tmp_path / "columnar")
+    with pytest.raises(ValueError):
+        read_channel(directory, "sonar")
+    with pytest.raises(ValueError):
+        read_channel(directory, "motors", ["sideways"])
+    (directory / "meta.json").write_text(json.dumps({"format": "something else"}))
+    with pytest.raises(ValueError):
+        read_meta(directory)
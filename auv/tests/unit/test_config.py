@@ -0,0 +1,41 @@
+from pathlib import Path
+import shutil
+
+from models.config import load_config
+
+DATA = Path(__file__).resolve().parent.parent.parent / "data"
+
+def make_data(tmp_path: Path, local: str = None) -> Path:
+    shutil.copy(DATA / "config.yaml", tmp_path / "config.yaml")
+    if local is not None:
+        (tmp_path / "local").mkdir()
+        (tmp_path / "local" / "config.yaml").write_text(local)
+    return tmp_path
+
+def test_defaults(tmp_path):
+    config = load_config(make_data(tmp_path))
+    assert config.recorder_path == "data/recordings"
+    assert config.batch_compression == "zlib"
+
+def test_empty_local(tmp_path):
+    assert load_config(make_data(tmp_path, "")).stats_interval == 5
+
+def test_local_falsy_values(tmp_path):
+    config = load_config(make_data(tmp_path, "\n".join([
+        "recorder_path: null",
+        "stats_interval: 0",
+        "batch_window: 0",
+        "batch_compression: null",
+        "virtual_time: false",
+        "simulation: false",
+        "socket_port: 9000",
+    ])))
+    assert config.recorder_path is None
+    assert config.stats_interval == 0
+    assert config.batch_window == 0
+    assert config.batch_compression is None
+    assert config.virtual_time is False
+    assert config.simulation is False
+    assert config.socket_port == 9000
+    # Everything else keeps its default
+    assert config.batch_bytes == 1024
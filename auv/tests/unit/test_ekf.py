@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from scipy.spatial.transform import Rotation
+
+from api.localization.extended_filter import (
+    EKF, ImuData, GpsCoordinate, GpsVelocity,
+    G, EARTH_RADIUS, TAU_A, P_P_INIT, P_V_INIT, P_AB_INIT,
+)
+
+class ReferenceEKF:
+    """ The filter written out with dense matrices, to check the in place one
+        against
+    """
+    def __init__(self, ekf: EKF, gps_vel: GpsVelocity, gps_coord: GpsCoordinate):
+        self.ekf = ekf # Only for its constants and frame helpers
+        self.lla = np.array([gps_coord.lat, gps_coord.lon, gps_coord.alt])
+        self.V = np.array([gps_vel.vN, gps_vel.vE, gps_vel.vD])
+        self.bias = np.zeros(3)
+        self.P = np.diag([P_P_INIT**2] * 3 + [P_V_INIT**2] * 3 + [P_AB_INIT**2] * 3)
+
+    def predict(self, dt: float, imu: ImuData, q: np.ndarray):
+        C_B2N = Rotation.from_quat([q[1], q[2], q[3], q[0]]).as_matrix()
+        f_b = np.array([imu.accX, imu.accY, imu.accZ]) - self.bias
+        self.V += (C_B2N @ f_b + [0., 0., G]) * dt
+        self.lla += self.ekf._llarate(self.V, self.lla[0], self.lla[2]) * dt
+
+        Fs = np.zeros((9, 9))
+        Fs[0:3, 3:6] = np.identity(3)
+        Fs[5, 2] = 2. * G / EARTH_RADIUS
+        Fs[3:6, 6:9] = -C_B2N
+        Fs[6:9, 6:9] = -np.identity(3) / TAU_A
+        PHI = np.identity(9) + Fs * dt
+        Gs = np.zeros((9, 6))
+        Gs[3:6, 0:3] = -C_B2N
+        Gs[6:9, 3:6] = np.identity(3)
+        Q = PHI @ Gs @ self.ekf.Rw @ Gs.T * dt
+        Q = 0.5 * (Q + Q.T)
+        P = PHI @ self.P @ PHI.T + Q
+        self.P = 0.5 * (P + P.T) + np.identity(9) * 1e-12
+
+    def correct(self, gps_vel: GpsVelocity, gps_coord: GpsCoordinate):
+        ekf = self.ekf
+        lla_gps = np.array([gps_coord.lat, gps_coord.lon, gps_coord.alt])
+        y = np.concatenate([
+            ekf._ecef2ned(ekf._lla2ecef(lla_gps) - ekf._lla2ecef(self.lla), self.lla),
+            np.array([gps_vel.vN, gps_vel.vE, gps_vel.vD]) - self.V,
+        ])
+        H, R = ekf.H, ekf.R
+        K = self.P @ H.T @ np.linalg.inv(H @ self.P @ H.T + R)
+        x_err = K @ y
+        lat, _lon, alt = self.lla
+        Rew, Rns = ekf._earth_radius(lat)
+        self.lla += [x_err[0] / (Rns + alt), x_err[1] / ((Rew + alt) * np.cos(lat)), -x_err[2]]
+        self.V += x_err[3:6]
+        self.bias += x_err[6:9]
+        I_KH = np.identity(9) - K @ H
+        P = I_KH @ self.P @ I_KH.T + K @ R @ K.T
+        self.P = 0.5 * (P + P.T) + np.identity(9) * 1e-12
+
+def test_matches_reference():
+    rng = np.random.default_rng(0)
+    start = GpsCoordinate(lat=np.radians(32.7), lon=np.radians(-117.2), alt=0.)
+    ekf = EKF()
+    ekf.initialize(GpsVelocity(0.5, -0.2, 0.), start)
+    reference = ReferenceEKF(ekf, GpsVelocity(0.5, -0.2, 0.), start)
+    assert ekf.initialized()
+    dt = 0.02
+    for step in range(1, 201):
+        q = Rotation.from_euler("xyz", [5., -3., step * 0.5], degrees=True).as_quat()
+        q = np.array([q[3], q[0], q[1], q[2]])
+        # About at rest, so specific force is -g in the (down) body z
+        imu = ImuData(*(rng.normal(0., 0.05, 3) + [0.1, 0., -G]))
+        ekf.predict(dt, imu, q)
+        reference.predict(dt, imu, q)
+        if step % 10 == 0:
+            gps_coord = GpsCoordinate(
+                lat=start.lat + rng.normal(0., 1e-6), lon=start.lon + rng.normal(0., 1e-6), alt=0.,
+            )
+            gps_vel = GpsVelocity(*rng.normal(0., 0.1, 2), 0.)
+            ekf.correct(gps_vel, gps_coord)
+            reference.correct(gps_vel, gps_coord)
+        np.testing.assert_allclose(ekf.lla_ins, reference.lla, rtol=1e-12)
+        np.testing.assert_allclose(ekf.V_ins, reference.V, rtol=1e-9, atol=1e-12)
+        np.testing.assert_allclose(ekf.accel_bias, reference.bias, rtol=1e-9, atol=1e-12)
+        np.testing.assert_allclose(ekf.P, reference.P, rtol=1e-9, atol=1e-12)
+
+def test_correct_before_initialize():
+    ekf = EKF()
+    ekf.correct(GpsVelocity(1., 0., 0.), GpsCoordinate(0.5, 0.5, 0.))
+    assert not ekf.initialized()
+    assert ekf.lat_ins == 0.
@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from models.data_types import MotorSpeeds
+from api.mock_controller import MockController, motion_model, STATE_SIZE
+from api.monte_carlo import (
+    BatchSimulator, RolloutSpec, motion_model_batch, quaternion_to_euler_batch,
+)
+
+STEP = 2.**-10 # Exact in binary, so both take the same number of steps
+
+def random_states(rng: np.random.Generator, n: int) -> np.ndarray:
+    Y = rng.normal(0., 1., (n, STATE_SIZE))
+    Y[:, 6:10] /= np.linalg.norm(Y[:, 6:10], axis=1)[:, None]
+    return Y
+
+def test_quaternion_to_euler_batch():
+    q = random_states(np.random.default_rng(0), 50)[:, 6:10]
+    out = np.zeros((50, 3))
+    quaternion_to_euler_batch(q, out)
+    np.testing.assert_allclose(out, Rotation.from_quat(q).as_euler("XYZ", degrees=True), atol=1e-9)
+    # Scaling the quaternion doesn't change the angles
+    np.testing.assert_allclose(quaternion_to_euler_batch(3. * q, np.zeros((50, 3))), out, atol=1e-9)
+
+def test_motion_model_batch():
+    rng = np.random.default_rng(1)
+    Y = random_states(rng, 20)
+    a_local, alpha_local = rng.normal(0., 1., (20, 3)), rng.normal(0., 1., (20, 3))
+    out = np.zeros((20, STATE_SIZE))
+    motion_model_batch(Y, a_local, alpha_local, np.zeros(3), out)
+    for y, a, alpha, derivative in zip(Y, a_local, alpha_local, out):
+        np.testing.assert_allclose(derivative, motion_model(y, a, alpha), atol=1e-12)
+    # The local acceleration is rotated into the global frame as scipy does
+    accelerations = Rotation.from_quat(Y[:, 6:10]).apply(a_local)
+    np.testing.assert_allclose(out[:, 3:6], accelerations - Y[:, 3:6], atol=1e-12)
+
+def test_matches_mock_controller(time):
+    speeds = MotorSpeeds(forward=0.6, turn=0.3, front=0.4, back=-0.2)
+    mock = MockController(lambda message: None, step=STEP, clock=SimpleNamespace(now=time))
+    mock.set_speeds(speeds)
+
+    spec = RolloutSpec(mass_sigma=0., inertia_sigma=0., disturbance_sigma=0.)
+    simulator = BatchSimulator(spec, 1, np.random.default_rng(0))
+    simulator.set_speeds(np.array([[speeds.forward, speeds.turn, speeds.front, speeds.back]]))
+
+    for _ in range(4): # 0.5 s each
+        time.now += 0.5
+        state = mock.get_state()
+        for _ in range(512):
+            simulator.integrate(STEP)
+        y = simulator.Y[0]
+        np.testing.assert_allclose(y, mock.y, atol=1e-9)
+        attitude = quaternion_to_euler_batch(simulator.Y[:, 6:10], np.zeros((1, 3)))[0]
+        np.testing.assert_allclose(attitude, state.attitude, atol=1e-9)
+        np.testing.assert_allclose(attitude, Rotation.from_quat(y[6:10]).as_euler("XYZ", degrees=True), atol=1e-9)
+        np.testing.assert_allclose(y[0:3], state.position, atol=1e-9)
+    # It went somewhere, turning and pitching
+    assert np.all(np.abs(state.attitude[1:]) > 1.)
+    assert np.linalg.norm(state.position) > 0.1
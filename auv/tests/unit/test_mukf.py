@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from scipy.spatial.transform import Rotation
+
+from api.localization.unscented_quat import MUKF, N_AUG, N_SIGMA
+
+def to_rotation(q: np.ndarray) -> Rotation:
+    w, x, y, z = q
+    return Rotation.from_quat([x, y, z, w])
+
+def measurements(rotation: Rotation):
+    """ Accelerometer and magnetometer readings as the filter's measurement
+        model predicts them for `rotation`: its matrix times z and x
+    """
+    matrix = rotation.as_matrix()
+    return matrix[:, 2] * 9.8, matrix[:, 0] * 50.
+
+def test_at_rest_stays_put():
+    mukf = MUKF()
+    am, mm = measurements(Rotation.identity())
+    for _ in range(50):
+        mukf.update_imu(am, np.zeros(3), mm, 0.01)
+    np.testing.assert_allclose(mukf.get_current_orientation(), [1., 0., 0., 0.], atol=1e-9)
+    np.testing.assert_allclose(mukf.w, 0., atol=1e-9)
+    # Every sigma point has its mirror image, and the weights add up to one
+    assert len(mukf._weights) == N_SIGMA
+    assert mukf._weights.sum() == pytest.approx(1.)
+    np.testing.assert_array_equal(mukf._offsets[1:N_AUG + 1], -mukf._offsets[N_AUG + 1:])
+    assert np.all(np.linalg.eigvalsh(mukf.P) > 0.)
+
+@pytest.mark.parametrize("euler", [[20., -10., 30.], [0., 0., 90.], [-5., 15., -120.]])
+def test_converges_to_known_rotation(euler):
+    truth = Rotation.from_euler("xyz", euler, degrees=True)
+    mukf = MUKF()
+    am, mm = measurements(truth)
+    for _ in range(300):
+        mukf.update_imu(am, np.zeros(3), mm, 0.01)
+    q = mukf.get_current_orientation()
+    assert np.linalg.norm(q) == pytest.approx(1.)
+    assert (to_rotation(q).inv() * truth).magnitude() < np.radians(0.5)
+    np.testing.assert_allclose(mukf.w, 0., atol=1e-3)
+
+def test_tracks_yaw_rate():
+    rate = np.array([0., 0., 0.5])
+    dt = 0.01
+    mukf = MUKF()
+    for step in range(1, 501):
+        truth = Rotation.from_rotvec(rate * dt * step)
+        am, mm = measurements(truth)
+        mukf.update_imu(am, rate, mm, dt)
+    assert (to_rotation(mukf.get_current_orientation()).inv() * truth).magnitude() < np.radians(0.5)
+    np.testing.assert_allclose(mukf.w, rate, atol=1e-3)
@@ -0,0 +1,117 @@
+from queue import Empty
+import threading
+
+import pytest
+
+from models.outbound import OutboundQueue
+
+def drain(queue: OutboundQueue) -> list:
+    items = []
+    while True:
+        try:
+            items.append(queue.get_nowait())
+        except Empty:
+            return items
+
+def test_priorities():
+    queue = OutboundQueue()
+    queue.put("log 1")
+    queue.put({"state": 1}, "telemetry", topic="state")
+    queue.put("ack 1", "critical")
+    queue.put("log 2", "normal")
+    queue.put("ack 2", "critical")
+    assert queue.qsize() == 5
+    assert drain(queue) == ["ack 1", "ack 2", {"state": 1}, "log 1", "log 2"]
+    assert queue.empty()
+
+def test_telemetry_latest_only():
+    queue = OutboundQueue()
+    for sample in range(5):
+        queue.put(sample, "telemetry", topic="state")
+    queue.put("stats", "telemetry", topic="task_stats")
+    assert drain(queue) == [4, "stats"]
+    assert queue.dropped == {"critical": 0, "telemetry": 4, "normal": 0}
+
+def test_telemetry_rate_limit(time):
+    # Times exact in binary, so the grid of the rate lands on samples exactly
+    queue = OutboundQueue(rates={"state": 8., "unlimited": 0.}, clock=time)
+    sent = []
+    for step in range(64): # 1 s, with a sample every 1/64 s
+        time.now = step / 64
+        queue.put(("state", step), "telemetry", topic="state")
+        queue.put(("unlimited", step), "telemetry", topic="unlimited")
+        sent.extend(drain(queue))
+    state = [step for topic, step in sent if topic == "state"]
+    assert state == list(range(0, 64, 8)) # 8 Hz, each the latest sample
+    assert len(sent) - len(state) == 64 # Every sample of the other
+    assert queue.dropped["telemetry"] == 55 # The last one is still waiting
+    assert queue.qsize() == 1
+
+def test_rate_limit_waits(time):
+    queue = OutboundQueue(rates={"state": 10.}, clock=time)
+    queue.put("first", "telemetry", topic="state")
+    assert queue.get_nowait() == "first"
+    queue.put("second", "telemetry", topic="state")
+    assert queue.time_until_ready() == pytest.approx(0.1)
+    with pytest.raises(Empty):
+        queue.get_nowait()
+    # Other classes aren't held up by it
+    queue.put("log")
+    assert queue.time_until_ready() == 0.
+    assert queue.get_nowait() == "log"
+    time.now = 0.1
+    assert queue.time_until_ready() == 0.
+    assert queue.get_nowait() == "second"
+    assert queue.time_until_ready() is None
+
+def test_rate_limit_stays_on_grid(time):
+    queue = OutboundQueue(rates={"state": 10.}, clock=time)
+    sent = []
+    for step in range(1000): # 1 s, polled every ms, sent a bit late each time
+        time.now = step * 0.001
+        queue.put(step, "telemetry", topic="state")
+        sent.extend(drain(queue))
+    assert len(sent) == 10
+
+    time.now = 5. # More than a period behind starts a new grid from now
+    queue.put("late", "telemetry", topic="state")
+    assert drain(queue) == ["late"]
+    queue.put("next", "telemetry", topic="state")
+    assert queue.time_until_ready() == pytest.approx(0.1)
+
+def test_normal_bounded():
+    queue = OutboundQueue(normal_size=3)
+    for item in range(5):
+        queue.put(item)
+    assert drain(queue) == [2, 3, 4]
+    assert queue.dropped["normal"] == 2
+
+def test_critical_bounded():
+    queue = OutboundQueue(critical_size=3)
+    for item in range(5):
+        queue.put(item, "critical")
+    assert drain(queue) == [2, 3, 4]
+    assert queue.dropped["critical"] == 2
+
+def test_telemetry_needs_topic():
+    with pytest.raises(ValueError):
+        OutboundQueue().put("state", "telemetry")
+
+def test_listeners():
+    queue = OutboundQueue()
+    calls = []
+    listener = lambda: calls.append(queue.qsize())
+    queue.add_listener(listener)
+    queue.put("a")
+    queue.remove_listener(listener)
+    queue.put("b")
+    assert calls == [1]
+
+def test_blocking_get():
+    queue = OutboundQueue()
+    with pytest.raises(Empty):
+        queue.get(timeout=0.01)
+    timer = threading.Timer(0.05, queue.put, args=("ack", "critical"))
+    timer.start()
+    assert queue.get(timeout=5.) == "ack"
+    timer.join()
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from models.pid import VectorPID, wrap_degrees
+
+def test_wrap_degrees():
+    angles = np.array([0., 180., -180., 190., -190., 540., 359.])
+    out = np.empty_like(angles)
+    np.testing.assert_allclose(
+        wrap_degrees(angles, out), [0., -180., -180., -170., 170., -180., -1.],
+    )
+
+def test_proportional():
+    pid = VectorPID(Kp=[1., 2., 3.], Ki=0., Kd=0.)
+    output = pid.update([1., 1., 1.], [0., 0.5, 2.], 0.1)
+    np.testing.assert_allclose(output, [1., 1., -3.])
+
+def test_wrapped_error():
+    pid = VectorPID(Kp=[1., 1.], Ki=0., Kd=0., wrap=[True, False])
+    np.testing.assert_allclose(pid.update([170., 170.], [-170., -170.], 0.1), [-20., 340.])
+
+def test_wrapped_derivative():
+    pid = VectorPID(Kp=[0.], Ki=0., Kd=1., wrap=[True])
+    pid.update([0.], [179.], 0.1)
+    # Crossing +/-180 is a 2 degree step, not a 358 degree one
+    np.testing.assert_allclose(pid.update([0.], [-179.], 0.1), [-20.])
+
+def test_derivative_on_measurement_does_not_kick():
+    on_measurement = VectorPID(Kp=[0.], Ki=0., Kd=1.)
+    on_error = VectorPID(Kp=[0.], Ki=0., Kd=1., derivative_on_measurement=False)
+    for pid in (on_measurement, on_error):
+        pid.update([0.], [0.], 0.1)
+    # A setpoint step with the measurement still
+    assert on_measurement.update([1.], [0.], 0.1)[0] == pytest.approx(0.)
+    assert on_error.update([1.], [0.], 0.1)[0] == pytest.approx(10.)
+    # Both see the measurement moving
+    assert on_measurement.update([1.], [0.5], 0.1)[0] == pytest.approx(-5.)
+    assert on_error.update([1.], [0.5], 0.1)[0] == pytest.approx(-5.)
+
+def test_first_update_has_no_derivative():
+    pid = VectorPID(Kp=[0.], Ki=0., Kd=1.)
+    assert pid.update([0.], [5.], 0.1)[0] == 0.
+    pid.reset()
+    assert pid.update([0.], [10.], 0.1)[0] == 0.
+
+def test_known_rate():
+    pid = VectorPID(Kp=[0., 0.], Ki=0., Kd=2.)
+    np.testing.assert_allclose(pid.update([0., 0.], [0., 0.], 0.1, rate=np.array([1., -3.])), [-2., 6.])
+
+def test_derivative_filter():
+    pid = VectorPID(Kp=[0.], Ki=0., Kd=1., derivative_filter=0.9)
+    pid.update([0.], [0.], 0.1)
+    pid.update([0.], [0.], 0.1)
+    # A -10/s step in the rate only gets a tenth of the way there in one tick
+    assert pid.update([0.], [1.], 0.1)[0] == pytest.approx(-1.)
+
+def test_integral_windup_clamp():
+    pid = VectorPID(Kp=[0.], Ki=1., Kd=0., windup=2.)
+    for _ in range(100):
+        output = pid.update([10.], [0.], 0.1)
+    assert pid.integral[0] == pytest.approx(2.)
+    assert output[0] == pytest.approx(2.)
+    # Comes straight back once the error changes sign
+    pid.update([-10.], [0.], 0.1)
+    assert pid.integral[0] == pytest.approx(1.)
+
+def test_saturated_output_stops_integrating():
+    pid = VectorPID(Kp=[1.], Ki=1., Kd=0., output_limit=5.)
+    for _ in range(100):
+        output = pid.update([10.], [0.], 0.1)
+    assert output[0] == pytest.approx(5.)
+    assert pid.integral[0] == pytest.approx(0.)
+    # So there's nothing to unwind once the error reverses
+    assert pid.update([-1.], [0.], 0.1)[0] == pytest.approx(-1.1)
+
+def test_batch():
+    pid = VectorPID(Kp=[1., 2.], Ki=0., Kd=0., batch=(3,))
+    setpoints = np.array([[1., 1.], [2., 2.], [3., 3.]])
+    output = pid.update(setpoints, np.zeros((3, 2)), 0.1)
+    assert output.shape == (3, 2)
+    np.testing.assert_allclose(output, [[1., 2.], [2., 4.], [3., 6.]])
+
+def test_set_gains():
+    pid = VectorPID(Kp=[1., 1.], Ki=0., Kd=0.)
+    pid.set_gains(1, p=3.)
+    np.testing.assert_allclose(pid.update([1., 1.], [0., 0.], 0.1), [1., 3.])
+
+def test_update_does_not_allocate_output():
+    pid = VectorPID(Kp=[1., 1.], Ki=0., Kd=0.)
+    assert pid.update([1., 1.], [0., 0.], 0.1) is pid.output
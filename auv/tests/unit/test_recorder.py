@@ -0,0 +1,134 @@
+import itertools
+import json
+import time
+
+import numpy as np
+import pytest
+
+from models.data_types import MotorSpeeds, State
+from models.shared_memory import StateHistoryHandle
+from models.recorder import (
+    FlightRecorder, chunk_paths, load, read_chunk, texts,
+    KIND_STATE, KIND_MOTORS, KIND_COMMAND, KIND_TASK, KIND_GAP, KIND_TEXT,
+    KIND_NMEA, KIND_ACCEL,
+)
+
+def fake_clock():
+    """ 1, 2, 3, ... on every call """
+    return itertools.count(1).__next__
+
+def record(recorder: FlightRecorder):
+    """ Runs the writer once in this thread, as if stopped right away """
+    recorder._stopping.set()
+    recorder.run()
+
+def test_round_trip(tmp_path):
+    recorder = FlightRecorder(tmp_path, clock=fake_clock())
+    long_event = "Localization " + "x" * 300 # Spans several records
+    recorder.motors(MotorSpeeds(forward=0.5, turn=-0.25, front=0., back=1.))
+    recorder.command({"command": "pid", "content": {"p": 1.5}})
+    recorder.task_event("Control", "startup")
+    recorder.task_event("Localization", long_event)
+    recorder.sample(KIND_ACCEL, (0.1, 0.2, 9.8))
+    recorder.nmea(b"$GPRMC,\xb0\r\n")
+    record(recorder)
+
+    records = load(chunk_paths(tmp_path))
+    assert recorder.records_written == len(records)
+    heads = records[records["kind"] != KIND_TEXT]
+    assert heads["kind"].tolist() == [KIND_MOTORS, KIND_COMMAND, KIND_TASK, KIND_TASK, KIND_ACCEL, KIND_NMEA]
+    np.testing.assert_array_equal(heads["timestamp"], [1., 2., 3., 4., 5., 6.])
+    np.testing.assert_array_equal(heads["data"][0, :4], [0.5, -0.25, 0., 1.])
+    np.testing.assert_array_equal(heads["data"][4, :3], [0.1, 0.2, 9.8])
+    assert [json.loads(text) for _, text in texts(records, KIND_COMMAND)] \
+        == [{"command": "pid", "content": {"p": 1.5}}]
+    assert list(texts(records, KIND_TASK)) \
+        == [(3., "Control startup"), (4., "Localization " + long_event)]
+    assert list(texts(records, KIND_NMEA)) == [(6., "$GPRMC,\xb0\r\n")]
+
+def test_chunks(tmp_path):
+    recorder = FlightRecorder(tmp_path, chunk_records=4, clock=fake_clock())
+    for index in range(10):
+        recorder.sample(KIND_ACCEL, (index, 0., 0.))
+    record(recorder)
+    paths = chunk_paths(tmp_path)
+    assert len(paths) == 3
+    assert [len(read_chunk(path)) for path in paths] == [4, 4, 2]
+    np.testing.assert_array_equal(load(paths)["data"][:, 0], np.arange(10))
+
+def test_latest_recording(tmp_path):
+    first = FlightRecorder(tmp_path, clock=fake_clock())
+    first.prefix = "flight_1"
+    first.motors(MotorSpeeds(forward=0., turn=0., front=0., back=0.))
+    record(first)
+    second = FlightRecorder(tmp_path, clock=fake_clock())
+    second.prefix = "flight_2"
+    record(second) # Nothing recorded, so no files
+    assert chunk_paths(tmp_path) == chunk_paths(tmp_path, prefix="flight_1")
+    assert chunk_paths(tmp_path, name="sensors") == []
+    assert len(load([])) == 0
+
+def test_pending_overflow(tmp_path):
+    recorder = FlightRecorder(tmp_path, clock=fake_clock(), pending_size=4)
+    for index in range(10):
+        recorder.sample(KIND_ACCEL, (index, 0., 0.))
+    assert recorder.records_lost == 6
+    record(recorder)
+    records = load(chunk_paths(tmp_path))
+    gaps = records[records["kind"] == KIND_GAP]
+    assert len(gaps) == 1
+    assert gaps["sequence"][0] == 0 # Not about states
+    assert gaps["data"][0, 0] == 6
+    # The oldest were dropped
+    np.testing.assert_array_equal(records[records["kind"] == KIND_ACCEL]["data"][:, 0], [6, 7, 8, 9])
+
+def start_with_history(recorder: FlightRecorder):
+    recorder.start()
+    # It only records states appended once it has started up
+    time.sleep(0.2)
+
+def append_states(history: StateHistoryHandle, first: int, last: int):
+    state = State()
+    for value in range(first, last + 1):
+        state.position[:] = value
+        state.angular_velocity[:] = -value
+        history.append(state, timestamp=float(value))
+
+def test_states(tmp_path, shm_name):
+    name = shm_name("history")
+    history = StateHistoryHandle(name)
+    append_states(history, 1, 2) # Before the recorder started
+    recorder = FlightRecorder(tmp_path, history=name, flush_interval=60.)
+    start_with_history(recorder)
+    append_states(history, 3, 7)
+    recorder.stop()
+    history.close()
+    states = load(chunk_paths(tmp_path))
+    assert states["kind"].tolist() == [KIND_STATE] * 5
+    assert states["sequence"].tolist() == [3, 4, 5, 6, 7]
+    np.testing.assert_array_equal(states["timestamp"], [3., 4., 5., 6., 7.])
+    np.testing.assert_array_equal(states["data"][:, 0], [3., 4., 5., 6., 7.])
+    np.testing.assert_array_equal(states["data"][:, 11], [-3., -4., -5., -6., -7.])
+
+def test_lapped_history(tmp_path, shm_name):
+    slots = 8
+    name = shm_name("history", slots=slots)
+    history = StateHistoryHandle(name, slots=slots)
+    recorder = FlightRecorder(tmp_path, history=name, history_slots=slots, flush_interval=60.)
+    start_with_history(recorder)
+    append_states(history, 1, 20)
+    recorder.stop()
+    history.close()
+    records = load(chunk_paths(tmp_path))
+    gap = records[0]
+    assert gap["kind"] == KIND_GAP
+    # Only slots - 2 states can be read at once, the rest are reported lost
+    assert (gap["sequence"], gap["data"][0]) == (1, 14)
+    assert recorder.states_lost == 14
+    assert records["sequence"][1:].tolist() == list(range(15, 21))
+
+def test_not_a_recording(tmp_path):
+    path = tmp_path / "flight_1_0000.fdr"
+    path.write_bytes(b"\x00" * 128)
+    with pytest.raises(ValueError):
+        read_chunk(path)
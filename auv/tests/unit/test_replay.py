@@ -0,0 +1,120 @@
+import time
+
+import api.replay
+from api.replay import replay, load_recording, ReplayController
+from models.data_types import State, MotorSpeeds
+from models.shared_memory import StateHistoryHandle
+from models.recorder import FlightRecorder, KIND_TICK, KIND_ACCEL, KIND_DEPTH
+
+START = 10.
+PERIOD = 0.05
+TICKS = 40
+
+def fake_filter(prev_time, _i2c, imu, _magnetometer, _serial, _ekf, _mukf, cur_time):
+    """ Reads one acceleration per tick and passes it on as the estimate """
+    ax, ay, az = imu.acceleration
+    state = State()
+    state.position[:2] = [ax, ay]
+    state.attitude[2] = az
+    state.velocity[0] = cur_time - prev_time
+    return state
+
+def tick_time(index: int) -> float:
+    return START + index * PERIOD
+
+def depth(index: int) -> float:
+    return 1. + index * 0.01
+
+def expected_state(index: int) -> State:
+    """ What fake_filter() and replay() make of the samples of a tick. There
+        is no depth sample every 8th tick, so the one before is read again.
+    """
+    state = State()
+    if index % 8 == 0:
+        read = depth(index - 1) if index > 0 else 0.
+    else:
+        read = depth(index)
+    state.position[:] = [index * 0.1, -index * 0.05, -read]
+    state.attitude[2] = index * 2.
+    now = tick_time(index)
+    state.velocity[0] = now - (now - PERIOD)
+    return state
+
+def record_run(directory, shm_name, motors=((), ())):
+    """ Records a synthetic run: a sensor recording of TICKS ticks, with a
+        second acceleration every 5th tick and no depth every 8th, and a
+        flight recording of the states, Control being active, and `motors`
+        as (times, outputs).
+    """
+    now = [0.]
+    clock = lambda: now[0]
+    sensors = FlightRecorder(directory, clock=clock, name="sensors")
+    for index in range(TICKS):
+        state = expected_state(index)
+        now[0] = tick_time(index) - 0.02
+        sensors.sample(KIND_ACCEL, (state.position[0], state.position[1], state.attitude[2]))
+        if index % 5 == 0:
+            now[0] += 0.001
+            sensors.sample(KIND_ACCEL, (0., 0., 0.)) # Never read
+        if index % 8 != 0:
+            now[0] = tick_time(index) - 0.01
+            sensors.sample(KIND_DEPTH, (depth(index),))
+        now[0] = tick_time(index)
+        sensors.sample(KIND_TICK, (now[0] - PERIOD, now[0], now[0]))
+    sensors._stopping.set()
+    sensors.run()
+
+    history_name = shm_name("history")
+    history = StateHistoryHandle(history_name)
+    try:
+        flight = FlightRecorder(directory, history=history_name, clock=clock, flush_interval=60.)
+        flight.start()
+        time.sleep(0.2) # Only states appended once it has started are recorded
+        now[0] = START - 1.
+        flight.task_event("Control", "activate")
+        flight.command({"command": "ping"})
+        for index in range(TICKS):
+            history.append(expected_state(index), tick_time(index))
+        for timestamp, output in zip(*motors):
+            now[0] = timestamp
+            flight.motors(MotorSpeeds(forward=output[0], turn=output[1], front=output[2], back=output[3]))
+        flight.stop()
+    finally:
+        history.close()
+    return load_recording(directory)
+
+def run_replay(sensors, flight, monkeypatch):
+    """ replay() with fake_filter(), also returning the motor outputs """
+    controllers = []
+    class KeptController(ReplayController):
+        def __init__(self, clock):
+            super().__init__(clock)
+            controllers.append(self)
+    monkeypatch.setattr(api.replay, "ReplayController", KeptController)
+    result = replay(sensors, flight, kalman_filter=fake_filter, setup_filters=lambda: (None, None))
+    return result, (controllers[0].times, controllers[0].outputs)
+
+def test_round_trip(tmp_path, shm_name, monkeypatch):
+    # The motor outputs of the "run" are those Control gives on its states
+    (tmp_path / "first").mkdir()
+    sensors, flight = record_run(tmp_path / "first", shm_name)
+    _first, motors = run_replay(sensors, flight, monkeypatch)
+    assert len(motors[0]) > 0
+
+    (tmp_path / "second").mkdir()
+    sensors, flight = record_run(tmp_path / "second", shm_name, motors)
+    result, replayed = run_replay(sensors, flight, monkeypatch)
+    assert replayed == motors # Deterministic
+
+    assert result["ticks"] == TICKS
+    assert result["state"]["compared"] == result["state"]["recorded"] == TICKS
+    assert max(result["state"]["max"].values()) == 0.
+    assert result["motors"]["compared"] == len(motors[0])
+    assert max(result["motors"]["max"].values()) == 0.
+    assert result["commands"] == {"applied": 0, "skipped": {"ping": 1}}
+
+    counts = result["sensors"]
+    assert counts["accel"] == {"recorded": TICKS + TICKS // 5, "unread": TICKS // 5, "extra": 0}
+    # A tick without a depth sample reads the last one again (or 0 at first)
+    assert counts["depth"] == {"recorded": TICKS - TICKS // 8, "unread": 0, "extra": TICKS // 8}
+    assert counts["nmea"] == {"recorded": 0, "unread": 0, "extra": 0}
@@ -0,0 +1,69 @@
+import pytest
+
+from models.scheduler import RateScheduler
+
+def make(time, **kwargs) -> RateScheduler:
+    return RateScheduler(100, clock=time.clock, sleep_func=time.sleep, **kwargs)
+
+def test_no_drift(time):
+    scheduler = make(time)
+    for k in range(1, 101):
+        time.now += 0.003 # The loop body
+        assert scheduler.wait() == 0
+        assert time.now == pytest.approx(k * 0.01)
+    assert scheduler.overruns == 0
+    assert scheduler.max_lateness == pytest.approx(0.)
+
+def test_skip(time):
+    scheduler = make(time, catch_up="skip")
+    time.now = 0.035 # Deadline 0.01 overrun by 2.5 periods
+    assert scheduler.wait() == 2
+    assert time.slept == [] # Runs again immediately
+    assert scheduler.lateness == pytest.approx(0.025)
+    # Then rejoins the grid, without the deadlines at 0.02 and 0.03
+    assert scheduler.wait() == 0
+    assert time.now == pytest.approx(0.04)
+    assert (scheduler.overruns, scheduler.missed) == (1, 2)
+
+def test_burst(time):
+    scheduler = make(time, catch_up="burst")
+    time.now = 0.035
+    iterations = 0
+    while not time.slept:
+        scheduler.wait()
+        iterations += 1
+    # The deadlines at 0.01 through 0.03 ran back to back, then 0.04 was slept to
+    assert iterations == 4
+    assert time.now == pytest.approx(0.04)
+    assert scheduler.wait() == 0
+    assert time.now == pytest.approx(0.05)
+    # One overrun, and every deadline ran
+    assert (scheduler.overruns, scheduler.missed) == (1, 0)
+
+def test_burst_limit(time):
+    scheduler = make(time, catch_up="burst", max_burst=3)
+    time.now = 0.105 # 9 periods behind, more than max_burst
+    assert scheduler.wait() == 9
+    assert scheduler.wait() == 0 # So it skips like "skip" does
+    assert time.now == pytest.approx(0.11)
+    assert (scheduler.overruns, scheduler.missed) == (1, 9)
+
+def test_reset(time):
+    scheduler = make(time, catch_up="reset")
+    time.now = 0.035
+    assert scheduler.wait() == 2
+    assert scheduler.wait() == 0
+    assert time.now == pytest.approx(0.045) # A new grid from when it overran
+
+def test_reset_after_pause(time):
+    scheduler = make(time)
+    time.now = 5.
+    scheduler.reset()
+    assert scheduler.wait() == 0
+    assert time.now == pytest.approx(5.01)
+    assert scheduler.overruns == 0
+
+@pytest.mark.parametrize("kwargs", [{"rate_hz": 0}, {"rate_hz": 10, "catch_up": "wait"}])
+def test_invalid(kwargs):
+    with pytest.raises(ValueError):
+        RateScheduler(**kwargs)
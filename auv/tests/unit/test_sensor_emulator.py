@@ -0,0 +1,90 @@
+from math import cos, degrees, radians, sqrt
+from types import SimpleNamespace
+
+import numpy as np
+import pynmea2
+import pytest
+from scipy.spatial.transform import Rotation
+
+from api.localization.main import parse_gprmc
+from api.sensor_emulator import (
+    SensorEmulator, EmulatorSpec, NoiseSpec, Truth, rmc_sentence,
+    G, EARTH_RADIUS, KNOTS,
+)
+
+def make_truth(position=(0., 0., 0.), velocity=(0., 0., 0.), rotation=None) -> Truth:
+    return Truth(
+        timestamp=0.,
+        position=np.array(position, dtype=float),
+        velocity=np.array(velocity, dtype=float),
+        acceleration=np.zeros(3),
+        rotation=np.eye(3) if rotation is None else rotation,
+        angular_velocity=np.zeros(3),
+    )
+
+def quiet_spec(**kwargs) -> EmulatorSpec:
+    """ No noise or bias anywhere """
+    return EmulatorSpec(
+        accel=NoiseSpec(), gyro=NoiseSpec(), mag=NoiseSpec(),
+        gps_position_noise=0., gps_speed_noise=0., pressure_noise=0., **kwargs,
+    )
+
+def make_emulator(time, truth: Truth, spec: EmulatorSpec) -> SensorEmulator:
+    return SensorEmulator(lambda: truth, spec, clock=SimpleNamespace(now=time, sleep=time.sleep))
+
+def test_rmc_sentence():
+    spec = quiet_spec()
+    truth = make_truth(position=(100., -50., 0.), velocity=(1., -1., 0.))
+    sentence = rmc_sentence(truth, spec, np.random.default_rng(0), unix_time=1.7e9 + 0.25)
+    assert sentence.endswith("\r\n")
+    message = pynmea2.parse(sentence.strip(), check=True)
+    assert message.status == "A"
+    assert message.datestamp.strftime("%d%m%y") == "141123"
+    assert message.latitude == pytest.approx(spec.origin[0] + degrees(100. / EARTH_RADIUS), abs=1e-6)
+    # 50 m west is east of the origin by as much
+    east = degrees(50. / (EARTH_RADIUS * cos(radians(spec.origin[0]))))
+    assert message.longitude == pytest.approx(spec.origin[1] + east, abs=1e-6)
+    assert message.spd_over_grnd == pytest.approx(sqrt(2.) * KNOTS, abs=0.01)
+    assert message.true_course == pytest.approx(45.)
+    # And localize() reads it back the same way
+    assert parse_gprmc(sentence.strip()) == (
+        message.latitude, message.longitude, message.spd_over_grnd, message.true_course,
+    )
+
+def test_rmc_sentence_under_water():
+    sentence = rmc_sentence(make_truth(position=(0., 0., -2.)), quiet_spec(),
+                            np.random.default_rng(0), unix_time=1.7e9)
+    assert pynmea2.parse(sentence.strip(), check=True).status == "V"
+    assert parse_gprmc(sentence.strip()) is None
+
+def test_rmc_checksum():
+    sentence = rmc_sentence(make_truth(), quiet_spec(), np.random.default_rng(0), unix_time=1.7e9)
+    body, checksum = sentence.strip()[1:].split("*")
+    corrupted = "$" + body.replace("GPRMC", "GPRMD", 1) + "*" + checksum
+    with pytest.raises(pynmea2.ChecksumError):
+        pynmea2.parse(corrupted, check=True)
+
+@pytest.mark.parametrize("z, depth", [(-3., 3.), (-0.5, 0.5), (1., 0.)])
+def test_ms5837_depth(time, z, depth):
+    emulator = make_emulator(time, make_truth(position=(0., 0., z)), quiet_spec())
+    assert emulator.depth() == pytest.approx(depth, abs=1e-9)
+    sensor = emulator.pressure_sensor
+    assert sensor.pressure() == pytest.approx(1013. + 1029. * G * depth / 100.)
+    # Like the real one, depth follows the fluid density set on it
+    sensor.setFluidDensity(1000.)
+    assert sensor.depth() == pytest.approx(depth * 1029. / 1000., abs=1e-9)
+
+def test_imu_at_rest(time):
+    emulator = make_emulator(time, make_truth(), quiet_spec())
+    np.testing.assert_allclose(emulator.imu.acceleration, [0., 0., G])
+    np.testing.assert_allclose(emulator.imu.gyro, [0., 0., 0.])
+    assert time.now == 0.
+    # Reading again waits for the next sample
+    np.testing.assert_allclose(emulator.imu.acceleration, [0., 0., G])
+    assert time.now == pytest.approx(1. / emulator.spec.imu_rate)
+
+def test_imu_tilted_at_rest(time):
+    rotation = Rotation.from_euler("XYZ", [10., -20., 30.], degrees=True)
+    emulator = make_emulator(time, make_truth(rotation=rotation.as_matrix()), quiet_spec())
+    # Gravity's reaction, up in the world, seen from the body
+    np.testing.assert_allclose(emulator.imu.acceleration, rotation.inv().apply([0., 0., G]), atol=1e-12)
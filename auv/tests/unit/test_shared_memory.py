@@ -0,0 +1,117 @@
+import threading
+
+import numpy as np
+import pytest
+
+from models.data_types import State
+from models.shared_memory import SharedStateHandle, SnapshotTimeout, load_barrier
+
+def make_state(value: float) -> State:
+    state = State()
+    for field in (state.position, state.velocity, state.attitude, state.angular_velocity):
+        field[:] = value
+    return state
+
+def assert_state(state: State, value: float):
+    for field in (state.position, state.velocity, state.attitude, state.angular_velocity):
+        np.testing.assert_array_equal(field, value)
+
+def test_round_trip(shm_name, locked):
+    name = shm_name()
+    writer = SharedStateHandle(name, locked=locked)
+    reader = SharedStateHandle(name, locked=locked)
+    state = State()
+    state.position[:] = [1., 2., 3.]
+    state.velocity[:] = [4., 5., 6.]
+    state.attitude[:] = [7., 8., 9.]
+    state.angular_velocity[:] = [10., 11., 12.]
+    writer.write_from(state, timestamp=42.)
+
+    out = State()
+    assert reader.read_into(out)
+    for field in ("position", "velocity", "attitude", "angular_velocity"):
+        np.testing.assert_array_equal(getattr(out, field), getattr(state, field))
+    assert reader.last_timestamp == 42.
+    assert reader.sequence() == 2
+    writer.close()
+    reader.close()
+
+def test_staleness(shm_name):
+    name = shm_name()
+    writer = SharedStateHandle(name)
+    reader = SharedStateHandle(name)
+    out = State()
+    # Never written
+    assert not reader.has_update()
+    assert not reader.read_into(out)
+
+    writer.write_from(make_state(1.), timestamp=1.)
+    assert reader.has_update()
+    assert reader.read_into(out)
+    assert not reader.has_update()
+    assert not reader.read_into(out)
+    assert_state(out, 1.)
+    assert reader.last_timestamp == 1.
+
+    writer.write_from(make_state(2.), timestamp=2.)
+    assert reader.read_into(out)
+    assert_state(out, 2.)
+    writer.close()
+    reader.close()
+
+def test_timeout_leaves_state_untouched(shm_name):
+    name = shm_name()
+    writer = SharedStateHandle(name, locked=False)
+    reader = SharedStateHandle(name, max_retries=10, locked=False)
+    writer.write_from(make_state(1.))
+    writer._sequence[0] += 1 # A writer stuck halfway through
+    out = make_state(5.)
+    with pytest.raises(SnapshotTimeout):
+        reader.read_into(out)
+    assert_state(out, 5.)
+    assert reader.last_sequence == 0
+    writer.close()
+    reader.close()
+
+def test_no_torn_reads(shm_name, locked):
+    """ Every snapshot read while another thread writes is one whole write """
+    name = shm_name()
+    writes = 20000
+    done = threading.Event()
+    def write():
+        writer = SharedStateHandle(name, locked=locked)
+        state = State()
+        for value in range(1, writes + 1):
+            for field in (state.position, state.velocity, state.attitude, state.angular_velocity):
+                field[:] = value
+            writer.write_from(state, timestamp=float(value))
+        writer.close()
+        done.set()
+    thread = threading.Thread(target=write)
+    reader = SharedStateHandle(name, locked=locked)
+    out = State()
+    last = 0.
+    thread.start()
+    while not done.is_set():
+        try:
+            updated = reader.read_into(out)
+        except SnapshotTimeout:
+            # The writer thread lost the GIL mid-write, which is fine
+            continue
+        if updated:
+            value = out.position[0]
+            assert_state(out, value)
+            assert reader.last_timestamp == value
+            assert value >= last
+            last = value
+    thread.join()
+    reader.read_into(out)
+    assert_state(out, writes)
+    reader.close()
+
+def test_barrier():
+    barrier = load_barrier()
+    if barrier is None:
+        pytest.skip("No memory barrier for this CPU")
+    barrier()
+    assert load_barrier("sparc") is None
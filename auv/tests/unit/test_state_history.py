@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from models.data_types import State
+from models.shared_memory import StateHistoryHandle, HISTORY_DTYPE
+
+SLOTS = 8
+
+def append_values(history: StateHistoryHandle, first: int, last: int):
+    state = State()
+    for value in range(first, last + 1):
+        state.position[:] = value
+        state.attitude[:] = -value
+        history.append(state, timestamp=value / 10)
+
+@pytest.fixture
+def history(shm_name, locked):
+    handle = StateHistoryHandle(shm_name("history", slots=SLOTS), slots=SLOTS, locked=locked)
+    yield handle
+    handle.close()
+
+def test_empty(history):
+    out = np.zeros(4, dtype=HISTORY_DTYPE)
+    assert history.count() == 0
+    assert history.read_last(4, out) == 0
+    view, count = history.window(4)
+    assert len(view) == 0 and count == 0
+
+def test_fewer_than_asked(history):
+    append_values(history, 1, 3)
+    out = np.zeros(5, dtype=HISTORY_DTYPE)
+    assert history.read_last(5, out) == 3
+    assert out["sequence"][:3].tolist() == [1, 2, 3]
+    assert out["timestamp"][:3].tolist() == pytest.approx([0.1, 0.2, 0.3])
+
+@pytest.mark.parametrize("appended", [SLOTS - 1, SLOTS, SLOTS + 3, 5 * SLOTS + 2])
+def test_wrap(history, appended):
+    """ The newest records come out oldest first however far the ring wrapped """
+    append_values(history, 1, appended)
+    assert history.count() == appended
+    k = SLOTS - 1
+    out = np.zeros(k, dtype=HISTORY_DTYPE)
+    n = history.read_last(k, out)
+    assert n == min(k, appended)
+    expected = list(range(appended - n + 1, appended + 1))
+    assert out["sequence"][:n].tolist() == expected
+    np.testing.assert_array_equal(out["position"][:n, 0], expected)
+    np.testing.assert_array_equal(out["attitude"][:n, 2], [-value for value in expected])
+
+    view, count = history.window(k)
+    assert count == appended
+    np.testing.assert_array_equal(view, out[:n])
+
+def test_window_intact(history):
+    append_values(history, 1, SLOTS)
+    k = 3
+    view, count = history.window(k)
+    assert history.intact(count, k)
+    # The writer can lap the rest of the ring before the window is touched
+    append_values(history, SLOTS + 1, 2 * SLOTS - k - 1)
+    assert history.intact(count, k)
+    assert view["sequence"].tolist() == [SLOTS - 2, SLOTS - 1, SLOTS]
+    append_values(history, 2 * SLOTS - k, 2 * SLOTS - k)
+    assert not history.intact(count, k)
+
+def test_k_out_of_range(history):
+    out = np.zeros(SLOTS, dtype=HISTORY_DTYPE)
+    for k in (0, SLOTS):
+        with pytest.raises(ValueError):
+            history.read_last(k, out)
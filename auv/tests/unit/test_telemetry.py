@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from models.data_types import State
+from models.telemetry import (
+    FRAME_STATE, FRAME_BATCH, FRAME_BATCH_ZLIB, FRAME_VERSION,
+    HEADER, STATE_FRAME, BATCH_ENTRY,
+    encode_state, decode_header, decode_state, encode_batch, decode_batch,
+)
+
+def make_state() -> State:
+    state = State()
+    state.position[:] = [12.5, -3.25, -1.5]
+    state.velocity[:] = [0.5, -0.125, 0.01]
+    state.attitude[:] = [1.5, -2.25, 179.9]
+    state.angular_velocity[:] = [0.1, -0.2, 0.3]
+    return state
+
+def test_state_round_trip():
+    state = make_state()
+    frame = encode_state(state, sequence=7, timestamp=12.345)
+    assert len(frame) == STATE_FRAME.size == 38
+    assert decode_header(frame) == (FRAME_STATE, 7, pytest.approx(12.345))
+    decoded = decode_state(frame)
+    np.testing.assert_allclose(decoded["position"], state.position, rtol=1e-6)
+    # Half floats, good to about 0.1 degrees and 1 mm/s
+    np.testing.assert_allclose(decoded["velocity"], state.velocity, atol=1e-3)
+    np.testing.assert_allclose(decoded["attitude"], state.attitude, atol=0.1)
+    np.testing.assert_allclose(decoded["angular_velocity"], state.angular_velocity, atol=1e-3)
+
+def test_header_wraps():
+    frame = encode_state(make_state(), sequence=0x10001, timestamp=2**32 / 1000 + 1.)
+    _frame_type, sequence, timestamp = decode_header(frame)
+    assert sequence == 1
+    assert timestamp == pytest.approx(1.)
+
+@pytest.mark.parametrize("frame", [
+    b"",
+    b"\x01\x01\x00",
+    HEADER.pack(FRAME_VERSION + 1, FRAME_STATE, 0, 0),
+])
+def test_bad_header(frame):
+    with pytest.raises(ValueError):
+        decode_header(frame)
+
+@pytest.mark.parametrize("change", [-1, 1])
+def test_wrong_size_state(change):
+    frame = encode_state(make_state(), 0, 0.)
+    frame = frame[:change] if change < 0 else frame + b"\x00"
+    decode_header(frame) # The header itself is fine
+    with pytest.raises(ValueError):
+        decode_state(frame)
+
+def test_batch_round_trip():
+    frame = encode_state(make_state(), 1, 0.)
+    messages = ['{"type": "info", "content": "ok"}', frame, "", b""]
+    batch = encode_batch(messages, sequence=5, timestamp=1.)
+    assert decode_header(batch) == (FRAME_BATCH, 5, pytest.approx(1.))
+    assert decode_batch(batch) == messages
+
+def test_batch_compression():
+    messages = ['{"type": "info", "content": "the same log again"}'] * 50
+    batch = encode_batch(messages, 0, 0., compress=True)
+    assert batch[1] == FRAME_BATCH_ZLIB
+    assert len(batch) < len(encode_batch(messages, 0, 0.))
+    assert decode_batch(batch) == messages
+    # Left uncompressed when compressing doesn't help
+    assert encode_batch(["x"], 0, 0., compress=True)[1] == FRAME_BATCH
+
+def test_empty_batch():
+    assert decode_batch(encode_batch([], 0, 0.)) == []
+
+@pytest.mark.parametrize("keep", [BATCH_ENTRY.size - 2, BATCH_ENTRY.size + 3])
+def test_truncated_batch(keep):
+    """ Cut inside the entry header, and inside the message """
+    batch = encode_batch(['{"type": "info"}'], 0, 0.)
+    with pytest.raises(ValueError):
+        decode_batch(batch[:HEADER.size + keep])
+
+def test_bad_compressed_batch():
+    batch = encode_batch(['{"type": "info"}'] * 50, 0, 0., compress=True)
+    with pytest.raises(ValueError):
+        decode_batch(batch[:HEADER.size] + b"not zlib")
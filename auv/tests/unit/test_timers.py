@@ -0,0 +1,119 @@
+import pytest
+
+from models.data_types import Promise
+from models.timers import TimerService
+
+@pytest.fixture
+def timers(time):
+    time.now = 100.
+    return TimerService(clock=time)
+
+def test_one_shot(time, timers):
+    calls = []
+    timers.schedule("a", 1., lambda: calls.append("a"))
+    assert "a" in timers and len(timers) == 1
+    assert timers.timeout() == pytest.approx(1.)
+    time.now += 0.5
+    assert timers.run_due() == 0
+    assert timers.timeout() == pytest.approx(0.5)
+    time.now += 0.5
+    assert timers.run_due() == 1
+    assert calls == ["a"]
+    assert "a" not in timers
+    assert timers.timeout() is None
+
+def test_order(time, timers):
+    calls = []
+    timers.schedule("late", 2., lambda: calls.append("late"))
+    timers.schedule("first", 1., lambda: calls.append("first"))
+    timers.schedule("second", 1., lambda: calls.append("second"))
+    time.now += 5.
+    assert timers.run_due() == 3
+    assert calls == ["first", "second", "late"]
+
+def test_repeating_keeps_its_schedule(time, timers):
+    calls = []
+    timers.schedule("tick", 1., lambda: calls.append(time.now), interval=1.)
+    for _ in range(3):
+        time.now += 1.2 # Runs late, but the next deadline doesn't drift
+        timers.run_due()
+        time.now -= 0.2
+    assert calls == pytest.approx([101.2, 102.2, 103.2])
+    assert timers.next_deadline() == pytest.approx(104.)
+    # Falling more than a whole interval behind skips the missed runs
+    time.now += 3.5
+    assert timers.run_due() == 1
+    assert timers.next_deadline() == pytest.approx(time.now + 1.)
+
+def test_cancel(time, timers):
+    calls = []
+    timers.schedule("a", 1., lambda: calls.append("a"))
+    timers.schedule("b", 2., lambda: calls.append("b"))
+    assert timers.cancel("a")
+    assert not timers.cancel("a")
+    assert timers.timeout() == pytest.approx(2.)
+    time.now += 5.
+    assert timers.run_due() == 1
+    assert calls == ["b"]
+
+def test_cancel_repeating_from_its_callback(time, timers):
+    calls = []
+    def callback():
+        calls.append(time.now)
+        timers.cancel("tick")
+    timers.schedule("tick", 1., callback, interval=1.)
+    time.now += 1.
+    timers.run_due()
+    time.now += 5.
+    assert timers.run_due() == 0
+    assert calls == [101.]
+    assert timers.timeout() is None
+
+def test_schedule_replaces(time, timers):
+    calls = []
+    timers.schedule("a", 1., lambda: calls.append(1))
+    timers.schedule("a", 3., lambda: calls.append(2))
+    assert len(timers) == 1
+    time.now += 2.
+    assert timers.run_due() == 0
+    time.now += 1.
+    assert timers.run_due() == 1
+    assert calls == [2]
+
+def test_rearm(time, timers):
+    calls = []
+    timers.schedule("watchdog", 1., lambda: calls.append("one-shot"))
+    timers.schedule("tick", 1., lambda: calls.append("tick"), interval=2.)
+    time.now += 0.9
+    assert timers.rearm("watchdog", 1.)
+    assert timers.rearm("tick") # From now, by its interval
+    time.now += 0.9
+    assert timers.run_due() == 0
+    assert timers.next_deadline() == pytest.approx(101.9)
+    time.now += 0.1
+    assert timers.run_due() == 1
+    assert calls == ["one-shot"]
+    assert timers.next_deadline() == pytest.approx(102.9)
+    assert not timers.rearm("watchdog") # Already ran
+    timers.schedule("once", 1., lambda: None)
+    with pytest.raises(ValueError): # A one-shot has no interval to fall back on
+        timers.rearm("once")
+
+def test_rearm_does_not_grow_heap(timers):
+    timers.schedule("watchdog", 1., lambda: None)
+    for _ in range(10000):
+        timers.rearm("watchdog", 1.)
+    assert len(timers._heap) <= 130
+    assert len(timers) == 1
+
+def test_promise(time, timers, monkeypatch):
+    import models.timers
+    monkeypatch.setattr(models.timers, "time", lambda: 1000.)
+    calls = []
+    promise = Promise(name="p", duration=2., callback=lambda: calls.append("p"))
+    promise.init = 999.5 # Created half a second ago
+    timers.add(promise)
+    assert timers.timeout() == pytest.approx(1.5)
+    time.now += 1.5
+    timers.run_due()
+    assert calls == ["p"]
@@ -0,0 +1,22 @@
+import asyncio
+import json
+from queue import Queue
+
+from core.websocket_handler import read_from_base
+from models.outbound import OutboundQueue
+
+async def messages(*raw):
+    for message in raw:
+        yield message
+
+def test_read_from_base_skips_non_objects():
+    queue_to_base = OutboundQueue()
+    queue_from_base: Queue = Queue()
+    logs = []
+    raw = ["not json", "[1]", '"x"', "3", "{}", '{"command": "ping"}']
+    asyncio.run(read_from_base(messages(*raw), queue_to_base, queue_from_base, logs.append))
+    # Only the object made it through, and was acknowledged
+    assert queue_from_base.get_nowait()["command"] == "ping"
+    assert queue_from_base.empty()
+    assert json.loads(queue_to_base.get_nowait()) == {"command": "ping", "ack": True}
+    assert sum("isn't" in log for log in logs) == 4
@@ -1,21 +1,18 @@
-from fastapi import FastAPI, WebSocket, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import uvicorn
 
-import cv2
-
 from contextlib import asynccontextmanager
 import asyncio
-from queue import Queue, Empty
-import threading
 import json
 from typing import Optional
 from pathlib import Path
 from time import sleep
 
-from backend import socket_thread
+from backend import AUVLink
+from broadcast import Broadcaster, Subscription
 
 from pydantic_yaml import parse_yaml_file_as
 from ruamel.yaml import YAML
@@ -34,66 +31,47 @@ def load_config() -> ConfigSchema:
         local_config = yaml.load(local_file)
         local_file.close()
         if local_config:
-            local_filtered = {k:v for (k,v) in local_config.items() if v}
-            default_config.update(local_filtered)
+            # Every key present replaces the default, even false or null
+            default_config.update(local_config)
     return ConfigSchema(**default_config)
 
-queue_to_frontend = Queue()
-queue_to_auv = Queue()
-meta_from_frontend = Queue()
-meta_to_frontend = Queue()
+# Created in lifespan() since they live in the event loop
+broadcaster: Optional[Broadcaster] = None
+link: Optional[AUVLink] = None
+latest_frame = None # video.LatestFrame when video is enabled
 
 def log(message: str):
-    queue_to_frontend.put("MAIN: \n" + message)
+    if broadcaster:
+        broadcaster.publish("MAIN: \n" + message)
     print("\033[44mMAIN:\033[0m " + message)
 
 config = load_config()
 
 log("STARTUP WITH CONFIGURATION: \n" + str(config.model_dump()))
-log("Initializing remote websocket")
-
-stop_event = threading.Event()
-restart_event = threading.Event()
-shutdown_event = threading.Event()
-connected_event = threading.Event()
-backend_thread = threading.Thread(
-    target=socket_thread,
-    args=[
-        stop_event,
-        config.auv_url,
-        config.ping_interval,
-        queue_to_frontend,
-        queue_to_auv,
-        meta_from_frontend,
-        restart_event,
-        shutdown_event,
-        connected_event,
-    ]
-)
-
-def start_backend():
-    """ If the backend websocket thread is not alive, start it.
-        If it is alive, do nothing.
-    """
-    if backend_thread.is_alive() == False:
-        backend_thread.start()
-
-def kill_backend():
-    """ If the backend websocket thread is alive, tell it to stop
-        and join until it does.
-    """
-    if backend_thread.is_alive() == True:
-        stop_event.set()
-        shutdown_event.set()
-        backend_thread.join()
-
-start_backend()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global broadcaster, link, latest_frame
+    broadcaster = Broadcaster()
+    log("Initializing remote websocket")
+    link = AUVLink(config.auv_url, config.ping_interval, broadcaster)
+    link_task = asyncio.create_task(link.run())
+    video_thread = None
+    if config.video:
+        from video import VideoThread, LatestFrame
+        latest_frame = LatestFrame()
+        video_thread = VideoThread(latest_frame)
+        video_thread.start()
     yield
-    log("Waiting for websocket thread to join")
-    kill_backend()
+    if video_thread:
+        video_thread.quit_loop()
+        # Joined off the event loop, and not forever if GStreamer hangs
+        await asyncio.to_thread(video_thread.join, 5.)
+        if video_thread.is_alive():
+            log("Video thread did not stop, leaving it behind")
+    log("Waiting for websocket task to finish")
+    await link.shutdown()
+    await link_task
 
 app = FastAPI(lifespan=lifespan)
 
@@ -104,49 +82,54 @@ app.mount("/api", api)
 # Mount the static react frontend
 app.mount("/", StaticFiles(directory="./frontend_gui/dist", html=True), name="public")
 
-async def eatSocket(websocket:WebSocket, socket_status_queue:asyncio.Queue):
-    frontend_message = await websocket.receive_json()
-    await websocket.send_text(json.dumps(frontend_message))
-    await socket_status_queue.put(True)
+def handle_frontend_message(frontend_message: dict, subscription: Subscription):
+    assert link
     if frontend_message["command"] == "websocket":
         if frontend_message["content"] == "ping":
-            if backend_thread.is_alive() == False or connected_event.is_set() == False:
-                log("Cannot ping, no active websocket connection")
-            meta_from_frontend.put(frontend_message)
+            link.request_ping()
         elif frontend_message["content"] == "restart":
-            stop_event.set()
-            restart_event.set()
-
+            link.restart()
+        elif frontend_message["content"] == "subscribe":
+            # {"command": "websocket", "content": "subscribe", "topics": [...]}
+            # with null topics for all of them
+            try:
+                subscription.set_topics(frontend_message.get("topics"))
+            except ValueError as err:
+                log(str(err))
     else:
-        queue_to_auv.put(frontend_message)
+        link.to_auv.put_nowait(frontend_message)
+
+async def send_to_frontend(websocket: WebSocket, subscription: Subscription):
+    while True:
+        message_to_frontend = await subscription.get()
+        await websocket.send_text(message_to_frontend)
 
 @api.websocket("/websocket")
-async def frontend_websocket(websocket: WebSocket):
+async def frontend_websocket(websocket: WebSocket, topics: Optional[str] = None):
+    """ One per open GUI, each gets its own subscription to the broadcaster,
+        and its commands go into the shared queue to the AUV. Connect with
+        e.g. ?topics=state,logs to only get some topics (see broadcast.py).
+    """
+    assert broadcaster
     await websocket.accept()
     await websocket.send_text("Local websocket live")
     log("Setup Done")
-    socket_status_queue = asyncio.Queue()
-    await socket_status_queue.put(True)
-    while True:
-        # Sleep so that the async function yields to event loop
-        await asyncio.sleep(0.001)
-        # Check queue_to_frontend & send to frontend
-        try:
-            message_to_frontend = queue_to_frontend.get_nowait()
-            if message_to_frontend:
-                print("\033[45mTO FRONT:\033[0m " + message_to_frontend)
-                await websocket.send_text(message_to_frontend)
-        except Empty:
-            pass
-        # Check websocket & send to queue_to_auv
-        try:
-            socket_available = socket_status_queue.get_nowait()
-            if socket_available:
-                asyncio.create_task(eatSocket(websocket=websocket,
-                                              socket_status_queue=socket_status_queue))
-        except asyncio.queues.QueueEmpty:
-            pass
-        continue
+    try:
+        subscription = broadcaster.subscribe(topics.split(",") if topics else None)
+    except ValueError as err:
+        log(str(err))
+        subscription = broadcaster.subscribe()
+    sender = asyncio.create_task(send_to_frontend(websocket, subscription))
+    try:
+        while True:
+            frontend_message = await websocket.receive_json()
+            await websocket.send_text(json.dumps(frontend_message))
+            handle_frontend_message(frontend_message, subscription)
+    except WebSocketDisconnect:
+        log("Frontend disconnected")
+    finally:
+        broadcaster.unsubscribe(subscription)
+        sender.cancel()
 
 layout_data_path = "./data/gui_layouts.json"
 
@@ -177,30 +160,19 @@ def get_layouts():
     except json.JSONDecodeError:
         log("Error: The gui grid layout json file at " + layout_data_path + " is invalid json")
 
-if config.video:
-    from video import VideoThread
-    video_q = Queue()
-    video_thread = VideoThread(video_q)
-
 async def generate_frames():
-    if not config.video:
-        return
+    """ MJPEG stream for one viewer, always the newest frame. The frames are
+        encoded once and shared by every viewer (see video.py).
+    """
+    assert latest_frame
+    sequence = 0
     while True:
-        try:
-            img = video_q.get()
-            ret, jpeg = cv2.imencode('.jpg', img)
-            if not ret:
-                log(f"Error: Could not encode image to JPEG")
-                continue
-
-            yield b'--frame\r\n' + b'Content-Type: image/jpeg\r\n\r\n' + jpeg.tobytes() + b'\r\n'
-
-        except Exception as e:
-            log(f"An error occurred while processing: {str(e)}")
+        sequence, part = await latest_frame.next(sequence)
+        yield part
 
 @api.get('/video_feed')
 async def video_feed():
-    if config.video:
+    if latest_frame:
         return StreamingResponse(
                 generate_frames(),
                 media_type='multipart/x-mixed-replace; boundary=frame',
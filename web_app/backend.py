@@ -1,17 +1,18 @@
-from websockets.sync.client import connect
+from websockets.asyncio.client import connect, ClientConnection
 from websockets.exceptions import ConnectionClosedOK, ConnectionClosedError
 
 import json
-from queue import Queue, Empty
-from functools import partial
-import threading
+import asyncio
 from time import time
-from typing import Optional, Union, Callable
+from typing import Optional, Union, Dict, Any
 from dataclasses import dataclass, asdict
 
+from telemetry import decode_frame, is_batch, unpack_batch
+from broadcast import Broadcaster, topic_of, topic_of_type
+
 @dataclass
 class Ping:
-    event: Optional[threading.Event]
+    event: None # Kept so the frontend sees the same ping object as before
     init_time: float
     elapsed_time: Optional[float] = None
 
@@ -21,136 +22,143 @@ class Data:
     content: Union[Ping, str]
     source: str = "WSKT"
 
-def custom_log(message: str, queue:Queue):
-    queue.put("WSKT: \n" + message)
-    print("\033[42mWSKT:\033[0m " + message)
-
-def socket_handler(
-    stop_event: threading.Event,
-    ip_address: str,
-    ping_interval: int,
-    queue_to_frontend: Queue,
-    queue_to_auv: Queue,
-    meta_from_frontend: Queue,
-    log: Callable,
-    connected_event: threading.Event,
-):
-    last_ping = time() - ping_interval # To do first ping immediately
-    active_pings = []
-    try:
-        websocket = connect(uri=ip_address)
-        hello = websocket.recv(timeout=None)
-        log("AUV Hello: " + str(hello))
-        connected_event.set()
-        while True:
-            if stop_event.is_set():
-                stop_event.clear()
-                websocket.close()
-                return
+class AUVLink:
+    """ Websocket client to the AUV that lives in the FastAPI event loop.
 
-            # For any active pings, check if the pong has been received
-            for ping in active_pings:
-                if ping.event.is_set():
-                    ping.elapsed_time = time() - ping.init_time
-                    ping.event = None
-                    ping_result = Data(
-                        type = "ping",
-                        content = ping
-                    )
-                    queue_to_frontend.put(json.dumps(asdict(ping_result)))
-                    active_pings.remove(ping)
-
-            if time() - last_ping > ping_interval:
-                active_pings.append(
-                    Ping(
-                        event = websocket.ping(),
-                        init_time = time()
-                    )
-                )
-                last_ping = time()
-
-            # If ping requested, ping and set up object
-            try:
-                meta_command = meta_from_frontend.get_nowait()
-                log("Received meta command: \n" + json.dumps(meta_command))
-                if meta_command["content"] == "ping":
-                    event = websocket.ping()
-                    new_ping = Ping(
-                        event = event,
-                        init_time = time()
-                    )
-                    active_pings.append(new_ping)
-            except Empty:
-                pass
-
-            # Forward messages from both ends
-            try:
-                message_to_frontend = json.loads(websocket.recv(timeout=0.0001)) # Doesn't block since timeout=0
-                if message_to_frontend:
-                    queue_to_frontend.put(message_to_frontend)
-            except TimeoutError:
-                pass
+        Every message from the AUV is published to `broadcaster` under its
+        topic, which fans it out to the frontend websockets.
+
+        Commands to the AUV wait in `to_auv` while disconnected. Call restart()
+        to (re)connect, and await run() once to drive everything. Create it
+        from inside the event loop.
+    """
+    def __init__(
+        self,
+        url: str,
+        ping_interval: int,
+        broadcaster: Broadcaster,
+    ):
+        self.url = url
+        self.ping_interval = ping_interval
+        self.broadcaster = broadcaster
+        self.to_auv: asyncio.Queue = asyncio.Queue()
+        self.connected = asyncio.Event()
+        self.websocket: Optional[ClientConnection] = None
+        self._restart = asyncio.Event()
+        self._shutdown = asyncio.Event()
+
+    def log(self, message: str):
+        self.broadcaster.publish("WSKT: \n" + message)
+        print("\033[42mWSKT:\033[0m " + message)
+
+    def forward_to_frontend(self, message: Union[str, bytes]):
+        if isinstance(message, bytes):
+            # Binary telemetry frame, decoded to JSON for the frontend
             try:
-                message_to_auv = queue_to_auv.get_nowait()
-                if message_to_auv:
-                    websocket.send(json.dumps(message_to_auv))
-            except Empty:
-                pass
-
-
-    except Exception as err:
-        if err.__class__ == ConnectionClosedOK:
-            log("AUV disconnected (OK)")
-        elif err.__class__ == ConnectionClosedError:
-            log("AUV disconnected (ERROR)")
+                frame = decode_frame(message)
+                self.broadcaster.publish(json.dumps(frame), topic_of_type(frame["type"]))
+            except ValueError as err:
+                self.log("Bad telemetry frame: " + str(err))
         else:
-            log("Unknown error")
-        log(repr(err))
+            # Already JSON text
+            self.broadcaster.publish(message, topic_of(message))
+
+    def restart(self):
+        """ Closes the connection to the AUV if any, and connects again """
+        self._restart.set()
+        if self.websocket:
+            asyncio.ensure_future(self.websocket.close())
+
+    def request_ping(self):
+        if self.websocket is None or not self.connected.is_set():
+            self.log("Cannot ping, no active websocket connection")
+            return
+        asyncio.ensure_future(self.ping(self.websocket))
+
+    async def ping(self, websocket: ClientConnection):
+        ping = Ping(event=None, init_time=time())
+        try:
+            pong = await websocket.ping()
+            await pong
+        except (ConnectionClosedOK, ConnectionClosedError):
+            return # The reader reports the disconnect
+        ping.elapsed_time = time() - ping.init_time
+        self.broadcaster.publish(json.dumps(asdict(Data(type="ping", content=ping))), "ping")
+
+    async def shutdown(self):
+        self._shutdown.set()
+        self._restart.set()
+        if self.websocket:
+            await self.websocket.close()
+
+    async def run(self):
+        self.log("AUV Socket Handler Alive")
+        self._restart.set() # To start the first time
+        while True:
+            await self._restart.wait()
+            if self._shutdown.is_set():
+                return
+            self._restart.clear()
+            await self.session()
+
+    async def session(self):
+        try:
+            async with connect(self.url, ping_interval=None) as websocket:
+                hello = await websocket.recv()
+                self.log("AUV Hello: " + str(hello))
+                self.websocket = websocket
+                self.connected.set()
+                tasks = [
+                    asyncio.create_task(self.read_from_auv(websocket)),
+                    asyncio.create_task(self.write_to_auv(websocket)),
+                    asyncio.create_task(self.keep_pinging(websocket)),
+                ]
+                try:
+                    done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                for task in done:
+                    if task.exception():
+                        raise task.exception() # type: ignore
+                self.log("AUV disconnected (OK)")
+        except ConnectionClosedOK as err:
+            self.log("AUV disconnected (OK)")
+            self.log(repr(err))
+        except ConnectionClosedError as err:
+            self.log("AUV disconnected (ERROR)")
+            self.log(repr(err))
+        except Exception as err:
+            self.log("Unknown error")
+            self.log(repr(err))
+        finally:
+            self.websocket = None
+            self.connected.clear()
         dead_object = Data(
             type = "WSKT",
             content = "WSKT DEAD"
         )
-        log(json.dumps(asdict(dead_object)))
-        connected_event.clear()
-        return
-
-def socket_thread(
-    stop_event: threading.Event,
-    ip_address: str,
-    ping_interval: int,
-    queue_to_frontend: Queue,
-    queue_to_auv: Queue,
-    meta_from_frontend: Queue,
-    restart_event: threading.Event,
-    shutdown_event: threading.Event,
-    connected_event: threading.Event,
-):
-    """ stop_event does not stop the thread, it merely closes the websocket
-        ping_interval not yet implemented.
-        queue_to_frontend and queue_to_auv are the passthrough "pipe" queues
-        meta_from_frontend is for websocket ping commands
-        restart_event tries to reconnect the websocket
-        shutdown_event exits the thread so it can be joined
-
-        Note: to fully end the connection and shut down, both stop_event and
-        shutdown_event must be set.
-    """
-    log = partial(custom_log, queue=queue_to_frontend)
-    log("AUV Socket Handler Alive")
-    restart_event.set() # To start the first time
-    while True:
-        if shutdown_event.is_set():
-            return
-        if restart_event.is_set():
-            stop_event.clear()
-            restart_event.clear()
-            socket_handler(
-                stop_event,
-                ip_address,
-                ping_interval,
-                queue_to_frontend,
-                queue_to_auv,
-                meta_from_frontend,
-                log,
-                connected_event,
-            )
+        self.log(json.dumps(asdict(dead_object)))
+
+    async def read_from_auv(self, websocket: ClientConnection):
+        async for message in websocket:
+            if isinstance(message, bytes) and is_batch(message):
+                # Several messages coalesced by the AUV into one frame
+                try:
+                    for unpacked in unpack_batch(message):
+                        self.forward_to_frontend(unpacked)
+                except ValueError as err:
+                    self.log("Bad batch frame: " + str(err))
+            elif message:
+                self.forward_to_frontend(message)
+
+    async def write_to_auv(self, websocket: ClientConnection):
+        while True:
+            message: Dict[str, Any] = await self.to_auv.get()
+            await websocket.send(json.dumps(message))
+
+    async def keep_pinging(self, websocket: ClientConnection):
+        while True:
+            await self.ping(websocket)
+            await asyncio.sleep(self.ping_interval)
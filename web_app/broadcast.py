@@ -0,0 +1,111 @@
+""" Fans messages out to every open frontend websocket, by topic. """
+
+import asyncio
+import json
+import threading
+from collections import deque
+from typing import Deque, Dict, Iterable, Literal, Optional, Set, get_args
+
+Topic = Literal["state", "logs", "tasks", "ping"]
+TOPICS: Set[str] = set(get_args(Topic))
+
+# Topics where only the newest message matters, so a subscriber that falls
+# behind gets the latest one instead of a backlog
+LATEST_ONLY: Set[str] = {"state"}
+
+# Message types from the AUV that aren't logs
+TYPE_TOPICS: Dict[str, str] = {
+    "state": "state",
+    "tasks": "tasks",
+    "task_stats": "tasks",
+    "task_info": "tasks",
+    "ping": "ping",
+}
+
+def topic_of_type(message_type: Optional[str]) -> str:
+    return TYPE_TOPICS.get(message_type, "logs") # type: ignore
+
+def topic_of(message: str) -> str:
+    """ Topic of a JSON message from the AUV, by its "type" (logs if none) """
+    try:
+        parsed = json.loads(message)
+    except ValueError:
+        return "logs"
+    if not isinstance(parsed, dict):
+        return "logs"
+    return topic_of_type(parsed.get("type"))
+
+class Subscription:
+    """ What one frontend receives: messages of `topics` (all if None) in a
+        ring of the newest `size`, plus the latest of each LATEST_ONLY topic.
+        Messages pushed out of the ring or superseded are counted in `dropped`.
+    """
+    def __init__(self, topics: Optional[Iterable[str]] = None, size: int = 1024):
+        self.topics: Optional[Set[str]] = None
+        self.set_topics(topics)
+        self.ring: Deque[str] = deque(maxlen=size)
+        self.latest: Dict[str, str] = {}
+        self.dropped = 0
+        self._ready = asyncio.Event()
+
+    def set_topics(self, topics: Optional[Iterable[str]]):
+        if topics is None:
+            self.topics = None
+            return
+        topics = set(topics)
+        unknown = topics - TOPICS
+        if unknown:
+            raise ValueError("Unknown topics: " + ", ".join(sorted(unknown)))
+        self.topics = topics
+
+    def wants(self, topic: str) -> bool:
+        return self.topics is None or topic in self.topics
+
+    def push(self, message: str, topic: str):
+        if topic in LATEST_ONLY:
+            if topic in self.latest:
+                self.dropped += 1
+            self.latest[topic] = message
+        else:
+            if len(self.ring) == self.ring.maxlen:
+                self.dropped += 1
+            self.ring.append(message)
+        self._ready.set()
+
+    async def get(self) -> str:
+        while True:
+            if self.ring:
+                return self.ring.popleft()
+            if self.latest:
+                topic = next(iter(self.latest))
+                return self.latest.pop(topic)
+            self._ready.clear()
+            await self._ready.wait()
+
+class Broadcaster:
+    """ Sends every published message to each subscription that wants its
+        topic. A slow subscriber only ever loses its own oldest messages, it
+        never holds up the publisher or the other subscribers. Create it from
+        inside the event loop; publish() may be called from any thread.
+    """
+    def __init__(self, subscriber_size: int = 1024):
+        self.subscriber_size = subscriber_size
+        self.subscriptions: Set[Subscription] = set()
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+
+    def subscribe(self, topics: Optional[Iterable[str]] = None) -> Subscription:
+        subscription = Subscription(topics, self.subscriber_size)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscriptions.discard(subscription)
+
+    def publish(self, message: str, topic: str = "logs"):
+        if threading.get_ident() != self._loop_thread:
+            self._loop.call_soon_threadsafe(self.publish, message, topic)
+            return
+        for subscription in self.subscriptions:
+            if subscription.wants(topic):
+                subscription.push(message, topic)
@@ -0,0 +1,42 @@
+""" Decodes the binary telemetry frames the AUV sends as websocket binary
+    messages. The layout is defined once, in auv/models/telemetry.py, which
+    only needs the standard library and is imported from there.
+"""
+
+from typing import Any, Dict, List, Union
+from pathlib import Path
+import sys
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "auv"))
+from models.telemetry import (
+    FRAME_STATE, FRAME_BATCH, FRAME_BATCH_ZLIB, HEADER,
+    decode_header, decode_state, decode_batch,
+)
+
+def is_batch(frame: bytes) -> bool:
+    return len(frame) >= HEADER.size and frame[1] in (FRAME_BATCH, FRAME_BATCH_ZLIB)
+
+def unpack_batch(frame: bytes) -> List[Union[str, bytes]]:
+    """ The messages in a batch frame, each either JSON text or a frame to
+        pass to decode_frame(). Raises ValueError for a malformed batch.
+    """
+    decode_header(frame)
+    return decode_batch(frame)
+
+def decode_frame(frame: bytes) -> Dict[str, Any]:
+    """ Turns a frame into the same shape of message the frontend gets for
+        every other log, e.g. for a state:
+        {"source": "LCAL", "type": "state", "sequence": 1, "timestamp": 2.0,
+         "content": {"position": [...], "velocity": [...], ...}}
+        Raises ValueError for anything that isn't a known, well formed frame.
+    """
+    frame_type, sequence, timestamp = decode_header(frame)
+    if frame_type == FRAME_STATE:
+        return {
+            "source": "LCAL",
+            "type": "state",
+            "sequence": sequence,
+            "timestamp": timestamp,
+            "content": decode_state(frame),
+        }
+    raise ValueError("Unknown frame type " + str(frame_type))
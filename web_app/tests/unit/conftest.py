@@ -0,0 +1,5 @@
+""" Unit tests for the web app's own modules. Run `python -m pytest
+    tests/unit` from web_app/. The pytest.ini here makes this directory the
+    root, and it has no __init__.py, so pytest never imports the app in
+    web_app/__init__.py.
+"""
@@ -0,0 +1,104 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+from broadcast import Broadcaster, Subscription, topic_of
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, timeout=5))
+
+async def drain(subscription: Subscription) -> list:
+    messages = []
+    while subscription.ring or subscription.latest:
+        messages.append(await subscription.get())
+    return messages
+
+def test_topic_of():
+    assert topic_of(json.dumps({"type": "state"})) == "state"
+    assert topic_of(json.dumps({"type": "task_info"})) == "tasks"
+    assert topic_of(json.dumps({"type": "info"})) == "logs"
+    assert topic_of(json.dumps(["not", "a", "dict"])) == "logs"
+    assert topic_of("not json") == "logs"
+
+def test_ring_overflow():
+    async def main():
+        broadcaster = Broadcaster(subscriber_size=3)
+        slow = broadcaster.subscribe()
+        for index in range(5):
+            broadcaster.publish("log " + str(index))
+        assert slow.dropped == 2
+        # The oldest went, the newest are kept in order
+        assert await drain(slow) == ["log 2", "log 3", "log 4"]
+    run(main())
+
+def test_latest_only():
+    async def main():
+        broadcaster = Broadcaster(subscriber_size=3)
+        subscription = broadcaster.subscribe()
+        for index in range(5):
+            broadcaster.publish("state " + str(index), "state")
+        broadcaster.publish("log", "logs")
+        assert subscription.dropped == 4
+        # Queued messages first, then the latest state
+        assert await drain(subscription) == ["log", "state 4"]
+    run(main())
+
+def test_slow_subscriber_does_not_affect_others():
+    async def main():
+        broadcaster = Broadcaster(subscriber_size=2)
+        slow = broadcaster.subscribe()
+        fast = broadcaster.subscribe()
+        received = []
+        for index in range(4):
+            broadcaster.publish(str(index))
+            received.append(await fast.get())
+        assert received == ["0", "1", "2", "3"]
+        assert fast.dropped == 0
+        assert slow.dropped == 2
+        assert await drain(slow) == ["2", "3"]
+    run(main())
+
+def test_topics():
+    async def main():
+        broadcaster = Broadcaster()
+        tasks_only = broadcaster.subscribe(["tasks"])
+        everything = broadcaster.subscribe()
+        broadcaster.publish("log", "logs")
+        broadcaster.publish("stats", "tasks")
+        assert await drain(tasks_only) == ["stats"]
+        assert await drain(everything) == ["log", "stats"]
+        tasks_only.set_topics(["logs"])
+        broadcaster.publish("log 2", "logs")
+        assert await drain(tasks_only) == ["log 2"]
+        await drain(everything)
+        broadcaster.unsubscribe(everything)
+        broadcaster.publish("log 3", "logs")
+        assert await drain(everything) == []
+    run(main())
+    with pytest.raises(ValueError):
+        Subscription(["sonar"])
+
+def test_get_waits():
+    async def main():
+        broadcaster = Broadcaster()
+        subscription = broadcaster.subscribe()
+        waiter = asyncio.ensure_future(subscription.get())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        broadcaster.publish("log")
+        assert await waiter == "log"
+    run(main())
+
+def test_publish_from_another_thread():
+    async def main():
+        broadcaster = Broadcaster()
+        subscription = broadcaster.subscribe()
+        thread = threading.Thread(target=broadcaster.publish, args=("from a thread", "logs"))
+        thread.start()
+        thread.join()
+        # Handed to the loop rather than pushed from the other thread
+        assert not subscription.ring
+        assert await subscription.get() == "from a thread"
+    run(main())
@@ -0,0 +1,55 @@
+import pytest
+
+from telemetry import decode_frame, is_batch, unpack_batch
+from models.telemetry import (
+    FRAME_STATE, FRAME_VERSION, HEADER, STATE_FRAME, encode_batch,
+)
+
+def state_frame(sequence: int = 3) -> bytes:
+    return STATE_FRAME.pack(
+        FRAME_VERSION, FRAME_STATE, sequence, 2500,
+        1., 2., 3., 0.5, 0., -0.5, 10., 20., -90., 0.25, 0., 0.,
+    )
+
+def test_decode_state():
+    assert decode_frame(state_frame()) == {
+        "source": "LCAL",
+        "type": "state",
+        "sequence": 3,
+        "timestamp": 2.5,
+        "content": {
+            "position": [1., 2., 3.],
+            "velocity": [0.5, 0., -0.5],
+            "attitude": [10., 20., -90.],
+            "angular_velocity": [0.25, 0., 0.],
+        },
+    }
+
+@pytest.mark.parametrize("frame", [
+    b"",
+    state_frame()[:-1],
+    state_frame() + b"\x00",
+    bytes([FRAME_VERSION + 1]) + state_frame()[1:],
+    HEADER.pack(FRAME_VERSION, 99, 0, 0),
+])
+def test_decode_malformed(frame):
+    with pytest.raises(ValueError):
+        decode_frame(frame)
+
+def test_unpack_batch():
+    messages = ['{"type": "info"}', state_frame(1), state_frame(2)]
+    for compress in (False, True):
+        batch = encode_batch(messages, sequence=0, timestamp=0., compress=compress)
+        assert is_batch(batch)
+        entries = unpack_batch(batch)
+        assert entries == messages
+        assert [decode_frame(entry)["sequence"] for entry in entries[1:]] == [1, 2]
+    assert not is_batch(state_frame())
+    assert not is_batch(b"\x01")
+
+def test_unpack_malformed_batch():
+    batch = encode_batch(['{"type": "info"}'], sequence=0, timestamp=0.)
+    with pytest.raises(ValueError):
+        unpack_batch(batch[:-1])
+    with pytest.raises(ValueError):
+        unpack_batch(bytes([FRAME_VERSION + 1]) + batch[1:])
@@ -1,28 +1,69 @@
 import gi
-from PIL import Image
-import numpy as np
 
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst, GLib
 
-from queue import Queue
+import asyncio
 import threading
+from typing import Optional, Tuple
 
 # Initialize GStreamer
 Gst.init(None)
 
+MJPEG_PART_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+
+class LatestFrame:
+    """ Holds only the newest encoded frame, already wrapped as a part of the
+        multipart MJPEG stream, so memory stays at one frame however slow the
+        viewers are. Every viewer gets the same bytes object, nothing is
+        copied or encoded per viewer.
+
+        publish() is called from the GStreamer thread and hands the frame to
+        the event loop, where viewers await next() without blocking it.
+    """
+    def __init__(self):
+        self.frame: Optional[bytes] = None
+        self.sequence = 0
+        self._loop = asyncio.get_running_loop()
+        self._new_frame = asyncio.Event()
+
+    def publish(self, frame: bytes):
+        self._loop.call_soon_threadsafe(self._publish, frame)
+
+    def _publish(self, frame: bytes):
+        self.frame = frame
+        self.sequence += 1
+        # Wake everyone waiting on this event, later waiters get a fresh one
+        self._new_frame.set()
+        self._new_frame = asyncio.Event()
+
+    async def next(self, sequence: int) -> Tuple[int, bytes]:
+        """ The newest frame after `sequence` (0 for whatever is there),
+            waiting for one if needed. Frames in between are skipped.
+        """
+        while self.frame is None or self.sequence <= sequence:
+            await self._new_frame.wait()
+        return self.sequence, self.frame
+
 class VideoThread(threading.Thread):
-    def __init__(self, output_q):
-        super().__init__()
-        self.output_q = output_q
+    """ Receives the H264 RTP stream from the AUV and re-encodes it to JPEG
+        inside the GStreamer pipeline, so each frame reaches Python already
+        encoded. Python only copies it twice, out of GStreamer's buffer and
+        into the part of the stream that goes to `output`.
+    """
+    def __init__(self, output: LatestFrame, quality: int = 85):
+        super().__init__(daemon=True) # So a hung GStreamer loop cannot block exit
+        self.output = output
 
         pipeline = Gst.parse_launch(
             'udpsrc port=5000 caps="application/x-rtp, media=video, encoding-name=H264, payload=96" '
-                '! rtph264depay ! h264parse ! avdec_h264 ! videoconvert ! video/x-raw,format=RGB ! appsink name=sink emit-signals=true max-buffers=1 drop=true'
+                '! rtph264depay ! h264parse ! avdec_h264 ! videoconvert '
+                f'! jpegenc quality={quality} ! appsink name=sink emit-signals=true max-buffers=1 drop=true'
         )
         appsink = pipeline.get_by_name("sink")
         appsink.connect("new-sample", self._on_new_sample)
         pipeline.set_state(Gst.State.PLAYING)
+        self.pipeline = pipeline
 
         self.loop = GLib.MainLoop()
 
@@ -34,6 +75,7 @@ class VideoThread(threading.Thread):
     def quit_loop(self):
         if self.loop:
             print("Scheduling loop quit...")
+            self.pipeline.set_state(Gst.State.NULL)
             # Schedule the quit operation to be executed in the main loop's thread
             GLib.idle_add(self._do_quit)
 
@@ -43,22 +85,21 @@ class VideoThread(threading.Thread):
         return GLib.SOURCE_REMOVE # Ensure this source is removed after executing
 
     def _on_new_sample(self, sink):
-        sample = sink.emit("pull-sample")
-        if sample:
-            buf = sample.get_buffer()
-            caps = sample.get_caps()
-            structure = caps.get_structure(0)
-            width = structure.get_value("width")
-            height = structure.get_value("height")
-
-            success, map_info = buf.map(Gst.MapFlags.READ)
-            if success:
-                data = map_info.data
-
-                # Convert raw RGB data to NumPy array
-                arr = np.frombuffer(data, dtype=np.uint8).reshape((height, width, 3))
-                self.output_q.put(arr)
-
-                buf.unmap(map_info)
-
+        part = sample_to_part(sink.emit("pull-sample"))
+        if part:
+            self.output.publish(part)
         return Gst.FlowReturn.OK
+
+def sample_to_part(sample: Optional[Gst.Sample]) -> Optional[bytes]:
+    """ The JPEG in an appsink sample as a part of the MJPEG stream """
+    if not sample:
+        return None
+    buf = sample.get_buffer()
+    success, map_info = buf.map(Gst.MapFlags.READ)
+    if not success:
+        return None
+    # map_info.data is already a copy (the buffer goes back to its pool right
+    # after), and joining the header on copies it again
+    part = b''.join((MJPEG_PART_HEADER, map_info.data, b'\r\n'))
+    buf.unmap(map_info)
+    return part